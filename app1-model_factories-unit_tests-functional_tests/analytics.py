@@ -0,0 +1,461 @@
+import datetime
+import json
+
+import pytz
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Sum, Count, FloatField
+from django.db.models.functions import Coalesce, Trunc, TruncDate
+from django.utils import timezone
+
+from vitesse_prod.apps.db.models import (
+    User, Order, Purchase, ExpenseClaim, Mileage, Activity, ActivityQuote, SpendRollup, get_currency_rate_table
+)
+
+
+ROLLUP_BATCH_SIZE = 1000
+
+ROLLUP_KEY_FIELDS = ('user', 'category', 'expense_field', 'project', 'currency')
+
+# UserAPIAnalyticsType.command -> rolled up sources
+ANALYTICS_TYPE_SOURCES = {
+    'expenses': (SpendRollup.SOURCE_EXPENSE_CLAIM, SpendRollup.SOURCE_MILEAGE),
+    'purchases': (SpendRollup.SOURCE_ORDER,),
+    'payments': (SpendRollup.SOURCE_PURCHASE,),
+    'travel': (SpendRollup.SOURCE_ACTIVITY,),
+}
+
+TIME_SERIES_PERIODS = ('week', 'month', 'quarter')
+
+# Rollup days are cut in this timezone whatever timezone the request or command activated
+ROLLUP_TIMEZONE = pytz.timezone(settings.TIME_ZONE)
+
+# First key of the company rollups advisory locks
+ROLLUP_LOCK_NAMESPACE = 7301
+
+
+def get_spend_rollup_sources():
+    """
+    (source, model, company lookup, date field, filters, {key field: expression}, amount expression).
+    Expenses are rolled up in the claim currency (value_in_base), mileages in the user's default currency.
+    """
+
+    return (
+        (SpendRollup.SOURCE_ORDER, Order, 'company_id', 'date_created', {'is_deleted': False}, {
+            'user': F('app_user_id'),
+            'category': F('category_id'),
+            'currency': F('currency_id'),
+        }, F('estimated_value') * F('quantity')),
+
+        (SpendRollup.SOURCE_PURCHASE, Purchase, 'user__company_id', 'date_created', {'is_deleted': False}, {
+            'user': F('user_id'),
+            'category': F('quote__order__category_id'),
+            'project': F('activity_quote__activity__project_id'),
+            'activity_type': F('activity_quote__activity__type'),
+            'currency': Coalesce(
+                'quote__order__currency_id',
+                'itinerary_quote__itinerary__currency_id',
+                'activity_quote__activity__currency_id'
+            ),
+        }, F('sum_paid')),
+
+        (SpendRollup.SOURCE_EXPENSE_CLAIM, ExpenseClaim, 'user__company_id', 'date', {}, {
+            'user': F('user_id'),
+            'expense_field': F('expense_field_id'),
+            'project': F('project_id'),
+            'currency': F('currency_id'),
+        }, F('value_in_base')),
+
+        (SpendRollup.SOURCE_MILEAGE, Mileage, 'user__company_id', 'date', {}, {
+            'user': F('user_id'),
+            'project': F('project_id'),
+            'currency': F('user__default_currency_id'),
+        }, F('miles') * F('cost_per_mile')),
+
+        (SpendRollup.SOURCE_ACTIVITY, Activity, 'company_id', 'date_created', {
+            'is_deleted': False, 'activity_quotes__is_accepted': True
+        }, {
+            'user': F('user_id'),
+            'project': F('project_id'),
+            'activity_type': F('type'),
+            'currency': F('currency_id'),
+        }, F('activity_quotes__value')),
+    )
+
+
+def get_local_date(value, tz=ROLLUP_TIMEZONE):
+    # Same day boundaries as TruncDate / __date with tz active
+
+    if settings.USE_TZ and timezone.is_aware(value):
+        value = timezone.localtime(value, tz)
+
+    return value.date()
+
+
+def get_rollup_lookups(instance):
+    # (source spec, fact lookups) of the rollup rows the instance counts in. An activity counts in the rollups
+    # through its accepted quotes, each quote for its own value
+
+    for source in get_spend_rollup_sources():
+        model, filters = source[1], source[4]
+
+        if isinstance(instance, ActivityQuote) and model == Activity:
+            lookups = dict(filters, id=instance.activity_id, activity_quotes__id=instance.pk)
+        elif isinstance(instance, model):
+            lookups = dict(filters, id=instance.pk)
+        else:
+            continue
+
+        yield source, lookups
+
+
+def group_spend_facts(source, queryset, company_lookup, date_field, keys, amount):
+    # (SpendRollup field values, amount, count) per rollup row of the facts
+
+    # Prefixed aliases, annotations may not shadow the model fields
+    expressions = dict(('rollup_%s' % field, expression) for field, expression in keys.items())
+    expressions['rollup_company'] = F(company_lookup)
+    expressions['rollup_date'] = TruncDate(date_field)
+
+    rows = queryset.order_by().values(**expressions).annotate(
+        rollup_amount=Sum(amount, output_field=FloatField()),
+        rollup_count=Count('id'),
+    )
+
+    for row in rows:
+        values = dict(('%s_id' % field, row.get('rollup_%s' % field)) for field in ROLLUP_KEY_FIELDS)
+        values.update(company_id=row['rollup_company'], date=row['rollup_date'], source=source,
+                      activity_type=row.get('rollup_activity_type') or '')
+
+        yield values, row['rollup_amount'] or 0, row['rollup_count']
+
+
+def get_spend_contributions(instance, lock=False):
+    """
+    {rollup row key: (amount, count)} the saved instance adds to the rollups, read from the database.
+    lock: the fact row is locked first, so a concurrent save of it can't read the same previous contributions.
+    """
+
+    contributions = {}
+    if instance.pk is None:
+        return contributions
+
+    with timezone.override(ROLLUP_TIMEZONE):
+        for (source, model, company_lookup, date_field, filters, keys, amount), lookups in get_rollup_lookups(instance):
+            if lock:
+                list(model.objects.select_for_update().filter(id=lookups['id']).values_list('id', flat=True))
+
+            for values, row_amount, row_count in group_spend_facts(
+                    source, model.objects.filter(**lookups), company_lookup, date_field, keys, amount):
+                if values['company_id']:
+                    contributions[tuple(sorted(values.items()))] = (row_amount, row_count)
+
+    return contributions
+
+
+def lock_company_rollups(company_id, shared=False):
+    # Transaction level advisory lock: saves share it, a rebuild of the company takes it alone
+
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_xact_lock%s(%%s, %%s)' % ('_shared' if shared else ''),
+                       [ROLLUP_LOCK_NAMESPACE, company_id])
+
+
+def apply_spend_rollup_deltas(previous, current):
+    """
+    Adds the difference of two get_spend_contributions() results to the rollups with F() increments,
+    in the transaction of the save. A key without a rollup row yet gets a new one.
+    """
+
+    deltas = {}
+    for key in set(previous) | set(current):
+        previous_amount, previous_count = previous.get(key, (0, 0))
+        current_amount, current_count = current.get(key, (0, 0))
+
+        if current_amount != previous_amount or current_count != previous_count:
+            deltas[key] = (current_amount - previous_amount, current_count - previous_count)
+
+    if not deltas:
+        return
+
+    with transaction.atomic():
+        for company_id in sorted(set(dict(key)['company_id'] for key in deltas)):
+            lock_company_rollups(company_id, shared=True)
+
+        for key, (amount, count) in deltas.items():
+            values = dict(key)
+
+            # Concurrent first saves of a key may each create its row, the sums stay right
+            rollup_id = SpendRollup.objects.filter(**values).order_by('id').values_list('id', flat=True).first()
+            if rollup_id:
+                SpendRollup.objects.filter(id=rollup_id).update(amount=F('amount') + amount, count=F('count') + count)
+            else:
+                SpendRollup.objects.create(amount=amount, count=count, **values)
+
+
+def get_spend_rollup_rows(company_id, days=None):
+
+    for source, model, company_lookup, date_field, filters, keys, amount in get_spend_rollup_sources():
+
+        queryset = model.objects.filter(**{company_lookup: company_id}).filter(**filters)
+        if days is not None:
+            queryset = queryset.filter(**{'%s__date__in' % date_field: list(days)})
+
+        for values, row_amount, row_count in group_spend_facts(source, queryset, company_lookup, date_field, keys, amount):
+            yield SpendRollup(amount=row_amount, count=row_count, **values)
+
+
+def rebuild_spend_rollups(company_id, days=None):
+    """
+    Replaces the company rollups of the given days (all of them without days) with freshly grouped facts.
+    For the backfill and the changes the saves don't see (i.e. queryset.update() of the facts).
+    The exclusive company advisory lock waits for the saves in flight and keeps the new ones out meanwhile.
+    """
+
+    # TruncDate and __date follow the active timezone
+    with timezone.override(ROLLUP_TIMEZONE), transaction.atomic():
+        lock_company_rollups(company_id)
+
+        rollups = SpendRollup.objects.filter(company_id=company_id)
+        if days is not None:
+            rollups = rollups.filter(date__in=list(days))
+        rollups.delete()
+
+        created = SpendRollup.objects.bulk_create(
+            get_spend_rollup_rows(company_id, days=days), batch_size=ROLLUP_BATCH_SIZE
+        )
+
+    return len(created)
+
+
+def rebuild_user_mileage_rollups(user_id):
+    # Mileage rollups follow the user's default currency, called once a currency conversion job is done
+
+    company_id = User.objects.filter(id=user_id).values_list('company_id', flat=True).first()
+    days = set(date.date() for date in Mileage.objects.filter(user_id=user_id).datetimes('date', 'day'))
+
+    if company_id and days:
+        rebuild_spend_rollups(company_id, days=days)
+
+
+def get_quarter_start(day):
+    return datetime.date(day.year, (day.month - 1) // 3 * 3 + 1, 1)
+
+
+def add_months(day, months):
+    month = day.month - 1 + months
+    return datetime.date(day.year + month // 12, month % 12 + 1, 1)
+
+
+def get_analytics_time_range(command, today=None):
+    # UserAPIAnalyticsTime.command -> (start, end) dates, end excluded. (None, None) for all time and unknown commands
+
+    today = today or get_local_date(timezone.now())
+
+    week_start = today - datetime.timedelta(days=today.weekday())
+    month_start = today.replace(day=1)
+    quarter_start = get_quarter_start(today)
+    year_start = datetime.date(today.year, 1, 1)
+    tomorrow = today + datetime.timedelta(days=1)
+
+    ranges = {
+        'current_week': (week_start, tomorrow),
+        'current_month': (month_start, tomorrow),
+        'current_quarter': (quarter_start, tomorrow),
+        'current_year': (year_start, tomorrow),
+        'last_week': (week_start - datetime.timedelta(days=7), week_start),
+        'last_month': (add_months(month_start, -1), month_start),
+        'last_quarter': (add_months(quarter_start, -3), quarter_start),
+        'last_year': (datetime.date(today.year - 1, 1, 1), year_start),
+        'last_7_days': (tomorrow - datetime.timedelta(days=7), tomorrow),
+        'last_30_days': (tomorrow - datetime.timedelta(days=30), tomorrow),
+        'last_90_days': (tomorrow - datetime.timedelta(days=90), tomorrow),
+        'last_12_months': (add_months(month_start, -11), tomorrow),
+        'all_time': (None, None),
+    }
+
+    # Commands stored by older releases are not all known here, they filter nothing
+    return ranges.get(command, (None, None))
+
+
+def summarize_spend(company_id, currency_id, sources, start=None, end=None, user_ids=None, category_ids=None,
+                    expense_field_ids=None, project_ids=None, activity_types=None, group_by=()):
+    """
+    Sums the rollups in the given window, converted to currency_id.
+    Returns a list of dicts: the group_by fields, amount and count. Empty id lists mean no filter.
+    """
+
+    rollups = SpendRollup.objects.filter(company_id=company_id, source__in=sources)
+
+    if start:
+        rollups = rollups.filter(date__gte=start)
+    if end:
+        rollups = rollups.filter(date__lt=end)
+
+    for lookup, values in (('user_id__in', user_ids), ('category_id__in', category_ids),
+                           ('expense_field_id__in', expense_field_ids), ('project_id__in', project_ids),
+                           ('activity_type__in', activity_types)):
+        if values:
+            rollups = rollups.filter(**{lookup: values})
+
+    rows = list(rollups.order_by().values('currency_id', *group_by).annotate(
+        total_amount=Sum('amount'), total_count=Sum('count')
+    ))
+
+    rates = get_currency_rate_table()
+    if any(row['currency_id'] not in rates for row in rows if row['currency_id']):
+        rates = get_currency_rate_table(refresh=True)
+
+    groups = {}
+    for row in rows:
+        key = tuple(row[field] for field in group_by)
+        group = groups.setdefault(key, dict(zip(group_by, key), amount=0.0, count=0))
+
+        # Rows without a currency (i.e. purchases without a quote) are taken as in the target currency
+        rate = rates[row['currency_id']] / rates[currency_id] if row['currency_id'] else 1.0
+
+        group['amount'] += (row['total_amount'] or 0) * rate
+        group['count'] += row['total_count'] or 0
+
+    if not groups and not group_by:
+        groups[()] = {'amount': 0.0, 'count': 0}
+
+    result = []
+    for group in groups.values():
+        group['amount'] = round(group['amount'], 2)
+        result.append(group)
+
+    return result
+
+
+def get_analytics_filters_summary(filters, group_by=(), today=None):
+    # Purchase categories filter the category, travel categories are Activity types
+
+    start, end = get_analytics_time_range(filters.time.command, today=today)
+
+    if filters.type.command not in ANALYTICS_TYPE_SOURCES:
+        raise ValueError('Unknown analytics type: %s' % filters.type.command)
+
+    return summarize_spend(
+        filters.user.company_id,
+        filters.currency_id,
+        ANALYTICS_TYPE_SOURCES[filters.type.command],
+        start=start,
+        end=end,
+        user_ids=json.loads(filters.user_ids or '[]'),
+        category_ids=json.loads(filters.purchase_category_ids or '[]'),
+        expense_field_ids=json.loads(filters.expense_field_ids or '[]'),
+        project_ids=json.loads(filters.project_ids or '[]'),
+        activity_types=json.loads(filters.travel_category_ids or '[]'),
+        group_by=group_by,
+    )
+
+
+def get_time_series_sources():
+    # source -> (model, company lookup, date field, filters, amount expression, currency expression)
+
+    return {
+        'orders': (Order, 'company_id', 'date_created', {'is_deleted': False},
+                   F('estimated_value') * F('quantity'), F('currency_id')),
+        'purchases': (Purchase, 'user__company_id', 'date_created', {'is_deleted': False}, F('sum_paid'), Coalesce(
+            'quote__order__currency_id', 'itinerary_quote__itinerary__currency_id', 'activity_quote__activity__currency_id'
+        )),
+        'expense_claims': (ExpenseClaim, 'user__company_id', 'date', {}, F('value_in_base'), F('currency_id')),
+        'activities': (Activity, 'company_id', 'date_created', {'is_deleted': False}, None, None),
+    }
+
+
+def get_bucket_start(day, period):
+
+    if period == 'week':
+        return day - datetime.timedelta(days=day.weekday())
+    if period == 'month':
+        return day.replace(day=1)
+    return get_quarter_start(day)
+
+
+def get_next_bucket_start(day, period):
+
+    if period == 'week':
+        return day + datetime.timedelta(days=7)
+    return add_months(day, 1 if period == 'month' else 3)
+
+
+def get_time_series(queryset, date_field, period, start, end, amount=None, currency=None, currency_id=None):
+    """
+    Dense series of [start, end) dates bucketed per week (ISO, from Monday), month or quarter in the current timezone.
+    One grouped query, DATE_TRUNC in the database; the empty buckets are filled here.
+    With amount and currency expressions the amounts are converted to currency_id, without currency_id
+    they are kept per currency in 'amounts' ({currency id: amount}) and 'amount' is None.
+    Returns a list of {'date': bucket start, 'count', 'amount'[, 'amounts']}.
+    """
+
+    if period not in TIME_SERIES_PERIODS:
+        raise ValueError('Unknown time series period: %s' % period)
+
+    tz = timezone.get_current_timezone()
+
+    def get_local_midnight(day):
+        return timezone.make_aware(datetime.datetime.combine(day, datetime.time.min), tz, is_dst=False)
+
+    queryset = queryset.filter(**{
+        '%s__gte' % date_field: get_local_midnight(start),
+        '%s__lt' % date_field: get_local_midnight(end),
+    })
+
+    expressions = {'series_bucket': Trunc(date_field, period, tzinfo=tz)}
+    if currency is not None:
+        expressions['series_currency'] = currency
+
+    aggregates = {'series_count': Count('id')}
+    if amount is not None:
+        aggregates['series_amount'] = Sum(amount, output_field=FloatField())
+
+    rows = list(queryset.order_by().values(**expressions).annotate(**aggregates))
+
+    rates = get_currency_rate_table() if currency is not None else {}
+    if any(row['series_currency'] not in rates for row in rows if row.get('series_currency')):
+        rates = get_currency_rate_table(refresh=True)
+
+    per_currency = currency is not None and not currency_id
+
+    buckets = {}
+    for row in rows:
+        # DATE_TRUNC ran on the local time, the local date of the bucket is its label
+        day = get_local_date(row['series_bucket'], tz)
+        bucket = buckets.setdefault(day, [0, 0.0, {}])
+
+        value = row.get('series_amount') or 0
+        if per_currency:
+            bucket[2][row['series_currency']] = bucket[2].get(row['series_currency'], 0.0) + value
+        elif row.get('series_currency'):
+            value = value * rates[row['series_currency']] / rates[currency_id]
+
+        bucket[0] += row['series_count']
+        bucket[1] += value
+
+    series = []
+    day = get_bucket_start(start, period)
+    while day < end:
+        count, value, amounts = buckets.get(day, (0, 0.0, {}))
+
+        if per_currency:
+            series.append({'date': day, 'count': count, 'amount': None,
+                           'amounts': dict((key, round(amount, 2)) for key, amount in amounts.items())})
+        else:
+            series.append({'date': day, 'count': count, 'amount': round(value, 2)})
+
+        day = get_next_bucket_start(day, period)
+
+    return series
+
+
+def get_company_time_series(company_id, source, period, start, end, currency_id=None):
+    # source: orders, purchases, expense_claims or activities (counts only). Without currency_id amounts stay per currency
+
+    model, company_lookup, date_field, filters, amount, currency = get_time_series_sources()[source]
+    queryset = model.objects.filter(**{company_lookup: company_id}).filter(**filters)
+
+    return get_time_series(
+        queryset, date_field, period, start, end, amount=amount, currency=currency, currency_id=currency_id
+    )
@@ -0,0 +1,114 @@
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.contrib.postgres.fields import JSONField
+from django.db.models import Case, When, Value, Max
+from django.db.models.functions import Cast
+
+from vitesse_prod.apps.db.models import Order, OrderLine, ProductAttributeValue, get_attribute_schema, \
+    normalize_attribute_value
+
+
+PROJECTION_CHUNK_SIZE = 1000
+
+# model -> ProductAttributeValue owner field
+PROJECTION_OWNER_FIELDS = (
+    (Order, 'order_id'),
+    (OrderLine, 'order_line_id'),
+)
+
+_deferred = threading.local()
+
+
+def get_owner_field(model):
+    return dict(PROJECTION_OWNER_FIELDS)[model]
+
+
+def build_attribute_projections(model, owner_ids):
+    # {owner id: {attribute slug: sorted case-folded values}}, one query
+
+    owner_field = get_owner_field(model)
+    owner_ids = set(owner_ids)
+
+    schema = get_attribute_schema()
+    projections = dict((owner_id, {}) for owner_id in owner_ids)
+
+    rows = ProductAttributeValue.objects.filter(**{owner_field + '__in': owner_ids}).values_list(
+        owner_field, 'product_attribute_id', 'value'
+    )
+    for owner_id, attribute_id, value in rows:
+        # Attribute created by another process after the schema was compiled
+        if attribute_id not in schema['by_id']:
+            schema = get_attribute_schema(refresh=True)
+
+        value = normalize_attribute_value(value)
+        if value:
+            projections[owner_id].setdefault(schema['by_id'][attribute_id]['slug'], set()).add(value)
+
+    return dict(
+        (owner_id, dict((slug, sorted(values)) for slug, values in projection.items()))
+        for owner_id, projection in projections.items()
+    )
+
+
+def refresh_attribute_projections(model, owner_ids, chunk_size=PROJECTION_CHUNK_SIZE):
+    # Rewrites attribute_values of the orders / order lines from their ProductAttributeValues, one UPDATE per chunk
+
+    owner_ids = sorted(set(owner_id for owner_id in owner_ids if owner_id))
+
+    deferred = getattr(_deferred, 'owner_ids', None)
+    if deferred is not None:
+        deferred[model].update(owner_ids)
+        return
+
+    for start in range(0, len(owner_ids), chunk_size):
+        projections = build_attribute_projections(model, owner_ids[start:start + chunk_size])
+
+        # The json literals are text to Postgres, cast back for the jsonb column
+        model.objects.filter(id__in=list(projections)).update(attribute_values=Cast(
+            Case(*[When(id=owner_id, then=Value(projection, output_field=JSONField()))
+                   for owner_id, projection in projections.items()], output_field=JSONField()),
+            JSONField()
+        ))
+
+
+@contextmanager
+def defer_attribute_projections():
+    # The refreshes requested inside, i.e. by the signals of a bulk delete, run once per model on exit
+
+    if getattr(_deferred, 'owner_ids', None) is not None:
+        yield
+        return
+
+    owner_ids = _deferred.owner_ids = defaultdict(set)
+    try:
+        yield
+    finally:
+        _deferred.owner_ids = None
+
+    for model, ids in owner_ids.items():
+        refresh_attribute_projections(model, ids)
+
+
+def backfill_attribute_projections(models=None, chunk_size=PROJECTION_CHUNK_SIZE, log=None):
+    # Every order and order line by id range, returns {model name: rows}
+
+    stats = {}
+
+    for model, owner_field in PROJECTION_OWNER_FIELDS:
+        if models and model not in models:
+            continue
+
+        max_id = model.objects.aggregate(max_id=Max('id'))['max_id'] or 0
+        stats[model.__name__] = 0
+
+        for start in range(1, max_id + 1, chunk_size):
+            owner_ids = list(model.objects.filter(id__gte=start, id__lt=start + chunk_size).values_list('id', flat=True))
+            refresh_attribute_projections(model, owner_ids, chunk_size=chunk_size)
+
+            stats[model.__name__] += len(owner_ids)
+            if log:
+                log('%s: %i' % (model.__name__, stats[model.__name__]))
+
+    return stats
@@ -0,0 +1,122 @@
+import heapq
+import time
+from bisect import bisect_left
+
+from django.db import connection
+from django.db.models import Count, Min
+from django.db.models.functions import Lower
+
+from vitesse_prod.apps.db.models import ProductAttributeValue, normalize_attribute_value
+
+
+# Process-level, dropped by the ProductAttributeValue signals in this process, reloaded by the other
+# processes once VOCABULARY_TTL seconds old
+VOCABULARY_TTL = 5 * 60
+
+AUTOCOMPLETE_LIMIT = 10
+
+# The top values of the empty prefix and of the prefixes up to SHORT_PREFIX_LENGTH characters are ranked
+# once per load, their ranges are most of the vocabulary
+TOP_VALUES_SIZE = 50
+SHORT_PREFIX_LENGTH = 2
+
+# Serves the per attribute GROUP BY lower(value) of the vocabulary loads and lower(value) LIKE 'prefix%'
+ATTRIBUTE_VOCABULARY_INDEXES_SQL = (
+    'CREATE INDEX IF NOT EXISTS %(table)s_attribute_value_lower '
+    'ON %(table)s (product_attribute_id, lower(value) text_pattern_ops)',
+)
+
+_vocabularies = {}
+
+
+class AttributeVocabulary(object):
+    """
+    The distinct case-folded values of an attribute, sorted, with the number of rows using each.
+    A prefix is a contiguous range of the sorted keys, found by bisection. Short prefixes are served
+    from the rankings computed on load.
+    """
+
+    def __init__(self, rows):
+        # rows: (value_lower, value, count)
+
+        rows = sorted(rows)
+
+        self.keys = [row[0] for row in rows]
+        self.values = [row[1] for row in rows]
+        self.counts = [row[2] for row in rows]
+        self.loaded_at = time.time()
+
+        # {prefix: positions, most used first}, up to TOP_VALUES_SIZE
+        self.top = {}
+        for position in sorted(range(len(self.keys)), key=lambda position: (-self.counts[position], position)):
+            for prefix in set(self.keys[position][:length] for length in range(SHORT_PREFIX_LENGTH + 1)):
+                positions = self.top.setdefault(prefix, [])
+                if len(positions) < TOP_VALUES_SIZE:
+                    positions.append(position)
+
+    @classmethod
+    def load(cls, attribute_id):
+
+        rows = ProductAttributeValue.objects.filter(product_attribute_id=attribute_id).exclude(value='').annotate(
+            value_lower=Lower('value')
+        ).order_by().values('value_lower').annotate(display_value=Min('value'), count=Count('id')).values_list(
+            'value_lower', 'display_value', 'count'
+        )
+
+        return cls(rows)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get_range(self, prefix):
+
+        if not prefix:
+            return 0, len(self.keys)
+
+        # Every key starting with prefix sorts before prefix with its last character incremented
+        end_key = prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
+        return bisect_left(self.keys, prefix), bisect_left(self.keys, end_key)
+
+    def complete(self, prefix, limit=AUTOCOMPLETE_LIMIT):
+        # Most used values first, alphabetically on ties
+
+        prefix = normalize_attribute_value(prefix)
+
+        if len(prefix) <= SHORT_PREFIX_LENGTH and limit <= TOP_VALUES_SIZE:
+            positions = self.top.get(prefix, [])[:limit]
+        else:
+            start, end = self.get_range(prefix)
+            positions = heapq.nlargest(limit, xrange(start, end), key=lambda position: (self.counts[position], -position))
+
+        return [{'value': self.values[position], 'count': self.counts[position]} for position in positions]
+
+
+def get_attribute_vocabulary(attribute_id, refresh=False):
+
+    vocabulary = _vocabularies.get(attribute_id)
+
+    if refresh or vocabulary is None or time.time() - vocabulary.loaded_at > VOCABULARY_TTL:
+        vocabulary = _vocabularies[attribute_id] = AttributeVocabulary.load(attribute_id)
+
+    return vocabulary
+
+
+def invalidate_attribute_vocabulary(attribute_id):
+    _vocabularies.pop(attribute_id, None)
+
+
+def autocomplete_attribute_values(attribute_id, prefix, limit=AUTOCOMPLETE_LIMIT):
+    """
+    Top limit values of the attribute starting with prefix (case-insensitive): [{'value', 'count'}].
+    Served from memory once the vocabulary is loaded, only the matches leave the server.
+    """
+
+    return get_attribute_vocabulary(attribute_id).complete(prefix, limit)
+
+
+def create_attribute_vocabulary_indexes():
+
+    with connection.cursor() as cursor:
+        for sql in ATTRIBUTE_VOCABULARY_INDEXES_SQL:
+            cursor.execute(sql % {'table': ProductAttributeValue._meta.db_table})
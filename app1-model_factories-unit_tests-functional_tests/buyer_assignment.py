@@ -0,0 +1,299 @@
+import datetime
+import threading
+import time
+from collections import defaultdict
+
+import pytz
+from django.db import transaction
+from django.db.models import Count
+
+from vitesse_prod.apps.db.models import User, Order
+
+
+# Other processes see membership changes once their index is BUYER_INDEX_TTL seconds old
+BUYER_INDEX_TTL = 60
+
+# (dimension, User m2m field, through table column). A buyer without any row in a dimension takes any value
+BUYER_DIMENSIONS = (
+    ('region', 'buyer_regions', 'region_id'),
+    ('company', 'buyer_companies', 'company_id'),
+    ('category', 'buyer_categories', 'category_id'),
+    ('subcategory', 'buyer_subcategories', 'subcategory_id'),
+)
+
+# Orders counted in a buyer's load
+OPEN_ORDER_STATUSES = (Order.STATUS_ASSIGNED, Order.STATUS_RECEIVED, Order.STATUS_SOURCING)
+
+# Order values of the dimensions, in BUYER_DIMENSIONS order
+ORDER_KEY_FIELDS = ('app_user__default_region_id', 'company_id', 'category_id', 'subcategory_id')
+
+ASSIGNMENT_CHUNK_SIZE = 1000
+
+_buyer_index = {'index': None}
+_index_lock = threading.RLock()
+
+
+class BuyerIndex(object):
+    """
+    Buyer memberships as bitsets: one bit per buyer, one mask per (dimension, value) plus the mask of
+    the buyers taking any value of the dimension. The candidates of an order key are the AND of four
+    masks, cached per key, and the buyer with the fewest open orders among them is picked.
+    """
+
+    def __init__(self):
+
+        self.bits = {}
+        self.buyer_ids = []
+        self.memberships = {}
+        self.loads = defaultdict(int)
+        self.candidates = {}
+        self.loaded_at = time.time()
+
+        self.masks = dict((dimension, {}) for dimension, field, column in BUYER_DIMENSIONS)
+        self.any_masks = dict((dimension, 0) for dimension, field, column in BUYER_DIMENSIONS)
+
+    @classmethod
+    def load(cls):
+
+        index = cls()
+
+        buyer_ids = list(User.objects.filter(role=User.BUYER, is_active=True).order_by('id').values_list('id', flat=True))
+        memberships = dict((buyer_id, dict((dimension, set()) for dimension, field, column in BUYER_DIMENSIONS))
+                           for buyer_id in buyer_ids)
+
+        for dimension, field, column in BUYER_DIMENSIONS:
+            rows = getattr(User, field).through.objects.filter(
+                user__role=User.BUYER, user__is_active=True
+            ).values_list('user_id', column)
+
+            for buyer_id, value in rows:
+                if buyer_id in memberships:
+                    memberships[buyer_id][dimension].add(value)
+
+        for buyer_id in buyer_ids:
+            index.set_buyer(buyer_id, memberships[buyer_id])
+
+        index.loads.update(
+            Order.objects.filter(buyer_id__in=buyer_ids, status__in=OPEN_ORDER_STATUSES).order_by().values_list(
+                'buyer_id').annotate(count=Count('id'))
+        )
+
+        return index
+
+    def get_bit(self, buyer_id):
+
+        if buyer_id not in self.bits:
+            self.bits[buyer_id] = 1 << len(self.buyer_ids)
+            self.buyer_ids.append(buyer_id)
+
+        return self.bits[buyer_id]
+
+    def set_buyer(self, buyer_id, memberships):
+        # memberships: {dimension: set of ids}, None removes the buyer
+
+        self.remove_buyer(buyer_id)
+        if memberships is None:
+            return
+
+        self.candidates = {}
+
+        bit = self.get_bit(buyer_id)
+        self.memberships[buyer_id] = memberships
+
+        for dimension, field, column in BUYER_DIMENSIONS:
+            if not memberships[dimension]:
+                self.any_masks[dimension] |= bit
+
+            for value in memberships[dimension]:
+                self.masks[dimension][value] = self.masks[dimension].get(value, 0) | bit
+
+    def remove_buyer(self, buyer_id):
+
+        if buyer_id not in self.memberships:
+            return
+
+        # The bit stays reserved, it's cleared from every mask
+        bit = self.bits[buyer_id]
+        memberships = self.memberships.pop(buyer_id)
+
+        for dimension, field, column in BUYER_DIMENSIONS:
+            self.any_masks[dimension] &= ~bit
+
+            for value in memberships[dimension]:
+                self.masks[dimension][value] &= ~bit
+
+        self.candidates = {}
+
+    def get_candidates(self, key):
+        # Buyer ids matching the order key (region_id, company_id, category_id, subcategory_id)
+
+        if key not in self.candidates:
+            mask = -1
+            for (dimension, field, column), value in zip(BUYER_DIMENSIONS, key):
+                # An order without a value in a dimension doesn't restrict it
+                if value is not None:
+                    mask &= self.masks[dimension].get(value, 0) | self.any_masks[dimension]
+
+            self.candidates[key] = [buyer_id for buyer_id in self.memberships if mask & self.bits[buyer_id]]
+
+        return self.candidates[key]
+
+    def pick_buyer(self, key):
+        # The least loaded candidate, lowest id on ties
+
+        candidates = self.get_candidates(key)
+        if not candidates:
+            return None
+
+        return min(candidates, key=lambda candidate_id: (self.loads[candidate_id], candidate_id))
+
+
+def get_buyer_index(refresh=False):
+
+    with _index_lock:
+        index = _buyer_index['index']
+
+        if refresh or index is None or time.time() - index.loaded_at > BUYER_INDEX_TTL:
+            index = _buyer_index['index'] = BuyerIndex.load()
+
+        return index
+
+
+def invalidate_buyer_index():
+    _buyer_index['index'] = None
+
+
+def reload_buyers(buyer_ids):
+    # Memberships of these users, re-read from the database, replace theirs in the loaded index
+
+    index = _buyer_index['index']
+    if index is None:
+        return
+
+    buyer_ids = set(buyer_ids)
+    memberships = dict(
+        (buyer_id, dict((dimension, set()) for dimension, field, column in BUYER_DIMENSIONS))
+        for buyer_id in User.objects.filter(id__in=buyer_ids, role=User.BUYER, is_active=True).values_list('id', flat=True)
+    )
+
+    for dimension, field, column in BUYER_DIMENSIONS:
+        for buyer_id, value in getattr(User, field).through.objects.filter(
+                user_id__in=list(memberships)).values_list('user_id', column):
+            memberships[buyer_id][dimension].add(value)
+
+    with _index_lock:
+        for buyer_id in buyer_ids:
+            index.set_buyer(buyer_id, memberships.get(buyer_id))
+
+
+def schedule_buyers_reload(buyer_ids):
+    # After the commit, a rolled back change leaves the index as it was
+
+    buyer_ids = set(buyer_ids)
+    if buyer_ids and _buyer_index['index'] is not None:
+        transaction.on_commit(lambda: reload_buyers(buyer_ids))
+
+
+def update_buyer_load(buyer_id, change):
+
+    index = _buyer_index['index']
+    if index is not None and buyer_id in index.memberships:
+        with _index_lock:
+            index.loads[buyer_id] = max(index.loads[buyer_id] + change, 0)
+
+
+def schedule_order_load_update(order, created):
+    # Called from the Order post_save: the order moved in or out of a buyer's open orders
+
+    if _buyer_index['index'] is None:
+        return
+
+    original_values = {} if created else order.get_original_values()
+
+    original_buyer_id = original_values.get('buyer_id') if original_values.get('status') in OPEN_ORDER_STATUSES else None
+    buyer_id = order.buyer_id if order.status in OPEN_ORDER_STATUSES else None
+
+    if original_buyer_id == buyer_id:
+        return
+
+    def update_loads():
+        update_buyer_load(original_buyer_id, -1)
+        update_buyer_load(buyer_id, 1)
+
+    transaction.on_commit(update_loads)
+
+
+def get_order_key(order):
+    return (order.app_user.default_region_id, order.company_id, order.category_id, order.subcategory_id)
+
+
+def assign_buyer(order, now=None):
+    # Assigns the picked buyer to a new order, returns the buyer id or None when no buyer matches.
+    # The buyer's load is counted by the Order post_save
+
+    with _index_lock:
+        buyer_id = get_buyer_index().pick_buyer(get_order_key(order))
+
+    if buyer_id is None:
+        return None
+
+    now = now or datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+
+    order.buyer_id = buyer_id
+    order.status = Order.STATUS_ASSIGNED
+    order.date_assigned_to_buyer = now
+    order.save(update_fields=['buyer', 'status', 'date_assigned_to_buyer', 'date_status_changed', 'date_edited'])
+
+    return buyer_id
+
+
+def assign_buyers(orders=None, now=None):
+    """
+    Assigns buyers to a backlog of orders, new and unassigned ones by default: one query for the orders,
+    the picks in memory and two queries per buyer and chunk. Returns {order id: buyer id} of the assigned orders,
+    an order assigned or moved on by another process meanwhile is left out.
+    The UPDATE skips the Order signals: the loads are counted here, date_edited is set for the incremental
+    savings and the spend rollups and supplier routes don't depend on the buyer or the status.
+    """
+
+    if orders is None:
+        orders = Order.objects.filter(status=Order.STATUS_NEW, buyer__isnull=True)
+
+    now = now or datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+    rows = orders.order_by('date_created', 'id').values_list('id', *ORDER_KEY_FIELDS)
+
+    # The picks count in the loads right away so the next picks are balanced, the lost ones are given back below
+    picks = {}
+    with _index_lock:
+        index = get_buyer_index()
+        for row in rows:
+            buyer_id = index.pick_buyer(row[1:])
+            if buyer_id is not None:
+                picks[row[0]] = buyer_id
+                index.loads[buyer_id] += 1
+
+    order_ids_by_buyer = defaultdict(list)
+    for order_id, buyer_id in picks.items():
+        order_ids_by_buyer[buyer_id].append(order_id)
+
+    assignments = {}
+    with transaction.atomic():
+        for buyer_id, order_ids in order_ids_by_buyer.items():
+            for start in range(0, len(order_ids), ASSIGNMENT_CHUNK_SIZE):
+                # Locked until the commit, the UPDATE writes exactly these rows
+                assigned_ids = list(Order.objects.select_for_update().filter(
+                    id__in=order_ids[start:start + ASSIGNMENT_CHUNK_SIZE], buyer__isnull=True, status=Order.STATUS_NEW
+                ).values_list('id', flat=True))
+
+                Order.objects.filter(id__in=assigned_ids).update(
+                    buyer_id=buyer_id, status=Order.STATUS_ASSIGNED, date_assigned_to_buyer=now,
+                    date_status_changed=now, date_edited=now
+                )
+                assignments.update((order_id, buyer_id) for order_id in assigned_ids)
+
+    with _index_lock:
+        for order_id, buyer_id in picks.items():
+            if order_id not in assignments:
+                index.loads[buyer_id] = max(index.loads[buyer_id] - 1, 0)
+
+    return assignments
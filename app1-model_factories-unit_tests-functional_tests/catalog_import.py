@@ -0,0 +1,288 @@
+import csv
+import os
+import time
+
+from django.db import transaction
+from django.db.models import Case, When, Value, IntegerField, ForeignKey
+
+from vitesse_prod.apps.db.catalog_search import update_catalog_search_vectors
+from vitesse_prod.apps.db.models import CatalogItem, Category, Currency, Measurement, \
+    invalidate_catalog_users_visibility
+
+
+CATALOG_IMPORT_CHUNK_SIZE = 1000
+
+# Compared on delta re-imports, (supplier_name, title) is the item key
+CATALOG_ITEM_FIELDS = (
+    'supplier_name', 'title', 'short_description', 'long_description', 'manufacturer', 'brand', 'image_url',
+    'price', 'tax_amount', 'days_to_deliver', 'currency', 'measurement',
+    'category', 'category_level_2', 'category_level_3', 'category_level_4', 'vendor', 'synonym', 'is_active',
+)
+
+CATALOG_TEXT_COLUMNS = (
+    'supplier_name', 'title', 'short_description', 'long_description', 'manufacturer', 'brand', 'image_url',
+    'vendor', 'synonym',
+)
+
+# column -> (type, default when empty; None: required)
+CATALOG_NUMBER_COLUMNS = {
+    'price': (float, None),
+    'tax_amount': (float, 0.0),
+    'days_to_deliver': (int, 3),
+}
+
+CATALOG_CATEGORY_COLUMNS = ('category', 'category_level_2', 'category_level_3', 'category_level_4')
+
+MAX_REPORTED_ERRORS = 100
+
+
+def normalize_column(name):
+    return (name or '').strip().lower().replace(' ', '_')
+
+
+def read_csv_rows(catalog_file):
+
+    reader = csv.reader(catalog_file)
+    header = [normalize_column(name.decode('utf-8-sig')) for name in next(reader)]
+
+    for row in reader:
+        yield dict(zip(header, [value.decode('utf-8') for value in row]))
+
+
+def read_xlsx_rows(catalog_file):
+
+    import openpyxl
+
+    # read_only streams the sheet instead of loading the whole workbook
+    workbook = openpyxl.load_workbook(catalog_file, read_only=True, data_only=True)
+    rows = workbook.active.iter_rows()
+
+    header = [normalize_column(unicode(cell.value or '')) for cell in next(rows)]
+
+    for row in rows:
+        yield dict(zip(header, [cell.value for cell in row]))
+
+
+def read_catalog_rows(catalog_file, file_name):
+
+    if os.path.splitext(file_name)[1].lower() in ('.xlsx', '.xlsm'):
+        return read_xlsx_rows(catalog_file)
+
+    return read_csv_rows(catalog_file)
+
+
+class NameLookup(object):
+    # In-memory get-or-create of rows by case insensitive name, loaded with one query on first use
+
+    def __init__(self, model, queryset=None, create=True):
+        self.model = model
+        self.queryset = queryset if queryset is not None else model.objects.all()
+        self.create = create
+        self.ids = None
+
+    def get_id(self, name):
+
+        name = (name or '').strip()
+        if not name:
+            return None
+
+        if self.ids is None:
+            self.ids = {}
+            for object_id, object_name in self.queryset.order_by('id').values_list('id', 'name'):
+                self.ids.setdefault(object_name.strip().lower(), object_id)
+
+        key = name.lower()
+        if key not in self.ids:
+            if not self.create:
+                raise ValueError('Unknown %s: %s' % (self.model._meta.verbose_name, name))
+            self.ids[key] = self.model.objects.create(name=name).id
+
+        return self.ids[key]
+
+
+def build_catalog_item_values(row, lookups):
+    # {field attname: value} of a file row, ValueError when the row can't be imported
+
+    values = {'is_active': True}
+
+    for column in CATALOG_TEXT_COLUMNS:
+        value = row.get(column)
+        values[column] = ('%s' % value).strip() if value is not None else ''
+
+    if not values['supplier_name'] or not values['title']:
+        raise ValueError('supplier_name and title are required')
+
+    for column, (number_type, default) in CATALOG_NUMBER_COLUMNS.items():
+        value = row.get(column)
+
+        if value is None or ('%s' % value).strip() == '':
+            if default is None:
+                raise ValueError('%s is required' % column)
+            value = default
+
+        try:
+            values[column] = number_type(float(value))
+        except (TypeError, ValueError):
+            raise ValueError('Invalid %s: %s' % (column, value))
+
+    values['currency_id'] = lookups['currency'].get_id(row.get('currency'))
+    values['measurement_id'] = lookups['measurement'].get_id(row.get('measurement'))
+
+    for column in CATALOG_CATEGORY_COLUMNS:
+        values['%s_id' % column] = lookups['category'].get_id(row.get(column))
+
+    for column in ('currency', 'measurement', 'category'):
+        if values['%s_id' % column] is None:
+            raise ValueError('%s is required' % column)
+
+    return values
+
+
+def get_catalog_item_fields():
+    return [CatalogItem._meta.get_field(name) for name in CATALOG_ITEM_FIELDS]
+
+
+def create_catalog_items(catalog, items):
+
+    with transaction.atomic():
+        created = CatalogItem.objects.bulk_create(
+            [CatalogItem(catalog=catalog, **values) for values in items], batch_size=CATALOG_IMPORT_CHUNK_SIZE
+        )
+        update_catalog_search_vectors([item.id for item in created])
+
+
+def update_catalog_items(items):
+    # items: list of (id, values), one CASE UPDATE for the whole chunk
+
+    if not items:
+        return
+
+    updates = {}
+    for field in get_catalog_item_fields():
+        output_field = IntegerField() if isinstance(field, ForeignKey) else field.__class__()
+        updates[field.attname] = Case(
+            *[When(id=item_id, then=Value(values[field.attname])) for item_id, values in items],
+            output_field=output_field
+        )
+
+    with transaction.atomic():
+        CatalogItem.objects.filter(id__in=[item_id for item_id, values in items]).update(**updates)
+        update_catalog_search_vectors([item_id for item_id, values in items])
+
+
+def load_catalog_rows(catalog, catalog_file, file_name, existing, chunk_size, log):
+    # Creates and updates the items of the file rows chunk by chunk, returns the report and the item keys of the file
+
+    attnames = [field.attname for field in get_catalog_item_fields()]
+
+    lookups = {
+        'currency': NameLookup(Currency, Currency.objects.filter(is_deleted=False), create=False),
+        'measurement': NameLookup(Measurement, Measurement.objects.filter(is_deleted=False)),
+        'category': NameLookup(Category, Category.objects.filter(is_deleted=False)),
+    }
+
+    report = {'rows': 0, 'created': 0, 'updated': 0, 'unchanged': 0, 'deactivated': 0, 'errors': [], 'errors_count': 0}
+    seen_keys = set()
+    to_create = []
+    to_update = []
+
+    def flush():
+
+        create_catalog_items(catalog, to_create)
+        update_catalog_items(to_update)
+
+        report['created'] += len(to_create)
+        report['updated'] += len(to_update)
+        del to_create[:]
+        del to_update[:]
+
+        if log:
+            log('%(rows)i rows, %(created)i created, %(updated)i updated' % report)
+
+    # Line 1 is the header
+    for line_number, row in enumerate(read_catalog_rows(catalog_file, file_name), 2):
+        report['rows'] += 1
+
+        try:
+            values = build_catalog_item_values(row, lookups)
+
+            key = (values['supplier_name'], values['title'])
+            if key in seen_keys:
+                raise ValueError('Duplicate item %s / %s' % key)
+            seen_keys.add(key)
+
+        except ValueError as e:
+            report['errors_count'] += 1
+            if len(report['errors']) < MAX_REPORTED_ERRORS:
+                report['errors'].append('Line %i: %s' % (line_number, e))
+            continue
+
+        if key not in existing:
+            to_create.append(values)
+        elif existing[key][1] != tuple(values[attname] for attname in attnames):
+            to_update.append((existing[key][0], values))
+        else:
+            report['unchanged'] += 1
+
+        if len(to_create) + len(to_update) >= chunk_size:
+            flush()
+
+    flush()
+
+    return report, seen_keys
+
+
+def import_catalog(catalog, catalog_file=None, file_name=None, delta=True, deactivate_missing=True,
+                   chunk_size=CATALOG_IMPORT_CHUNK_SIZE, log=None):
+    """
+    Streams the catalog file (CSV or XLSX) into CatalogItems, chunk by chunk.
+    delta: items are matched by (supplier_name, title), only the new and changed ones are written and,
+    with deactivate_missing, the ones missing from the file are deactivated. Without delta the catalog
+    items are replaced in one transaction. Returns the import report.
+    """
+
+    started_at = time.time()
+
+    opened_file = catalog_file is None
+    if opened_file:
+        catalog.file.open('rb')
+        catalog_file = catalog.file
+        file_name = catalog.file.name
+
+    try:
+        if delta:
+            attnames = [field.attname for field in get_catalog_item_fields()]
+
+            existing = {}
+            items = CatalogItem.objects.filter(catalog=catalog).values_list('id', *attnames).iterator()
+            for item in items:
+                values = dict(zip(attnames, item[1:]))
+                existing[(values['supplier_name'], values['title'])] = (item[0], tuple(item[1:]))
+
+            report, seen_keys = load_catalog_rows(catalog, catalog_file, file_name, existing, chunk_size, log)
+
+            if deactivate_missing:
+                active_index = attnames.index('is_active')
+                missing_ids = [item_id for key, (item_id, values) in existing.items()
+                               if key not in seen_keys and values[active_index]]
+
+                for start in range(0, len(missing_ids), chunk_size):
+                    CatalogItem.objects.filter(id__in=missing_ids[start:start + chunk_size]).update(is_active=False)
+                report['deactivated'] = len(missing_ids)
+
+        else:
+            # The users never see the catalog empty or half loaded, a failed load keeps the previous items
+            with transaction.atomic():
+                CatalogItem.objects.filter(catalog=catalog).delete()
+                report, seen_keys = load_catalog_rows(catalog, catalog_file, file_name, {}, chunk_size, log)
+
+    finally:
+        if opened_file:
+            catalog.file.close()
+
+    invalidate_catalog_users_visibility([catalog.id])
+
+    report['seconds'] = round(time.time() - started_at, 2)
+    report['rows_per_second'] = int(report['rows'] / report['seconds']) if report['seconds'] else report['rows']
+
+    return report
@@ -0,0 +1,108 @@
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector, TrigramSimilarity
+from django.db import connection
+from django.db.models import F, Count, Max, Min
+
+from vitesse_prod.apps.db.models import CatalogItem
+
+
+CATALOG_SEARCH_CONFIG = getattr(settings, 'CATALOG_SEARCH_CONFIG', 'english')
+
+SEARCH_VECTOR_CHUNK_SIZE = 5000
+
+# Full text goes through the GIN index on search_vector, the typo tolerant fallback through this one (% operator)
+CATALOG_SEARCH_INDEXES_SQL = (
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX IF NOT EXISTS %(table)s_title_trgm ON %(table)s USING gin (title gin_trgm_ops)',
+)
+
+
+def get_catalog_search_vector():
+
+    return (
+        SearchVector('title', weight='A', config=CATALOG_SEARCH_CONFIG) +
+        SearchVector('brand', 'manufacturer', 'synonym', weight='B', config=CATALOG_SEARCH_CONFIG) +
+        SearchVector('short_description', 'vendor', weight='C', config=CATALOG_SEARCH_CONFIG) +
+        SearchVector('long_description', weight='D', config=CATALOG_SEARCH_CONFIG)
+    )
+
+
+def update_catalog_search_vectors(ids=None, chunk_size=SEARCH_VECTOR_CHUNK_SIZE):
+    # Computed by the database in UPDATEs of chunk_size rows. All items without ids
+
+    ids = list(ids) if ids is not None else None
+    items = CatalogItem.objects.all()
+
+    if ids is not None:
+        for start in range(0, len(ids), chunk_size):
+            items.filter(id__in=ids[start:start + chunk_size]).update(search_vector=get_catalog_search_vector())
+        return
+
+    bounds = items.aggregate(min_id=Min('id'), max_id=Max('id'))
+    if bounds['min_id'] is None:
+        return
+
+    for start in range(bounds['min_id'], bounds['max_id'] + 1, chunk_size):
+        items.filter(id__gte=start, id__lt=start + chunk_size).update(search_vector=get_catalog_search_vector())
+
+
+def create_catalog_search_indexes():
+
+    with connection.cursor() as cursor:
+        for sql in CATALOG_SEARCH_INDEXES_SQL:
+            cursor.execute(sql % {'table': CatalogItem._meta.db_table})
+
+
+def search_catalog_items(user, query, category_id=None, limit=20, offset=0, facets_limit=20):
+    """
+    Ranked search over the active items of the user's catalogs. Full text first (weights: title,
+    brand/manufacturer/synonym, short description/vendor, long description); when nothing matches,
+    trigram similarity of the title, so misspelled queries still find items.
+    Facets are the category counts of the whole match, before the category_id filter.
+    """
+
+    query = (query or '').strip()
+
+    items = CatalogItem.objects.filter(catalog_id__in=user.get_visible_catalog_ids(), is_active=True)
+
+    is_fuzzy = False
+    if query:
+        search_query = SearchQuery(query, config=CATALOG_SEARCH_CONFIG)
+        matches = items.filter(search_vector=search_query)
+        facets = get_category_facets(matches)
+
+        if facets:
+            matches = matches.annotate(rank=SearchRank(F('search_vector'), search_query))
+        else:
+            is_fuzzy = True
+            matches = items.filter(title__trigram_similar=query)
+            facets = get_category_facets(matches)
+            matches = matches.annotate(rank=TrigramSimilarity('title', query))
+
+        ordering = ('-rank', 'id')
+    else:
+        matches = items
+        facets = get_category_facets(matches)
+        ordering = ('title', 'id')
+
+    if category_id:
+        matches = matches.filter(category_id=category_id)
+        total = sum(facet['count'] for facet in facets if facet['id'] == category_id)
+    else:
+        total = sum(facet['count'] for facet in facets)
+
+    results = matches.select_related('currency', 'measurement', 'category').order_by(*ordering)[offset:offset + limit]
+
+    return {
+        'items': list(results),
+        'total': total,
+        'is_fuzzy': is_fuzzy,
+        'facets': facets[:facets_limit],
+    }
+
+
+def get_category_facets(matches):
+
+    rows = matches.order_by().values('category_id', 'category__name').annotate(count=Count('id')).order_by('-count')
+
+    return [{'id': row['category_id'], 'name': row['category__name'], 'count': row['count']} for row in rows]
@@ -0,0 +1,145 @@
+import datetime
+import logging
+import threading
+
+import pytz
+from django.db import connection, transaction
+from django.db.models import F, Count, Max
+
+from vitesse_prod.apps.db.analytics import rebuild_user_mileage_rollups
+from vitesse_prod.apps.db.models import CurrencyConversionJob, ExpenseClaim, Mileage, get_currency_rate_table
+
+
+logger = logging.getLogger(__name__)
+
+CONVERSION_CHUNK_SIZE = 1000
+
+# (model, converted field, job progress prefix)
+CONVERSION_STEPS = (
+    (ExpenseClaim, 'value', 'expense_claim'),
+    (Mileage, 'cost_per_mile', 'mileage'),
+)
+
+
+def schedule_currency_conversion(user, old_currency_id, new_currency_id):
+    # Called from User post_save. Creates the job with the rate snapshot and runs it once the job and
+    # the currency change are committed, together when the save runs in a transaction
+
+    rates = get_currency_rate_table(refresh=True)
+
+    job = CurrencyConversionJob(
+        user=user,
+        old_currency_id=old_currency_id,
+        new_currency_id=new_currency_id,
+        rate=rates[old_currency_id] / rates[new_currency_id]
+    )
+
+    with transaction.atomic():
+        for model, field, prefix in CONVERSION_STEPS:
+            stats = model.objects.filter(user=user).aggregate(total=Count('id'), max_id=Max('id'))
+            setattr(job, 'max_%s_id' % prefix, stats['max_id'] or 0)
+            setattr(job, '%ss_total' % prefix, stats['total'])
+
+        job.save()
+
+        transaction.on_commit(lambda: start_currency_conversion(user.id))
+
+    return job
+
+
+def start_currency_conversion(user_id):
+
+    thread = threading.Thread(target=run_currency_conversion_jobs, kwargs={'user_id': user_id, 'close_connection': True})
+    thread.daemon = True
+    thread.start()
+
+    return thread
+
+
+def run_currency_conversion_jobs(user_id=None, chunk_size=CONVERSION_CHUNK_SIZE, close_connection=False):
+    # Pending and interrupted jobs, oldest first. A user's jobs must be applied in order, so a failed job blocks the later ones
+
+    try:
+        jobs = CurrencyConversionJob.objects.filter(
+            status__in=[CurrencyConversionJob.STATUS_PENDING, CurrencyConversionJob.STATUS_RUNNING]
+        ).order_by('id')
+        if user_id:
+            jobs = jobs.filter(user_id=user_id)
+
+        blocked_user_ids = set(CurrencyConversionJob.objects.filter(
+            status=CurrencyConversionJob.STATUS_FAILED).values_list('user_id', flat=True))
+
+        processed = []
+        for job_id, job_user_id in jobs.values_list('id', 'user_id'):
+
+            if job_user_id in blocked_user_ids:
+                continue
+
+            job = process_currency_conversion_job(job_id, chunk_size=chunk_size)
+            if job.status == CurrencyConversionJob.STATUS_FAILED:
+                blocked_user_ids.add(job_user_id)
+
+            processed.append(job)
+
+        return processed
+
+    finally:
+        if close_connection:
+            connection.close()
+
+
+def process_currency_conversion_job(job_id, chunk_size=CONVERSION_CHUNK_SIZE):
+    """
+    Converts the job's rows chunk by chunk. Every chunk update and the job progress are committed together
+    under the job row lock, so concurrent workers or a restart never convert a row twice.
+    """
+
+    CurrencyConversionJob.objects.filter(id=job_id, status=CurrencyConversionJob.STATUS_PENDING).update(
+        status=CurrencyConversionJob.STATUS_RUNNING
+    )
+
+    try:
+        for model, field, prefix in CONVERSION_STEPS:
+            last_id_attr = 'last_%s_id' % prefix
+            processed_attr = '%ss_processed' % prefix
+
+            while True:
+                with transaction.atomic():
+                    job = CurrencyConversionJob.objects.select_for_update().get(id=job_id)
+
+                    if job.status != CurrencyConversionJob.STATUS_RUNNING:
+                        return job
+
+                    ids = list(model.objects.filter(
+                        user_id=job.user_id,
+                        id__gt=getattr(job, last_id_attr),
+                        id__lte=getattr(job, 'max_%s_id' % prefix)
+                    ).order_by('id').values_list('id', flat=True)[:chunk_size])
+
+                    if not ids:
+                        break
+
+                    model.objects.filter(id__in=ids).update(**{field: F(field) * job.rate})
+
+                    setattr(job, last_id_attr, ids[-1])
+                    setattr(job, processed_attr, getattr(job, processed_attr) + len(ids))
+                    job.save(update_fields=[last_id_attr, processed_attr])
+
+        with transaction.atomic():
+            job = CurrencyConversionJob.objects.select_for_update().get(id=job_id)
+            if job.status == CurrencyConversionJob.STATUS_RUNNING:
+                job.status = CurrencyConversionJob.STATUS_DONE
+                job.date_finished = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+                job.save(update_fields=['status', 'date_finished'])
+
+    except Exception as e:
+        logger.exception('Currency conversion job %s failed', job_id)
+
+        CurrencyConversionJob.objects.filter(id=job_id).update(status=CurrencyConversionJob.STATUS_FAILED, error=str(e))
+        job = CurrencyConversionJob.objects.get(id=job_id)
+
+    if job.status == CurrencyConversionJob.STATUS_DONE:
+        # The mileages were rolled up in the previous currency
+        rebuild_user_mileage_rollups(job.user_id)
+
+    return job
@@ -0,0 +1,243 @@
+import datetime
+import io
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+import pytz
+import requests
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction, IntegrityError
+from PIL import Image
+
+from vitesse_prod.apps.db.models import ImageUrlCheck
+
+
+logger = logging.getLogger(__name__)
+
+IMAGE_CONTENT_TYPES = ('image/png', 'image/jpeg', 'image/gif')
+
+IMAGE_URL_CHECK_WORKERS = getattr(settings, 'IMAGE_URL_CHECK_WORKERS', 16)
+IMAGE_URL_CHECK_TIMEOUT = getattr(settings, 'IMAGE_URL_CHECK_TIMEOUT', 5)
+IMAGE_URL_CHECK_MAX_AGE = getattr(settings, 'IMAGE_URL_CHECK_MAX_AGE', datetime.timedelta(days=7))
+
+MIRROR_MAX_BYTES = 10 * 1024 * 1024
+MIRROR_SIZE = (200, 200)
+
+QUERY_CHUNK_SIZE = 1000
+
+_sessions = threading.local()
+
+
+def get_session():
+    # requests.Session is not thread safe, one per worker thread keeps the connections alive
+
+    session = getattr(_sessions, 'session', None)
+    if session is None:
+        session = _sessions.session = requests.Session()
+
+    return session
+
+
+def get_content_type(response):
+    return response.headers.get('content-type', '').split(';')[0].strip().lower()
+
+
+def check_image_url(url, etag='', timeout=IMAGE_URL_CHECK_TIMEOUT):
+    """
+    HEAD request, or a one byte range GET for servers that don't answer HEAD properly.
+    The body is never downloaded. not_modified: the stored etag is still current.
+    """
+
+    result = {'url': url, 'is_valid': False, 'not_modified': False, 'status_code': None,
+              'content_type': '', 'etag': '', 'error': ''}
+    headers = {'If-None-Match': etag} if etag else {}
+    session = get_session()
+
+    try:
+        response = session.head(url, headers=headers, timeout=timeout, allow_redirects=True)
+
+        if response.status_code in (405, 501) or (response.ok and not get_content_type(response)):
+            headers['Range'] = 'bytes=0-0'
+            response = session.get(url, headers=headers, timeout=timeout, allow_redirects=True, stream=True)
+            response.close()
+
+    except (requests.RequestException, ValueError) as e:
+        result['error'] = str(e)
+        return result
+
+    result['status_code'] = response.status_code
+
+    if etag and response.status_code == 304:
+        result['not_modified'] = True
+        return result
+
+    result['content_type'] = get_content_type(response)[:255]
+    result['etag'] = response.headers.get('etag', '')[:255]
+    result['is_valid'] = response.status_code in (200, 206) and result['content_type'] in IMAGE_CONTENT_TYPES
+
+    return result
+
+
+def get_image_url_checks(urls):
+    # {url: ImageUrlCheck} of the already checked urls
+
+    hashes = dict((ImageUrlCheck.hash_url(url), url) for url in urls)
+    hash_list = list(hashes)
+
+    checks = {}
+    for start in range(0, len(hash_list), QUERY_CHUNK_SIZE):
+        for check in ImageUrlCheck.objects.filter(url_hash__in=hash_list[start:start + QUERY_CHUNK_SIZE]):
+            checks[hashes[check.url_hash]] = check
+
+    return checks
+
+
+def create_image_url_checks(new_checks):
+    # Inserts the checks per chunk, a url checked by a concurrent call meanwhile gets its row updated instead
+
+    for start in range(0, len(new_checks), QUERY_CHUNK_SIZE):
+        chunk = new_checks[start:start + QUERY_CHUNK_SIZE]
+        try:
+            with transaction.atomic():
+                ImageUrlCheck.objects.bulk_create(chunk)
+        except IntegrityError:
+            for check in chunk:
+                create_image_url_check(check)
+
+
+def create_image_url_check(check):
+
+    try:
+        with transaction.atomic():
+            check.save(force_insert=True)
+    except IntegrityError:
+        check.pk = None
+        values = dict((field, getattr(check, field))
+                      for field in ('is_valid', 'status_code', 'content_type', 'etag', 'error', 'date_checked'))
+        ImageUrlCheck.objects.filter(url_hash=check.url_hash).update(**values)
+        check.pk = ImageUrlCheck.objects.get(url_hash=check.url_hash).pk
+
+
+def run_in_pool(function, items, workers):
+
+    if not items:
+        return []
+
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        return pool.map(function, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def validate_image_urls(urls, workers=IMAGE_URL_CHECK_WORKERS, timeout=IMAGE_URL_CHECK_TIMEOUT,
+                        max_age=IMAGE_URL_CHECK_MAX_AGE, refresh=False):
+    """
+    Returns {url: is valid}. Results younger than max_age come from ImageUrlCheck without any request,
+    older ones are revalidated concurrently with If-None-Match. Only the pool threads do HTTP,
+    the database is written from the calling thread.
+    """
+
+    urls = set(url for url in urls if url)
+    now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+
+    checks = get_image_url_checks(urls)
+
+    to_check = [url for url in urls if refresh or url not in checks or checks[url].date_checked < now - max_age]
+
+    results = run_in_pool(
+        lambda url: check_image_url(url, etag=checks[url].etag if url in checks else '', timeout=timeout),
+        to_check, workers
+    )
+
+    new_checks = []
+    not_modified_ids = []
+    for result in results:
+        url = result['url']
+        values = dict((field, result[field]) for field in ('is_valid', 'status_code', 'content_type', 'etag', 'error'))
+
+        if url not in checks:
+            checks[url] = ImageUrlCheck(url=url, url_hash=ImageUrlCheck.hash_url(url), date_checked=now, **values)
+            new_checks.append(checks[url])
+
+        elif result['not_modified']:
+            not_modified_ids.append(checks[url].id)
+
+        else:
+            ImageUrlCheck.objects.filter(id=checks[url].id).update(date_checked=now, **values)
+            for field, value in values.items():
+                setattr(checks[url], field, value)
+
+    create_image_url_checks(new_checks)
+
+    for start in range(0, len(not_modified_ids), QUERY_CHUNK_SIZE):
+        ImageUrlCheck.objects.filter(id__in=not_modified_ids[start:start + QUERY_CHUNK_SIZE]).update(date_checked=now)
+
+    return dict((url, checks[url].is_valid) for url in urls)
+
+
+def download_thumbnail(url, size=MIRROR_SIZE, timeout=IMAGE_URL_CHECK_TIMEOUT):
+    # PNG bytes of the image thumbnail, None if it can't be downloaded or read
+
+    try:
+        response = get_session().get(url, timeout=timeout, stream=True)
+        try:
+            response.raise_for_status()
+
+            data = io.BytesIO()
+            for chunk in response.iter_content(64 * 1024):
+                data.write(chunk)
+                if data.tell() > MIRROR_MAX_BYTES:
+                    return None
+        finally:
+            response.close()
+
+        data.seek(0)
+        image = Image.open(data)
+        image.thumbnail(size)
+
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA')
+
+        thumbnail = io.BytesIO()
+        image.save(thumbnail, 'PNG')
+
+        return thumbnail.getvalue()
+
+    except (requests.RequestException, IOError, ValueError):
+        logger.warning('Could not mirror %s', url, exc_info=True)
+        return None
+
+
+def mirror_image_urls(urls, workers=IMAGE_URL_CHECK_WORKERS, timeout=IMAGE_URL_CHECK_TIMEOUT, size=MIRROR_SIZE):
+    """
+    Stores a local thumbnail of every valid url not mirrored yet, or mirrored before its ETag changed.
+    Returns {url: mirror file name}.
+    """
+
+    checks = get_image_url_checks(set(url for url in urls if url))
+
+    to_mirror = [
+        url for url, check in checks.items()
+        if check.is_valid and (not check.mirror or (check.etag and check.etag != check.mirror_etag))
+    ]
+
+    thumbnails = run_in_pool(lambda url: download_thumbnail(url, size=size, timeout=timeout), to_mirror, workers)
+
+    for url, thumbnail in zip(to_mirror, thumbnails):
+        if thumbnail is None:
+            continue
+
+        check = checks[url]
+
+        # Replaced mirror, the previous file would be left orphaned in the storage
+        if check.mirror:
+            check.mirror.storage.delete(check.mirror.name)
+
+        check.mirror.save('%s.png' % check.url_hash[:32], ContentFile(thumbnail), save=False)
+        ImageUrlCheck.objects.filter(id=check.id).update(mirror=check.mirror.name, mirror_etag=check.etag)
+
+    return dict((url, check.mirror.name) for url, check in checks.items() if check.mirror)
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from vitesse_prod.apps.db.buyer_assignment import assign_buyers, get_buyer_index
+
+
+class Command(BaseCommand):
+    help = 'Assigns buyers to the new orders without one, balancing on the buyers open orders'
+
+    def handle(self, *args, **options):
+
+        get_buyer_index(refresh=True)
+
+        assignments = assign_buyers()
+        self.stdout.write('%i orders assigned to %i buyers' % (len(assignments), len(set(assignments.values()))))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from vitesse_prod.apps.db.attribute_projection import backfill_attribute_projections, PROJECTION_CHUNK_SIZE
+from vitesse_prod.apps.db.models import Order, OrderLine
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds attribute_values of the orders and order lines from their ProductAttributeValues'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', choices=['order', 'order_line'], default=None)
+        parser.add_argument('--chunk-size', type=int, default=PROJECTION_CHUNK_SIZE, dest='chunk_size')
+
+    def handle(self, *args, **options):
+
+        models = {'order': [Order], 'order_line': [OrderLine]}.get(options['model'])
+
+        stats = backfill_attribute_projections(models=models, chunk_size=options['chunk_size'], log=self.stdout.write)
+        for model_name, count in stats.items():
+            self.stdout.write('%s: %i rows' % (model_name, count))
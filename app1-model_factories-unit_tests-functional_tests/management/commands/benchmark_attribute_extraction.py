@@ -0,0 +1,45 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from vitesse_prod.apps.db.nlp import AttributeExtractor, build_matchers
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks AttributeExtractor on synthetic matchers and descriptions (no database access)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--attributes', type=int, default=400)
+        parser.add_argument('--values', type=int, default=50, help='Values per attribute')
+        parser.add_argument('--descriptions', type=int, default=20000)
+        parser.add_argument('--tokens', type=int, default=25, help='Tokens per description')
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+
+        rnd = random.Random(options['seed'])
+        vocabulary = ['word%i' % i for i in range(5000)]
+
+        matchers = {}
+        for attribute_id in range(options['attributes']):
+            values = [' '.join(rnd.sample(vocabulary, rnd.randint(1, 3))) for _ in range(options['values'])]
+            matchers[attribute_id] = build_matchers(values)
+
+        descriptions = [
+            ' '.join(rnd.choice(vocabulary) for _ in range(options['tokens']))
+            for _ in range(options['descriptions'])
+        ]
+
+        start = time.time()
+        extractor = AttributeExtractor(matchers)
+        compile_time = time.time() - start
+
+        start = time.time()
+        results = extractor.extract_many(descriptions)
+        scan_time = time.time() - start
+
+        self.stdout.write('Patterns: %i (skipped %i). Compiled in %.2fs.' % (
+            extractor.patterns_count, extractor.skipped_patterns_count, compile_time))
+        self.stdout.write('Descriptions: %i in %.2fs, %.0f descriptions/sec, %i values found.' % (
+            len(descriptions), scan_time, len(descriptions) / scan_time, sum(len(r) for r in results)))
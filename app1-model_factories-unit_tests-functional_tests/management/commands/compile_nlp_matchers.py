@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from vitesse_prod.apps.db.nlp import compile_stale_matchers, COMPILE_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Recompiles NLP matchers of the stale ProductAttribute / NLPProductAttribute rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', dest='force', default=False,
+                            help='Recompile every row, not only the stale ones')
+        parser.add_argument('--processes', type=int, default=None,
+                            help='Worker processes (defaults to the number of CPUs, 1 disables the pool)')
+        parser.add_argument('--chunk-size', type=int, default=COMPILE_CHUNK_SIZE, dest='chunk_size')
+        parser.add_argument('--no-seed', action='store_false', dest='seed', default=True,
+                            help="Don't create missing NLPProductAttribute rows for Product.attributes")
+
+    def handle(self, *args, **options):
+
+        stats = compile_stale_matchers(
+            processes=options['processes'],
+            chunk_size=options['chunk_size'],
+            force=options['force'],
+            seed=options['seed'],
+            log=self.stdout.write
+        )
+
+        self.stdout.write('Seeded: %(seeded)i. Attributes compiled: %(attributes)i. '
+                          'Product attributes compiled: %(nlp_attributes)i.' % stats)
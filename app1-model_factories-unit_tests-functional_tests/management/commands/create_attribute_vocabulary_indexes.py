@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from vitesse_prod.apps.db.attribute_vocabulary import create_attribute_vocabulary_indexes
+
+
+class Command(BaseCommand):
+    help = 'Creates the lower(value) index of ProductAttributeValue used by the attribute vocabularies'
+
+    def handle(self, *args, **options):
+
+        create_attribute_vocabulary_indexes()
+        self.stdout.write('Done')
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+
+from vitesse_prod.apps.db.models import Catalog
+from vitesse_prod.apps.db.catalog_import import import_catalog, CATALOG_IMPORT_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Imports the uploaded Catalog file (CSV or XLSX) into CatalogItems'
+
+    def add_arguments(self, parser):
+        parser.add_argument('catalog_id', type=int)
+        parser.add_argument('--full', action='store_true', default=False,
+                            help='Replace all the catalog items instead of a delta import')
+        parser.add_argument('--keep-missing', action='store_false', default=True, dest='deactivate_missing',
+                            help='Keep the items missing from the file active')
+        parser.add_argument('--chunk-size', type=int, default=CATALOG_IMPORT_CHUNK_SIZE, dest='chunk_size')
+
+    def handle(self, *args, **options):
+
+        catalog = Catalog.objects.get(id=options['catalog_id'])
+
+        report = import_catalog(
+            catalog,
+            delta=not options['full'],
+            deactivate_missing=options['deactivate_missing'],
+            chunk_size=options['chunk_size'],
+            log=self.stdout.write
+        )
+
+        for error in report['errors']:
+            self.stderr.write(error)
+
+        self.stdout.write(
+            '%(rows)i rows in %(seconds)ss (%(rows_per_second)i rows/s). %(created)i created, %(updated)i updated, '
+            '%(unchanged)i unchanged, %(deactivated)i deactivated, %(errors_count)i errors' % report
+        )
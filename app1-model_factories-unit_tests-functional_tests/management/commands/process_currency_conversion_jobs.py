@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from vitesse_prod.apps.db.currency_conversion import run_currency_conversion_jobs, CONVERSION_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Runs pending and resumes interrupted expense re-denomination jobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user-id', type=int, default=None, dest='user_id')
+        parser.add_argument('--chunk-size', type=int, default=CONVERSION_CHUNK_SIZE, dest='chunk_size')
+
+    def handle(self, *args, **options):
+
+        jobs = run_currency_conversion_jobs(user_id=options['user_id'], chunk_size=options['chunk_size'])
+
+        for job in jobs:
+            self.stdout.write('%s. %s%%' % (job, job.progress))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from vitesse_prod.apps.db.media_processing import run_media_jobs
+
+
+class Command(BaseCommand):
+    help = 'Processes pending and interrupted media jobs (rotation, thumbnails, dimensions)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retry-failed', action='store_true', default=False, dest='retry_failed')
+        parser.add_argument('--max-attempts', type=int, default=3, dest='max_attempts')
+
+    def handle(self, *args, **options):
+
+        jobs = run_media_jobs(retry_failed=options['retry_failed'], max_attempts=options['max_attempts'])
+
+        for job in jobs:
+            self.stdout.write('%s' % job)
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from vitesse_prod.apps.db.models import rebuild_all_catalog_visibility
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the per user catalog visibility index'
+
+    def handle(self, *args, **options):
+
+        rebuild_all_catalog_visibility()
+        self.stdout.write('Done')
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from vitesse_prod.apps.db.models import Company
+from vitesse_prod.apps.db.analytics import rebuild_spend_rollups
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the daily spend rollups of the analytics, per company'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--company-id', type=int, default=None, dest='company_id')
+
+    def handle(self, *args, **options):
+
+        company_ids = Company.objects.order_by('id').values_list('id', flat=True)
+        if options['company_id']:
+            company_ids = company_ids.filter(id=options['company_id'])
+
+        for company_id in company_ids:
+            created_count = rebuild_spend_rollups(company_id)
+            self.stdout.write('%i: %i rollups' % (company_id, created_count))
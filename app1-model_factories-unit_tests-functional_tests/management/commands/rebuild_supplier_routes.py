@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from vitesse_prod.apps.db.models import Order
+from vitesse_prod.apps.db.supplier_routing import rebuild_supplier_routes, fill_suggested_suppliers
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the supplier routing index and optionally suggests suppliers for orders without any'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--company-id', type=int, default=None, dest='company_id')
+        parser.add_argument('--fill-orders', action='store_true', default=False, dest='fill_orders')
+
+    def handle(self, *args, **options):
+
+        company_ids = [options['company_id']] if options['company_id'] else None
+
+        routes_count = rebuild_supplier_routes(company_ids=company_ids)
+        self.stdout.write('%i routes' % routes_count)
+
+        if options['fill_orders']:
+            orders = Order.objects.filter(category__isnull=False, order_suggested_suppliers__isnull=True)
+            if company_ids:
+                orders = orders.filter(company_id__in=company_ids)
+
+            self.stdout.write('%i suggested suppliers' % fill_suggested_suppliers(orders))
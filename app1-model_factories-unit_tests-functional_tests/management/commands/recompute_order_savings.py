@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from vitesse_prod.apps.db.models import Company
+from vitesse_prod.apps.db.savings import recompute_order_savings
+
+
+class Command(BaseCommand):
+    help = 'Recomputes OrderSavings of the closed orders, per company'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--company-id', type=int, default=None, dest='company_id')
+        parser.add_argument('--incremental', action='store_true', default=False,
+                            help='Only orders (or their quotes) changed since the last finished run')
+
+    def handle(self, *args, **options):
+
+        companies = Company.objects.all()
+        if options['company_id']:
+            companies = companies.filter(id=options['company_id'])
+
+        for company in companies:
+            run = recompute_order_savings(company, incremental=options['incremental'])
+            self.stdout.write('%s: %i orders' % (company, run.orders_processed))
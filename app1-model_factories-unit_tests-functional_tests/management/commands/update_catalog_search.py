@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from vitesse_prod.apps.db.catalog_search import update_catalog_search_vectors, create_catalog_search_indexes
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the CatalogItem search vectors, optionally creating the trigram index first'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--create-indexes', action='store_true', default=False, dest='create_indexes',
+                            help='pg_trgm extension and the title trigram index')
+
+    def handle(self, *args, **options):
+
+        if options['create_indexes']:
+            create_catalog_search_indexes()
+
+        update_catalog_search_vectors()
+        self.stdout.write('Done')
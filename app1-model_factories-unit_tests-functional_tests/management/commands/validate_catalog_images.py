@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from vitesse_prod.apps.db.models import CatalogItem
+from vitesse_prod.apps.db.image_validation import validate_image_urls, mirror_image_urls, IMAGE_URL_CHECK_WORKERS
+
+
+class Command(BaseCommand):
+    help = 'Checks the catalog item image urls concurrently and optionally mirrors the valid ones as thumbnails'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--catalog-id', type=int, default=None, dest='catalog_id')
+        parser.add_argument('--workers', type=int, default=IMAGE_URL_CHECK_WORKERS, dest='workers')
+        parser.add_argument('--refresh', action='store_true', default=False, help='Ignore the cached results')
+        parser.add_argument('--mirror', action='store_true', default=False)
+
+    def handle(self, *args, **options):
+
+        items = CatalogItem.objects.filter(is_active=True)
+        if options['catalog_id']:
+            items = items.filter(catalog_id=options['catalog_id'])
+
+        urls = set(items.values_list('image_url', flat=True))
+
+        results = validate_image_urls(urls, workers=options['workers'], refresh=options['refresh'])
+        self.stdout.write('%i urls, %i valid' % (len(results), sum(results.values())))
+
+        if options['mirror']:
+            mirrors = mirror_image_urls([url for url, is_valid in results.items() if is_valid], workers=options['workers'])
+            self.stdout.write('%i mirrored' % len(mirrors))
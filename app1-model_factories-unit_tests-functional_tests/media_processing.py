@@ -0,0 +1,163 @@
+import datetime
+import logging
+from multiprocessing.pool import ThreadPool
+
+import pytz
+from django.conf import settings
+from django.db import connection, transaction, IntegrityError
+from django.db.models import F
+from easy_thumbnails.files import get_thumbnailer
+from PIL import Image
+
+from vitesse_prod.apps.db.models import MediaJob, OrderImage, OrderFile, ExpenseClaim
+
+
+logger = logging.getLogger(__name__)
+
+MEDIA_PROCESSING_WORKERS = getattr(settings, 'MEDIA_PROCESSING_WORKERS', 2)
+
+# A running job not finished after this many seconds is considered interrupted
+MEDIA_JOB_STALE_AFTER = 15 * 60
+
+# kind -> (model, file field, thumbnail field, width field, height field). OrderImage rotates in save()
+MEDIA_KINDS = {
+    MediaJob.KIND_ORDER_IMAGE: (OrderImage, 'image', 'thumbnail', 'width', 'height'),
+    MediaJob.KIND_ORDER_FILE: (OrderFile, 'file', None, 'width', 'height'),
+    MediaJob.KIND_EXPENSE_CLAIM_PHOTO: (ExpenseClaim, 'photo', None, 'photo_width', 'photo_height'),
+}
+
+_media_pool = {'pool': None}
+
+
+def get_media_kind(instance):
+
+    for kind, media_kind in MEDIA_KINDS.items():
+        if isinstance(instance, media_kind[0]):
+            return kind
+
+
+def schedule_media_job(instance):
+    # Called from post_save. Queues the stored file once, the request does not wait for the processing
+
+    kind = get_media_kind(instance)
+    field_file = getattr(instance, MEDIA_KINDS[kind][1])
+
+    if not field_file:
+        return None
+
+    try:
+        with transaction.atomic():
+            job, created = MediaJob.objects.get_or_create(
+                kind=kind, object_id=instance.id, defaults={'file_name': field_file.name}
+            )
+    except IntegrityError:
+        # Queued by a concurrent save of the same row, (kind, object_id) is unique
+        job, created = MediaJob.objects.get(kind=kind, object_id=instance.id), False
+
+    if not created:
+        if job.file_name == field_file.name:
+            return job
+
+        # Replaced file, a job still running for the previous one won't mark this one done
+        MediaJob.objects.filter(id=job.id).update(file_name=field_file.name, status=MediaJob.STATUS_PENDING, error='')
+
+    transaction.on_commit(lambda: start_media_job(job.id))
+
+    return job
+
+
+def get_media_pool():
+
+    if _media_pool['pool'] is None:
+        _media_pool['pool'] = ThreadPool(MEDIA_PROCESSING_WORKERS)
+
+    return _media_pool['pool']
+
+
+def start_media_job(job_id):
+    return get_media_pool().apply_async(process_media_job, (job_id,), {'close_connection': True})
+
+
+def get_image_size(field_file):
+
+    field_file.open('rb')
+    try:
+        return Image.open(field_file).size
+    except IOError:
+        return None
+    finally:
+        field_file.close()
+
+
+def process_media_file(field_file, thumbnail_field, width_field, height_field):
+    # Returns the values to update the media row with, files that are not images are left as they are
+
+    size = get_image_size(field_file)
+    if size is None:
+        return {}
+
+    values = {width_field: str(size[0]), height_field: str(size[1])}
+
+    if thumbnail_field:
+        values[thumbnail_field] = get_thumbnailer(field_file)['50']
+
+    return values
+
+
+def process_media_job(job_id, close_connection=False):
+
+    now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+
+    try:
+        claimed = MediaJob.objects.filter(id=job_id, status=MediaJob.STATUS_PENDING).update(
+            status=MediaJob.STATUS_RUNNING, date_started=now, attempts=F('attempts') + 1
+        )
+        if not claimed:
+            return None
+
+        job = MediaJob.objects.get(id=job_id)
+        model, file_field, thumbnail_field, width_field, height_field = MEDIA_KINDS[job.kind]
+
+        try:
+            instance = model.objects.filter(id=job.object_id).first()
+
+            # Nothing to do when deleted or replaced since the job was queued
+            if instance is not None and getattr(instance, file_field).name == job.file_name:
+                values = process_media_file(getattr(instance, file_field), thumbnail_field, width_field, height_field)
+                if values:
+                    model.objects.filter(id=instance.id, **{file_field: job.file_name}).update(**values)
+
+            MediaJob.objects.filter(id=job.id, status=MediaJob.STATUS_RUNNING, file_name=job.file_name).update(
+                status=MediaJob.STATUS_DONE, date_finished=datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+            )
+
+        except Exception as e:
+            logger.exception('Media job %s failed', job_id)
+
+            MediaJob.objects.filter(id=job.id, status=MediaJob.STATUS_RUNNING, file_name=job.file_name).update(
+                status=MediaJob.STATUS_FAILED, error=str(e)
+            )
+
+        return MediaJob.objects.get(id=job_id)
+
+    finally:
+        if close_connection:
+            connection.close()
+
+
+def run_media_jobs(retry_failed=False, max_attempts=3):
+    # Pending jobs, interrupted ones and optionally the failed ones, processed in this process
+
+    stale_date = datetime.datetime.utcnow().replace(tzinfo=pytz.utc) - datetime.timedelta(seconds=MEDIA_JOB_STALE_AFTER)
+    MediaJob.objects.filter(status=MediaJob.STATUS_RUNNING, date_started__lt=stale_date).update(
+        status=MediaJob.STATUS_PENDING
+    )
+
+    if retry_failed:
+        MediaJob.objects.filter(status=MediaJob.STATUS_FAILED, attempts__lt=max_attempts).update(
+            status=MediaJob.STATUS_PENDING, error=''
+        )
+
+    job_ids = MediaJob.objects.filter(status=MediaJob.STATUS_PENDING).order_by('id').values_list('id', flat=True)
+
+    return [job for job in (process_media_job(job_id) for job_id in job_ids) if job is not None]
@@ -3,34 +3,38 @@ from django.contrib.auth.models import (
     AbstractBaseUser, PermissionsMixin, Group
 )
 from django.contrib.postgres.fields import ArrayField, JSONField
-from django.db import models
-from django.db.models import Q, F, Count, Case, When, Value
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
+from django.db import models, transaction, IntegrityError
+from django.db.models import Q, F, Count, Case, When, Value, ExpressionWrapper, Subquery, OuterRef
 from django.conf import settings
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.text import slugify
 from django.utils.translation import ugettext_lazy as _
 from django.core.exceptions import ValidationError
+from django.core.cache import cache
 
 # EXTENDING DATETIME LOOKUPS
 from django.conf import settings
-from django.db.models.fields import DateField, DateTimeField, IntegerField, TimeField
-from django.db.models.functions import Func, Lower
+from django.db.models.fields import DateField, DateTimeField, IntegerField, TimeField, FloatField, BooleanField
+from django.db.models.functions import Func, Lower, Greatest, Coalesce
 from django.db.models.lookups import Transform
 from django.utils import timezone
 from django.utils.functional import cached_property
+from contextlib import contextmanager
 from django.contrib.humanize.templatetags.humanize import intcomma
 
 from .managers import UserManager
 
-from easy_thumbnails.files import get_thumbnailer
-
+import os
 import math
+import time
+import threading
 import hashlib
 import datetime
 import pytz
 import json
 import urllib2
-import requests
 
 
 class Now(Func):
@@ -49,6 +53,62 @@ class Now(Func):
         return self.as_sql(compiler, connection)
 
 
+class WindowFunc(Func):
+    # <function>(<expressions>) OVER (PARTITION BY ... ORDER BY ...), i.e. WindowFunc('RANK', partition_by=['order_id'], order_by=['value', 'id'])
+    # Evaluated after WHERE, so window annotations can be selected and ordered by but not filtered on
+    template = '%(function)s(%(expressions)s) OVER (%(window)s)'
+    contains_aggregate = False
+
+    def __init__(self, function, expressions=(), partition_by=(), order_by=(), **extra):
+        self.function = function
+        self.partition_by = list(self._parse_expressions(*partition_by))
+        self.order_by_descending = [isinstance(e, basestring) and e.startswith('-') for e in order_by]
+        self.order_by = list(self._parse_expressions(*[e.lstrip('-') if isinstance(e, basestring) else e for e in order_by]))
+        super(WindowFunc, self).__init__(*expressions, **extra)
+
+    def get_source_expressions(self):
+        return super(WindowFunc, self).get_source_expressions() + self.partition_by + self.order_by
+
+    def resolve_expression(self, query=None, allow_joins=True, reuse=None, summarize=False, for_save=False):
+        # Func only resolves its own arguments
+        c = super(WindowFunc, self).resolve_expression(query, allow_joins, reuse, summarize, for_save)
+        c.partition_by = [e.resolve_expression(query, allow_joins, reuse, summarize, for_save) for e in c.partition_by]
+        c.order_by = [e.resolve_expression(query, allow_joins, reuse, summarize, for_save) for e in c.order_by]
+        return c
+
+    def set_source_expressions(self, exprs):
+        exprs = list(exprs)
+        functions_count = len(exprs) - len(self.partition_by) - len(self.order_by)
+        super(WindowFunc, self).set_source_expressions(exprs[:functions_count])
+        self.partition_by = exprs[functions_count:functions_count + len(self.partition_by)]
+        self.order_by = exprs[functions_count + len(self.partition_by):]
+
+    def as_sql(self, compiler, connection, **extra_context):
+
+        window_sql = []
+        window_params = []
+
+        if self.partition_by:
+            partition_sql = []
+            for expression in self.partition_by:
+                sql, params = compiler.compile(expression)
+                partition_sql.append(sql)
+                window_params.extend(params)
+            window_sql.append('PARTITION BY %s' % ', '.join(partition_sql))
+
+        if self.order_by:
+            order_sql = []
+            for expression, descending in zip(self.order_by, self.order_by_descending):
+                sql, params = compiler.compile(expression)
+                order_sql.append('%s %s' % (sql, 'DESC' if descending else 'ASC'))
+                window_params.extend(params)
+            window_sql.append('ORDER BY %s' % ', '.join(order_sql))
+
+        sql, params = super(WindowFunc, self).as_sql(compiler, connection, window=' '.join(window_sql), **extra_context)
+
+        return sql, list(params) + window_params
+
+
 class DateTransform(Transform):
     def as_sql(self, compiler, connection):
         sql, params = compiler.compile(self.lhs)
@@ -92,7 +152,57 @@ class HasCompany(models.Model):
         abstract = True
 
 
-class User(AbstractBaseUser, PermissionsMixin):
+class TrackedFieldsMixin(object):
+    """
+    Keeps the values of tracked_fields (attnames) as they were loaded from the database,
+    so pre_save handlers can compare them without re-fetching the row.
+    Instances not created by a query (i.e. Model(id=...)) load the originals once, on first access.
+    """
+
+    tracked_fields = ()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(TrackedFieldsMixin, cls).from_db(db, field_names, values)
+        instance.reset_original_values()
+        return instance
+
+    def refresh_from_db(self, *args, **kwargs):
+        super(TrackedFieldsMixin, self).refresh_from_db(*args, **kwargs)
+        self.reset_original_values()
+
+    def reset_original_values(self):
+        # Deferred fields are left out and loaded on demand
+        self._original_values = dict(
+            (field, getattr(self, field)) for field in self.tracked_fields if field in self.__dict__
+        )
+
+    def get_original_values(self):
+
+        if not self.pk:
+            return {}
+
+        original_values = getattr(self, '_original_values', None)
+        if original_values is None:
+            original_values = self._original_values = {}
+
+        missing_fields = [field for field in self.tracked_fields if field not in original_values]
+        if missing_fields:
+            original_values.update(
+                type(self)._base_manager.filter(pk=self.pk).values(*missing_fields).first() or {}
+            )
+
+        return original_values
+
+    def get_original_value(self, field):
+        return self.get_original_values().get(field)
+
+    def has_field_changed(self, field):
+        original_values = self.get_original_values()
+        return field in original_values and original_values[field] != getattr(self, field)
+
+
+class User(TrackedFieldsMixin, AbstractBaseUser, PermissionsMixin):
 
     MANAGER = 1
     BUYER = 2
@@ -161,6 +271,8 @@ class User(AbstractBaseUser, PermissionsMixin):
 
     objects = UserManager()
 
+    tracked_fields = ('role', 'default_region_id', 'default_currency_id', 'company_id', 'is_active')
+
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['name']
 
@@ -227,29 +339,17 @@ class User(AbstractBaseUser, PermissionsMixin):
     @property
     def unread_notifications_count(self):
 
-        count = 0
-        if UserUnreadActivityNotificationsCount.objects.filter(user=self).exists():
-            count = UserUnreadActivityNotificationsCount.objects.filter(user=self).first().count
-
-        return count
+        return UserUnreadActivityNotificationsCount.objects.filter(user=self).values_list('count', flat=True).first() or 0
 
     def set_unread_notifications_count(self, count):
 
-        obj, is_created = UserUnreadActivityNotificationsCount.objects.get_or_create(user=self)
-
         # If string (i.e. '-1' | '+1' | '-2') do the math else set the value
         if isinstance(count, basestring):
-            obj.count += + int(count)
+            UserUnreadActivityNotificationsCount.objects.add_counts({self.id: int(count)})
         else:
-            obj.count = count
-
-        # Avoid negative value
-        if obj.count < 0:
-            obj.count = 0
+            UserUnreadActivityNotificationsCount.objects.set_count(self.id, count)
 
-        obj.save(update_fields=['count'])
-
-        return obj.count
+        return self.unread_notifications_count
 
     def save(self, *args, **kwargs):
 
@@ -331,7 +431,106 @@ class User(AbstractBaseUser, PermissionsMixin):
         return "%0.1f" % (fields_filled_out / float(len(all_fields)) * 100)
 
     def has_catalog_items(self):
-        return CatalogItem.objects.filter(catalog__users=self).exists()
+        return get_catalog_visibility(self.id)['has_items']
+
+    def get_visible_catalog_ids(self):
+        return list(get_catalog_visibility(self.id)['catalog_ids'])
+
+
+class UserUnreadActivityNotificationsCountQueryset(models.QuerySet):
+
+    def add_counts(self, deltas):
+        # deltas: {user_id: +n | -n}. Atomic F() increments, one UPDATE per distinct delta, count never goes below 0
+
+        user_ids_by_delta = {}
+        for user_id, delta in deltas.items():
+            if delta:
+                user_ids_by_delta.setdefault(delta, []).append(user_id)
+
+        if not user_ids_by_delta:
+            return
+
+        # The missing rows are created at 0 first, so every delta is applied once, by the UPDATE
+        user_ids = [user_id for user_id, delta in deltas.items() if delta]
+        existing_user_ids = set(self.filter(user_id__in=user_ids).values_list('user_id', flat=True))
+        missing_user_ids = [user_id for user_id in user_ids if user_id not in existing_user_ids]
+
+        if missing_user_ids:
+            try:
+                with transaction.atomic():
+                    self.bulk_create([
+                        UserUnreadActivityNotificationsCount(user_id=user_id, count=0) for user_id in missing_user_ids
+                    ])
+            except IntegrityError:
+                # One row created concurrently rolls the whole insert back, a row already there is fine
+                for user_id in missing_user_ids:
+                    try:
+                        with transaction.atomic():
+                            self.create(user_id=user_id, count=0)
+                    except IntegrityError:
+                        pass
+
+        for delta, delta_user_ids in user_ids_by_delta.items():
+            self.filter(user_id__in=delta_user_ids).update(count=Greatest(F('count') + delta, Value(0)))
+
+    def set_count(self, user_id, count):
+
+        count = max(count, 0)
+
+        if not self.filter(user_id=user_id).update(count=count):
+            try:
+                with transaction.atomic():
+                    self.create(user_id=user_id, count=count)
+            except IntegrityError:
+                self.filter(user_id=user_id).update(count=count)
+
+
+class UserUnreadActivityNotificationsCountManager(models.Manager):
+
+    def get_queryset(self):
+        return UserUnreadActivityNotificationsCountQueryset(self.model, using=self._db)
+
+    def add_counts(self, deltas):
+        return self.get_queryset().add_counts(deltas)
+
+    def set_count(self, user_id, count):
+        return self.get_queryset().set_count(user_id, count)
+
+
+# Per-thread buffer of pending unread counter deltas, see coalesce_unread_notifications_counts()
+_unread_notifications_counts_buffer = threading.local()
+
+
+@contextmanager
+def coalesce_unread_notifications_counts():
+    # ActivityNotification creates/deletes inside the block update the counters once, on exit
+
+    if getattr(_unread_notifications_counts_buffer, 'deltas', None) is not None:
+        # Nested, the outer block flushes
+        yield
+        return
+
+    _unread_notifications_counts_buffer.deltas = {}
+    try:
+        yield
+    finally:
+        deltas = _unread_notifications_counts_buffer.deltas
+        _unread_notifications_counts_buffer.deltas = None
+
+        # Also after an exception: notifications saved in autocommit before it are committed.
+        # In a transaction the counters commit or roll back with them, unless it can only roll back now
+        if not transaction.get_connection().needs_rollback:
+            UserUnreadActivityNotificationsCount.objects.add_counts(deltas)
+
+
+def add_unread_notifications_count(user_id, delta):
+
+    deltas = getattr(_unread_notifications_counts_buffer, 'deltas', None)
+
+    if deltas is None:
+        UserUnreadActivityNotificationsCount.objects.add_counts({user_id: delta})
+    else:
+        deltas[user_id] = deltas.get(user_id, 0) + delta
 
 
 class UserUnreadActivityNotificationsCount(models.Model):
@@ -339,6 +538,8 @@ class UserUnreadActivityNotificationsCount(models.Model):
     user = models.OneToOneField('User', related_name='unread_notifications')
     count = models.IntegerField(default=0)
 
+    objects = UserUnreadActivityNotificationsCountManager()
+
     def __unicode__(self):
         return '%s. Count: %i' % (self.user, self.count)
 
@@ -449,47 +650,26 @@ class Company(models.Model):
             file_url = self.terms_n_conditions.name.split('/')[-1]
         return file_url
 
-    def get_custom_email_host(self):
-
-        from vitesse_prod.apps.general_functions.functions import get_object_or_None
-
-        custom_email_host = None
-        email_settings = get_object_or_None(CompanyEmailSettings, company=self)
+    def get_email_settings(self):
+        return get_company_settings(self.id)['email_settings']
 
-        if email_settings and email_settings.host and email_settings.port and email_settings.host_user and email_settings.password:
-            custom_email_host = email_settings
-
-        return custom_email_host
+    def get_custom_email_host(self):
+        return get_company_settings(self.id)['custom_email_host']
 
     def get_quote_acceptance_justification_emails(self):
+        return list(get_company_settings(self.id)['quote_acceptance_justification_emails'])
 
-        from vitesse_prod.apps.general_functions.functions import get_object_or_None
-
-        emails = []
-        email_settings = get_object_or_None(CompanyEmailSettings, company=self)
+    def get_quote_cancellation_justification_recipients_emails(self):
+        return list(get_company_settings(self.id)['quote_cancellation_justification_recipients_emails'])
 
-        if email_settings:
-            for email in email_settings.quote_acceptance_justification_emails.split(';'):
-
-                if email.strip():
-                    emails.append(email)
-
-        return emails
+    def get_quote_declined_justification_recipients_emails(self):
+        return list(get_company_settings(self.id)['quote_declined_justification_recipients_emails'])
 
     def get_quote_pending_recipients_emails(self):
+        return list(get_company_settings(self.id)['quote_pending_recipients_emails'])
 
-        from vitesse_prod.apps.general_functions.functions import get_object_or_None
-
-        emails = []
-        email_settings = get_object_or_None(CompanyEmailSettings, company=self)
-
-        if email_settings:
-            for email in email_settings.quote_pending_recipients_emails.split(';'):
-
-                if email.strip():
-                    emails.append(email)
-
-        return emails
+    def get_logo_file_name(self):
+        return get_company_settings(self.id)['logo_file_name']
 
 
 class CompanyEmailSettings(models.Model):
@@ -532,7 +712,75 @@ class CompanyMediaSettings(models.Model):
         return file_url
 
 
-class CompanyCategorySupplier(models.Model):
+# COMPANY SETTINGS CACHE
+
+# Process-level {company_id: parsed CompanyEmailSettings/CompanyMediaSettings}, loaded with one query.
+# Dropped by the settings post_save/post_delete signals in this process, other processes reload
+# an entry once it is COMPANY_SETTINGS_CACHE_TTL seconds old.
+COMPANY_SETTINGS_CACHE_TTL = 60
+
+COMPANY_EMAIL_LISTS = (
+    'quote_acceptance_justification_emails',
+    'quote_cancellation_justification_recipients_emails',
+    'quote_declined_justification_recipients_emails',
+    'quote_pending_recipients_emails',
+)
+
+_company_settings_cache = {}
+
+
+def split_emails(value):
+    return [email for email in (value or '').split(';') if email.strip()]
+
+
+def load_company_settings(company_id):
+
+    email_fields = [field.attname for field in CompanyEmailSettings._meta.concrete_fields]
+
+    row = Company.objects.filter(id=company_id).values(
+        'media_settings__logo', *['company_email_settings__%s' % field for field in email_fields]
+    ).first() or {}
+
+    email_settings = None
+    if row.get('company_email_settings__id'):
+        email_settings = CompanyEmailSettings(**dict(
+            (field, row['company_email_settings__%s' % field]) for field in email_fields
+        ))
+
+    settings_data = {
+        'email_settings': email_settings,
+        'custom_email_host': None,
+        'logo': row.get('media_settings__logo') or '',
+        'logo_file_name': (row.get('media_settings__logo') or '').split('/')[-1],
+        'loaded_at': time.time(),
+    }
+
+    if email_settings and email_settings.host and email_settings.port and email_settings.host_user and email_settings.password:
+        settings_data['custom_email_host'] = email_settings
+
+    for field in COMPANY_EMAIL_LISTS:
+        settings_data[field] = split_emails(getattr(email_settings, field)) if email_settings else []
+
+    return settings_data
+
+
+def get_company_settings(company_id, refresh=False):
+
+    settings_data = _company_settings_cache.get(company_id)
+
+    if refresh or settings_data is None or time.time() - settings_data['loaded_at'] > COMPANY_SETTINGS_CACHE_TTL:
+        settings_data = _company_settings_cache[company_id] = load_company_settings(company_id)
+
+    return settings_data
+
+
+def invalidate_company_settings(sender, instance, **kwargs):
+
+    company_id = instance.id if sender == Company else instance.company_id
+    _company_settings_cache.pop(company_id, None)
+
+
+class CompanyCategorySupplier(TrackedFieldsMixin, models.Model):
 
     company = models.ForeignKey('Company')
     category = models.ForeignKey('Category', null=True, blank=True)
@@ -540,6 +788,8 @@ class CompanyCategorySupplier(models.Model):
     supplier = models.ForeignKey('Supplier', related_name='company_category_suppliers')
     is_in_category_card = models.BooleanField(default=False)
 
+    tracked_fields = ('company_id', 'category_id', 'subcategory_id')
+
     class Meta:
         verbose_name = _('Company Category Supplier')
         verbose_name_plural = _('Company Category Suppliers')
@@ -558,7 +808,79 @@ class CompanyCategorySupplier(models.Model):
         return '%i. %s. %s. %s' % (self.id, self.company.name, strv, self.supplier.company_name)
 
 
-class Order(HasCompany, Misc):
+class AttributeValuesQuerySet(models.QuerySet):
+
+    def filter_attributes(self, filters):
+        """
+        filters: {attribute slug: value or list of values}, every attribute matching one of its values.
+        Containment (@>) on the attribute_values projection, served by its GIN index instead of
+        a ProductAttributeValue join per attribute.
+        """
+
+        queryset = self
+        contained = {}
+
+        for slug, values in filters.items():
+            if not isinstance(values, (list, tuple, set)):
+                values = [values]
+            values = [normalize_attribute_value(value) for value in values]
+
+            # An empty list of values matches no row
+            if not values:
+                return self.none()
+
+            if len(values) == 1:
+                contained[slug] = values
+                continue
+
+            condition = Q()
+            for value in values:
+                condition |= Q(attribute_values__contains={slug: [value]})
+            queryset = queryset.filter(condition)
+
+        if contained:
+            queryset = queryset.filter(attribute_values__contains=contained)
+
+        return queryset
+
+
+class OrderQuerySet(AttributeValuesQuerySet):
+
+    def for_listing(self):
+        """
+        Everything the order lists render, in one query: RFQ counts (rfq_count_str), main image,
+        accepted quote value, currency sign and UI status. Counts and images are correlated subqueries,
+        so the row count is never multiplied by joins.
+        """
+
+        # Both counts of the "quoted/total" label are over the submitted RFQs
+        rfqs = SupplierQuote.objects.filter(order=OuterRef('pk'), is_submitted=True).order_by().values('order')
+        main_image = OrderFile.objects.filter(order=OuterRef('pk')).order_by('id')
+
+        ui_status_cases = []
+        for value, label, statuses in Order.UI_STATUSES:
+            ui_status_cases.append(When(status__in=statuses, then=Value(value)))
+
+        return self.select_related('currency').annotate(
+            total_rfq_count=Coalesce(Subquery(
+                rfqs.annotate(c=Count('id')).values('c'), output_field=IntegerField()
+            ), 0),
+            quoted_rfq_count=Coalesce(Subquery(
+                rfqs.filter(supplier_process_status__in=SupplierQuote.QUOTED_PROCESS_STATUSES).annotate(
+                    c=Count('id')).values('c'), output_field=IntegerField()
+            ), 0),
+            main_image_id=Subquery(main_image.values('id')[:1], output_field=IntegerField()),
+            main_image_file=Subquery(main_image.values('file')[:1], output_field=models.CharField()),
+            accepted_quote_value=Subquery(
+                Quote.objects.filter(order=OuterRef('pk'), accepted=True).order_by('id').values('value')[:1],
+                output_field=FloatField()
+            ),
+            currency_sign=F('currency__sign'),
+            ui_status_value=Case(*ui_status_cases, default=Value('not-submitted'), output_field=models.CharField()),
+        )
+
+
+class Order(TrackedFieldsMixin, HasCompany, Misc):
 
     from vitesse_prod.apps.general_functions.functions import set_file_name
 
@@ -662,30 +984,54 @@ class Order(HasCompany, Misc):
     is_catalog = models.BooleanField(default=False)
     tax_amount = models.FloatField(default=0)
 
+    # {attribute slug: case-folded values} of order_values, kept by attribute_projection
+    attribute_values = JSONField(default=dict, blank=True)
+
+    # (ui status value, label, statuses), quoted orders not viewed by the app user are labelled New
+    UI_STATUSES = (
+        ('submitted', 'Submitted', [STATUS_NEW, STATUS_PENDING_AUTHORIZATION, STATUS_ASSIGNED, STATUS_RECEIVED, STATUS_SOURCING]),
+        ('quoted', 'Quoted', [STATUS_QUOTED]),
+        ('closed', 'Closed', [STATUS_CLOSED_ACCEPTED, STATUS_CLOSED_CANCELED, STATUS_CLOSED_AUTHORIZER_DECLINED, STATUS_CLOSED_QUOTES_DECLINED]),
+    )
+
+    objects = OrderQuerySet.as_manager()
+
+    tracked_fields = ('status', 'buyer_id', 'category_id', 'subcategory_id')
+
     class Meta:
         verbose_name = _('orders')
         verbose_name_plural = _('orders')
         ordering = ["-date_created"]
+        index_together = ('company', 'date_created')
+        indexes = [GinIndex(fields=['attribute_values'])]
 
     def __unicode__(self):
         return 'ID: %s. Tracking No: %s' % (str(self.id), self.tracking_number, )
 
     def get_main_image(self):
+
+        # Annotated by OrderQuerySet.for_listing()
+        if hasattr(self, 'main_image_id'):
+            return OrderFile(id=self.main_image_id, order_id=self.id, file=self.main_image_file) if self.main_image_id else None
+
         return OrderFile.objects.filter(order=self).order_by('id').first()
 
+    def get_currency_sign(self):
+        return self.currency_sign if hasattr(self, 'currency_sign') else self.currency.sign
+
     def get_estimated_value(self):
 
         if not self.estimated_value:
             return "Don't know"
 
-        return "%s %s" % (self.currency.sign, intcomma("%.2f" % (float(self.estimated_value) / 1)))
+        return "%s %s" % (self.get_currency_sign(), intcomma("%.2f" % (float(self.estimated_value) / 1)))
 
     def get_expected_value(self):
 
         if not self.estimated_value:
             return "0"
 
-        return "%s %s" % (self.currency.sign, intcomma("%.2f" % float(self.estimated_value * self.quantity)))
+        return "%s %s" % (self.get_currency_sign(), intcomma("%.2f" % float(self.estimated_value * self.quantity)))
 
     def get_expected_value_clear(self):
 
@@ -744,20 +1090,13 @@ class Order(HasCompany, Misc):
             'label': 'Not Submitted'
         }
 
-        if self.status in [Order.STATUS_NEW, Order.STATUS_PENDING_AUTHORIZATION, Order.STATUS_ASSIGNED, Order.STATUS_RECEIVED, Order.STATUS_SOURCING]:
-            ui_status_info['value'] = 'submitted'
-            ui_status_info['label'] = 'Submitted'
-
-        elif self.status in [Order.STATUS_QUOTED]:
-            ui_status_info['value'] = 'quoted'
-            ui_status_info['label'] = 'Quoted'
+        for value, label, statuses in self.UI_STATUSES:
+            if self.status in statuses:
+                ui_status_info['value'] = value
+                ui_status_info['label'] = label
 
-            if not self.viewed_by_app_user:
-                ui_status_info['label'] = 'New'
-
-        elif self.status in [Order.STATUS_CLOSED_ACCEPTED, Order.STATUS_CLOSED_CANCELED, Order.STATUS_CLOSED_AUTHORIZER_DECLINED, Order.STATUS_CLOSED_QUOTES_DECLINED]:
-            ui_status_info['value'] = 'closed'
-            ui_status_info['label'] = 'Closed'
+        if ui_status_info['value'] == 'quoted' and not self.viewed_by_app_user:
+            ui_status_info['label'] = 'New'
 
         return ui_status_info
 
@@ -786,43 +1125,32 @@ class Order(HasCompany, Misc):
 
         # The baseline spend is the amount given in the request and the savings is the difference between lowest quote and the baseline spend
 
-        baseline = self.get_expected_value_clear()
+        baseline = round(self.estimated_value * self.quantity, 2) if self.estimated_value else 0
         # lowest_quote = Quote.objects.filter(order=self).order_by('value').first()
-        accepted_quote = Quote.objects.filter(order=self, accepted=True).first()
+        if hasattr(self, 'accepted_quote_value'):
+            accepted_value = self.accepted_quote_value
+        else:
+            accepted_value = Quote.objects.filter(order=self, accepted=True).values_list('value', flat=True).first()
         savings_amount = None
 
-        if accepted_quote:
-            savings_amount = round(float(baseline) - accepted_quote.value * self.quantity, 2)
+        if accepted_value is not None:
+            savings_amount = round(baseline - accepted_value * self.quantity, 2)
 
         return savings_amount
 
     @property
     def attributes(self):
-        result = {}
+        values = [(v.product_attribute_id, v.value, v.is_manual) for v in self.order_values.all()]
+        return json.dumps(build_attributes_dict(values, hide_item_name_id=True))
 
-        for attribute in ProductAttribute.objects.filter(is_custom=False):
-            result[slugify(attribute.title.lower()).replace('-', '_')] = {
-                'is_custom': attribute.is_custom,
-                'id': attribute.id,
-            }
-
-        for value in self.order_values.all():
-            if value.product_attribute.is_custom:
-                result[slugify(value.product_attribute.title.lower()).replace('-', '_')] = {
-                    'value': value.value,
-                    'is_manual': value.is_manual,
-                    'is_custom': value.product_attribute.is_custom,
-                    'id': value.product_attribute.id if value.product_attribute.title != 'Item name' else -1,
-                }
-            else:
-                result[slugify(value.product_attribute.title.lower()).replace('-', '_')].update({
-                    'value': value.value,
-                    'is_manual': value.is_manual,
-                })
-        return json.dumps(result)
+    @classmethod
+    def bulk_attributes(cls, orders):
+        # {order_id: attributes dict} for a whole list/queryset of orders in a single values query
+        return bulk_build_attributes_dicts('order_id', orders, hide_item_name_id=True)
 
 
 class OrderImage(models.Model):
+    # Rotated on upload, before it is stored. The '50' thumbnail and the dimensions are filled by a MediaJob
 
     from vitesse_prod.apps.general_functions.functions import set_file_name
 
@@ -849,15 +1177,13 @@ class OrderImage(models.Model):
 
     def save(self, *args, **kwargs):
 
-        if self.image:
+        # A new upload, the stored file already is
+        if self.image and not self.image._committed:
             from vitesse_prod.apps.general_functions.functions import rotate_image
             rotate_image(self.image)
 
         super(OrderImage, self).save(*args, **kwargs)
 
-        if self.image:
-            OrderImage.objects.filter(id=self.id).update(thumbnail=get_thumbnailer(self.image)['50'])
-
 
 class OrderFile(models.Model):
 
@@ -995,6 +1321,22 @@ class OrderSavings(models.Model):
         return '%i. %s. %s' % (self.id, self.order, self.get_type_display())
 
 
+class OrderSavingsRun(models.Model):
+    # Bookkeeping of savings.recompute_order_savings(), the incremental mode starts from the last finished run
+
+    company = models.ForeignKey('Company', related_name='order_savings_runs')
+    is_incremental = models.BooleanField(default=False)
+    orders_processed = models.IntegerField(default=0)
+    date_started = models.DateTimeField()
+    date_finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-date_started']
+
+    def __unicode__(self):
+        return '%i. %s. %s' % (self.id, self.company_id, self.date_started)
+
+
 class OrderSavingsLevelApplied(models.Model):
 
     TYPE_PRICE_NEGOTIATION = 1
@@ -1097,10 +1439,16 @@ class OrderLine(models.Model):
 
     raw_description = models.TextField(null=True, blank=True)
 
+    # {attribute slug: case-folded values} of order_line_values, kept by attribute_projection
+    attribute_values = JSONField(default=dict, blank=True)
+
+    objects = AttributeValuesQuerySet.as_manager()
+
     class Meta:
         verbose_name = _('order lines')
         verbose_name_plural = _('order lines')
         ordering = ["id"]
+        indexes = [GinIndex(fields=['attribute_values'])]
 
     def __unicode__(self):
         return 'ID: %s. Order No: %s. Session ID: %s' % (self.id, self.order_id, self.session_id,)
@@ -1150,28 +1498,49 @@ class OrderLine(models.Model):
 
     @property
     def raw_attributes(self):
-        result = {}
-        for attribute in ProductAttribute.objects.filter(is_custom=False):
-            result[slugify(attribute.title.lower()).replace('-', '_')] = {
-                'is_custom': attribute.is_custom,
-                'id': attribute.id,
-            }
+        values = [(v.product_attribute_id, v.value, v.is_manual) for v in self.order_line_values.all()]
+        return build_attributes_dict(values)
 
-        for value in self.order_line_values.all():
-            if value.product_attribute.is_custom:
-                result[slugify(value.product_attribute.title.lower()).replace('-', '_')] = {
-                    'value': value.value,
-                    'is_manual': value.is_manual,
-                    'is_custom': value.product_attribute.is_custom,
-                    'id': value.product_attribute.id,
-                }
-            else:
-                result[slugify(value.product_attribute.title.lower()).replace('-', '_')].update({
-                    'value': value.value,
-                    'is_manual': value.is_manual,
-                })
-        # return json.dumps(result)
-        return result
+    @classmethod
+    def bulk_raw_attributes(cls, order_lines):
+        # {order_line_id: attributes dict} for a whole list/queryset of order lines in a single values query
+        return bulk_build_attributes_dicts('order_line_id', order_lines)
+
+
+class QuoteRankingQueryset(models.QuerySet):
+    # Shared by Quote and SupplierQuote: per order ranking over the filtered rows, one query, no GROUP BY
+
+    def with_ranking(self):
+
+        currency_rates = get_currency_rate_table()
+        gbp_rate = Case(
+            *[When(order__currency_id=currency_id, then=Value(rate)) for currency_id, rate in currency_rates.items()],
+            default=Value(None),
+            output_field=FloatField()
+        )
+
+        return self.annotate(
+            order_rank=WindowFunc('RANK', partition_by=['order_id'], order_by=['value'], output_field=IntegerField()),
+            order_cheapest_value=WindowFunc('MIN', [F('value')], partition_by=['order_id'], output_field=FloatField()),
+            order_quotes_count=WindowFunc('COUNT', [F('id')], partition_by=['order_id'], output_field=IntegerField()),
+        ).annotate(
+            is_order_cheapest=Case(
+                When(value=F('order_cheapest_value'), then=Value(True)), default=Value(False), output_field=BooleanField()
+            ),
+            delta_to_cheapest=ExpressionWrapper(F('value') - F('order_cheapest_value'), output_field=FloatField()),
+            total_gbp=ExpressionWrapper(F('value') * F('order__quantity') * gbp_rate, output_field=FloatField()),
+        )
+
+    def sync_ranks(self):
+        # Persists order_rank into the hand maintained rank column with one UPDATE
+
+        ranks = list(self.with_ranking().values_list('id', 'order_rank'))
+        if not ranks:
+            return 0
+
+        return self.model.objects.filter(id__in=[quote_id for quote_id, rank in ranks]).update(
+            rank=Case(*[When(id=quote_id, then=Value(rank)) for quote_id, rank in ranks], output_field=IntegerField())
+        )
 
 
 class Quote(models.Model):
@@ -1194,6 +1563,9 @@ class Quote(models.Model):
 
     supplier_quote = models.ForeignKey('SupplierQuote', null=True, blank=True)
     date_created = models.DateTimeField(auto_now_add=True)
+    date_edited = models.DateTimeField(auto_now=True, null=True, db_index=True)
+
+    objects = QuoteRankingQueryset.as_manager()
 
     def __unicode__(self):
         return '%i. %s' % (self.id, self.description[:200])
@@ -1204,17 +1576,64 @@ class Quote(models.Model):
 
     @property
     def total_value_gbp(self):
-        from vitesse_prod.apps.general_functions.functions import get_currency_rate
-        return self.value_total * get_currency_rate(self.order.currency.name)
+        return convert_to_gbp(self.value_total, self.order.currency_id)
+
+    @classmethod
+    def bulk_total_value_gbp(cls, queryset):
+        # {id: total_value_gbp} in one query instead of order/currency lookups per object
+        rows = list(queryset.values_list('id', 'value', 'order__quantity', 'order__currency_id'))
+        totals = convert_to_gbp_bulk(
+            (round(value * quantity, 2), currency_id) for _id, value, quantity, currency_id in rows
+        )
+        return dict(zip([row[0] for row in rows], totals))
 
     @property
     def total_value_gbp_int(self):
         return int(self.total_value_gbp * 100)
 
     def is_cheapest(self):
+
+        # Annotated by with_ranking()
+        if hasattr(self, 'is_order_cheapest'):
+            return self.is_order_cheapest
+
         return self.value == Quote.objects.filter(order=self.order).order_by('value')[0].value
 
 
+class OrderBestQuote(models.Model):
+    # Materialized cheapest quote per order, refreshed by the Quote signals when settings.ORDER_BEST_QUOTE_TABLE is on
+
+    order = models.OneToOneField('Order', related_name='order_best_quote')
+    quote = models.ForeignKey('Quote', related_name='+')
+    value = models.FloatField()
+    quotes_count = models.IntegerField(default=1)
+    date_updated = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return '%s. %s. %0.2f' % (self.order_id, self.quote_id, self.value)
+
+
+def refresh_order_best_quotes(order_ids=None):
+    # Rebuilds the OrderBestQuote rows of order_ids (all orders if None) in 3 queries
+
+    quotes = Quote.objects.all() if order_ids is None else Quote.objects.filter(order_id__in=order_ids)
+
+    counts = dict(quotes.order_by().values('order_id').annotate(count=Count('id')).values_list('order_id', 'count'))
+    best_quotes = [
+        OrderBestQuote(order_id=order_id, quote_id=quote_id, value=value, quotes_count=counts[order_id])
+        for order_id, quote_id, value in quotes.order_by('order_id', 'value', 'id').distinct('order_id').values_list(
+            'order_id', 'id', 'value'
+        )
+    ]
+
+    with transaction.atomic():
+        stale = OrderBestQuote.objects.all() if order_ids is None else OrderBestQuote.objects.filter(order_id__in=order_ids)
+        stale.delete()
+        OrderBestQuote.objects.bulk_create(best_quotes)
+
+    return len(best_quotes)
+
+
 class QuoteRecommendation(models.Model):
 
     quote = models.OneToOneField('Quote', related_name='quote_recommendation')
@@ -1272,6 +1691,104 @@ class QuoteSupportingDocument(models.Model):
         return '%s. %s' % (self.quote, self.file)
 
 
+def render_supplier_header_info(header_info, supplier, order):
+
+    templates = {
+        '[VENDOR NAME]': supplier.company_name,
+        '[COMPANY]': order.company.name,
+        '[BUYER EMAIL]': order.buyer.email
+    }
+
+    supplier_header_info = header_info
+
+    for template, value in templates.items():
+        supplier_header_info = supplier_header_info.replace(template, value)
+
+    return supplier_header_info
+
+
+class SupplierQuoteManager(models.Manager.from_queryset(QuoteRankingQueryset)):
+
+    def dispatch_rfq(self, order, suppliers, **fields):
+        """
+        Sends the order's RFQ to all suppliers at once: supplier quotes and their tokens are bulk created
+        in one transaction, the header template is rendered against one order/company/buyer lookup.
+        fields: SupplierQuote field values shared by all quotes (header_info, item_description, ...)
+        Returns [(supplier_quote, token)]
+        """
+
+        order = Order.objects.select_related('company', 'buyer').get(id=order.id if isinstance(order, Order) else order)
+        supplier_ids = [supplier.id if isinstance(supplier, Supplier) else supplier for supplier in suppliers]
+
+        header_info = fields.get('header_info')
+        date_created = datetime.datetime.utcnow()
+
+        with transaction.atomic():
+            supplier_quotes = []
+            for supplier in Supplier.objects.filter(id__in=supplier_ids).only('id', 'company_name'):
+                supplier_quote = SupplierQuote(order=order, supplier=supplier, date_created=date_created, **fields)
+
+                if header_info:
+                    supplier_quote.supplier_header_info = render_supplier_header_info(header_info, supplier, order)
+
+                supplier_quotes.append(supplier_quote)
+
+            # Postgres returns the ids of bulk created rows
+            supplier_quotes = self.bulk_create(supplier_quotes)
+
+            tokens = SupplierQuoteToken.objects.bulk_create([
+                SupplierQuoteToken(supplier_quote=supplier_quote, token=SupplierQuoteToken.generate_token())
+                for supplier_quote in supplier_quotes
+            ])
+
+        return list(zip(supplier_quotes, tokens))
+
+
+class MediaJob(models.Model):
+    # One record per stored file (kind, object_id), processed by media_processing.process_media_job.
+    # Re-queued only when the file name changes, so saving the same upload twice does the work once
+
+    KIND_ORDER_IMAGE = 'order_image'
+    KIND_ORDER_FILE = 'order_file'
+    KIND_EXPENSE_CLAIM_PHOTO = 'expense_claim_photo'
+
+    KIND_CHOICES = (
+        (KIND_ORDER_IMAGE, 'Order Image'),
+        (KIND_ORDER_FILE, 'Order File'),
+        (KIND_EXPENSE_CLAIM_PHOTO, 'Expense Claim Photo'),
+    )
+
+    STATUS_PENDING = 0
+    STATUS_RUNNING = 1
+    STATUS_DONE = 2
+    STATUS_FAILED = 3
+
+    STATUS_CHOICES = (
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    )
+
+    kind = models.CharField(max_length=50, choices=KIND_CHOICES)
+    object_id = models.IntegerField()
+    file_name = models.CharField(max_length=255)
+
+    status = models.SmallIntegerField(choices=STATUS_CHOICES, default=STATUS_PENDING, db_index=True)
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(default='', blank=True)
+
+    date_created = models.DateTimeField(auto_now_add=True)
+    date_started = models.DateTimeField(null=True, blank=True)
+    date_finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = ('kind', 'object_id')
+
+    def __unicode__(self):
+        return '%i. %s %s. %s' % (self.id, self.kind, self.object_id, self.get_status_display())
+
+
 class SupplierQuote(models.Model):
 
     from vitesse_prod.apps.general_functions.functions import set_file_name
@@ -1290,6 +1807,8 @@ class SupplierQuote(models.Model):
         (SUPPLIER_PROCESS_STATUS_ACCEPTED, 'Accepted'),
     )
 
+    QUOTED_PROCESS_STATUSES = (SUPPLIER_PROCESS_STATUS_QUOTED, SUPPLIER_PROCESS_STATUS_ACCEPTED)
+
     order = models.ForeignKey('Order', related_name='order_supplier_quotes')
     supplier = models.ForeignKey('Supplier', related_name='supplier_supplier_quotes')
 
@@ -1317,6 +1836,8 @@ class SupplierQuote(models.Model):
     is_attachments_processed_by_buyer = models.BooleanField(default=False)
     exact_match_provided = models.BooleanField(default=False)
 
+    objects = SupplierQuoteManager()
+
     def __unicode__(self):
         return '%i. %s' % (self.id, self.order)
 
@@ -1326,18 +1847,7 @@ class SupplierQuote(models.Model):
             self.date_created = datetime.datetime.utcnow()
 
         if self.header_info:
-            templates = {
-                '[VENDOR NAME]': self.supplier.company_name,
-                '[COMPANY]': self.order.company.name,
-                '[BUYER EMAIL]': self.order.buyer.email
-            }
-
-            supplier_header_info = self.header_info
-
-            for template, value in templates.items():
-                supplier_header_info = supplier_header_info.replace(template, value)
-
-            self.supplier_header_info = supplier_header_info
+            self.supplier_header_info = render_supplier_header_info(self.header_info, self.supplier, self.order)
 
         super(SupplierQuote, self).save(*args, **kwargs)
 
@@ -1347,8 +1857,16 @@ class SupplierQuote(models.Model):
 
     @property
     def total_value_gbp(self):
-        from vitesse_prod.apps.general_functions.functions import get_currency_rate
-        return self.value_total * get_currency_rate(self.order.currency.name)
+        return convert_to_gbp(self.value_total, self.order.currency_id)
+
+    @classmethod
+    def bulk_total_value_gbp(cls, queryset):
+        # {id: total_value_gbp} in one query instead of order/currency lookups per object
+        rows = list(queryset.values_list('id', 'value', 'order__quantity', 'order__currency_id'))
+        totals = convert_to_gbp_bulk(
+            (round(value * quantity, 2), currency_id) for _id, value, quantity, currency_id in rows
+        )
+        return dict(zip([row[0] for row in rows], totals))
 
     @property
     def total_value_gbp_int(self):
@@ -1471,7 +1989,7 @@ class SupplierQuoteEndFile(models.Model):
 class SupplierQuoteToken(models.Model):
     supplier_quote = models.ForeignKey('SupplierQuote')
 
-    token = models.TextField()
+    token = models.TextField(unique=True)
 
     is_active = models.BooleanField(default=True)  # Becomes False once SupplierQuite processed by supplier
     date_created = models.DateTimeField(auto_now_add=True)
@@ -1488,19 +2006,15 @@ class SupplierQuoteToken(models.Model):
         return self.is_active and self.supplier_quote.order.buyer_deadline >= utc_now
                # and utc_now <= self.date_created + datetime.timedelta(days=3)
 
-    def generate_token(self):
-        return hashlib.sha512(str(self.__class__.__name__) + str(self.id) + str(datetime.datetime.utcnow())).hexdigest()
+    @staticmethod
+    def generate_token():
+        # 512 random bits, collisions are not a practical concern and the unique index backs it up
+        return hashlib.sha512(os.urandom(64)).hexdigest()
 
     def save(self, *args, **kwargs):
 
         if not self.token:
-
-            generated_token = self.generate_token()
-
-            while SupplierQuoteToken.objects.filter(token=generated_token).exists():
-                generated_token = self.generate_token()
-
-            self.token = generated_token
+            self.token = self.generate_token()
 
         super(SupplierQuoteToken, self).save(*args, **kwargs)
 
@@ -1727,6 +2241,24 @@ class OrderSuggestedSupplier(models.Model):
         return '%i. %s' % (self.id, self.order.app_user.name)
 
 
+class SupplierRoute(models.Model):
+    # Ranked supplier ids for new orders of (company, category, subcategory), built by supplier_routing.
+    # company is null for the routes of the Supplier.category/subcategory links alone, used by companies
+    # with no suppliers or history of their own for the category
+
+    company = models.ForeignKey('Company', null=True, blank=True, related_name='supplier_routes')
+    category = models.ForeignKey('Category', related_name='+')
+    subcategory = models.ForeignKey('Subcategory', null=True, blank=True, related_name='+')
+    supplier_ids = ArrayField(models.IntegerField(), default=list)
+    date_updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        index_together = ('category', 'company', 'subcategory')
+
+    def __unicode__(self):
+        return '%i. %s. %s. %s' % (self.id, self.company_id, self.category_id, self.subcategory_id)
+
+
 class DeviceToken(models.Model):
 
     token = models.CharField(max_length=255)
@@ -1996,8 +2528,7 @@ class ItineraryQuote(models.Model):
 
     @property
     def total_value_gbp(self):
-        from vitesse_prod.apps.general_functions.functions import get_currency_rate
-        return self.value * get_currency_rate(self.itinerary.currency.name)
+        return convert_to_gbp(self.value, self.itinerary.currency_id)
 
 
 class SignupToken(models.Model):
@@ -2082,6 +2613,9 @@ class ExpenseClaim(models.Model):
     date_created = models.DateTimeField(auto_now_add=True)
     date_edited = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        index_together = ('user', 'date')
+
     def __unicode__(self):
         return '%i. %s' % (self.id, self.description)
 
@@ -2151,6 +2685,9 @@ class Mileage(models.Model):
     date_created = models.DateTimeField(auto_now_add=True)
     date_edited = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        index_together = ('user', 'date')
+
     def __unicode__(self):
         return '%i. %s' % (self.id, self.description)
 
@@ -2210,27 +2747,160 @@ class CurrencyRate(models.Model):
         return '%i.' % (self.id, )
 
 
-class Purchase(models.Model):
+# CURRENCY RATE TABLE
 
-    user = models.ForeignKey('User', related_name='user_purchases')
-    quote = models.ForeignKey('Quote', null=True, blank=True)
-    itinerary_quote = models.ForeignKey('ItineraryQuote', null=True, blank=True)
-    activity_quote = models.ForeignKey('ActivityQuote', null=True, blank=True)
+# In-memory {currency_id: rate to GBP} built from CurrencyRate once per CurrencyRate version
+# (last_date_updated). Dropped by the CurrencyRate post_save signal in this process, other
+# processes pick up the new version on their next check.
+CURRENCY_RATE_VERSION_CHECK_INTERVAL = 60
 
-    sum_paid = models.FloatField()
-    braintree_transaction_token = models.CharField(max_length=255, blank=True, default='')
+_currency_rate_table = {'version': None, 'rates': {}, 'checked_at': 0}
 
-    is_deleted = models.BooleanField(default=False)
-    date_created = models.DateTimeField(auto_now_add=True)
 
-    def __unicode__(self):
-        return '%i.' % (self.id, )
+def get_currency_rate_version():
+    return CurrencyRate.objects.order_by('-last_date_updated').values_list('last_date_updated', flat=True).first()
 
 
-class UserAPIAnalyticsTime(models.Model):
+def get_rate_from_data(data, name):
+    # CurrencyRate.data: {currency name: rate to GBP}, GBP itself is not listed
+    return float(data.get(name, 1.0))
 
-    index = models.IntegerField(default=1)
-    label = models.CharField(max_length=255)
+
+def get_currency_rate_table(refresh=False):
+
+    table = _currency_rate_table
+    now = time.time()
+
+    if not refresh and table['version'] is not None and now - table['checked_at'] < CURRENCY_RATE_VERSION_CHECK_INTERVAL:
+        return table['rates']
+
+    version = get_currency_rate_version()
+    table['checked_at'] = now
+
+    if refresh or version != table['version'] or not table['rates']:
+        # The rates of every currency come from one read of the row the version is taken from
+        row = CurrencyRate.objects.order_by('-last_date_updated').values('data', 'last_date_updated').first() or {}
+        data = json.loads(row.get('data') or '{}')
+
+        table['rates'] = dict(
+            (currency_id, get_rate_from_data(data, name))
+            for currency_id, name in Currency.objects.values_list('id', 'name')
+        )
+        table['version'] = row.get('last_date_updated')
+
+    return table['rates']
+
+
+def invalidate_currency_rate_table(*args, **kwargs):
+    _currency_rate_table['version'] = None
+
+
+def get_currency_rate_by_id(currency_id):
+
+    rates = get_currency_rate_table()
+
+    # Currency created after the table was built
+    if currency_id not in rates:
+        rates = get_currency_rate_table(refresh=True)
+
+    return rates[currency_id]
+
+
+def convert_to_gbp(value, currency_id):
+    return value * get_currency_rate_by_id(currency_id)
+
+
+def convert_to_gbp_bulk(pairs):
+    # pairs: iterable of (value, currency_id). Returns list of GBP values in the same order
+
+    pairs = list(pairs)
+    rates = get_currency_rate_table()
+
+    if any(currency_id not in rates for value, currency_id in pairs):
+        rates = get_currency_rate_table(refresh=True)
+
+    return [value * rates[currency_id] for value, currency_id in pairs]
+
+
+class CurrencyConversionJob(models.Model):
+    # Re-denominates user's ExpenseClaim.value / Mileage.cost_per_mile after a default_currency change,
+    # in primary key chunks, with one rate snapshot. Processed by currency_conversion.run_currency_conversion_jobs
+
+    STATUS_PENDING = 0
+    STATUS_RUNNING = 1
+    STATUS_DONE = 2
+    STATUS_FAILED = 3
+
+    STATUS_CHOICES = (
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    )
+
+    user = models.ForeignKey('User', related_name='user_currency_conversion_jobs')
+    old_currency = models.ForeignKey('Currency', related_name='+')
+    new_currency = models.ForeignKey('Currency', related_name='+')
+    rate = models.FloatField()
+
+    # Rows created after the change are already in the new currency
+    max_expense_claim_id = models.IntegerField(default=0)
+    max_mileage_id = models.IntegerField(default=0)
+
+    last_expense_claim_id = models.IntegerField(default=0)
+    last_mileage_id = models.IntegerField(default=0)
+
+    expense_claims_total = models.IntegerField(default=0)
+    expense_claims_processed = models.IntegerField(default=0)
+    mileages_total = models.IntegerField(default=0)
+    mileages_processed = models.IntegerField(default=0)
+
+    status = models.SmallIntegerField(choices=STATUS_CHOICES, default=STATUS_PENDING, db_index=True)
+    error = models.TextField(default='', blank=True)
+
+    date_created = models.DateTimeField(auto_now_add=True)
+    date_finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['id']
+
+    def __unicode__(self):
+        return '%i. %s. %s -> %s. %s' % (self.id, self.user_id, self.old_currency_id, self.new_currency_id, self.get_status_display())
+
+    @property
+    def progress(self):
+
+        total = self.expense_claims_total + self.mileages_total
+        if not total:
+            return 100.0
+
+        return round((self.expense_claims_processed + self.mileages_processed) * 100.0 / total, 1)
+
+
+class Purchase(models.Model):
+
+    user = models.ForeignKey('User', related_name='user_purchases')
+    quote = models.ForeignKey('Quote', null=True, blank=True)
+    itinerary_quote = models.ForeignKey('ItineraryQuote', null=True, blank=True)
+    activity_quote = models.ForeignKey('ActivityQuote', null=True, blank=True)
+
+    sum_paid = models.FloatField()
+    braintree_transaction_token = models.CharField(max_length=255, blank=True, default='')
+
+    is_deleted = models.BooleanField(default=False)
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        index_together = ('user', 'date_created')
+
+    def __unicode__(self):
+        return '%i.' % (self.id, )
+
+
+class UserAPIAnalyticsTime(models.Model):
+
+    index = models.IntegerField(default=1)
+    label = models.CharField(max_length=255)
     command = models.CharField(max_length=255)
 
     def __unicode__(self):
@@ -2292,6 +2962,12 @@ class UserAPIAnalyticsFilters(models.Model):
 
         return self
 
+    def get_spend_summary(self, group_by=()):
+
+        from vitesse_prod.apps.db.analytics import get_analytics_filters_summary
+
+        return get_analytics_filters_summary(self, group_by=group_by)
+
     def update_filters(self, data):
 
         basic_data = {}
@@ -2349,9 +3025,47 @@ class UserAPIAnalyticsLocalFilters(models.Model):
         return filters
 
 
+class SpendRollup(models.Model):
+    # Daily spend per company and key, maintained by analytics.py. Amounts are in the row currency
+
+    SOURCE_ORDER = 'order'
+    SOURCE_PURCHASE = 'purchase'
+    SOURCE_EXPENSE_CLAIM = 'expense_claim'
+    SOURCE_MILEAGE = 'mileage'
+    SOURCE_ACTIVITY = 'activity'
+
+    SOURCE_CHOICES = (
+        (SOURCE_ORDER, 'Order'),
+        (SOURCE_PURCHASE, 'Purchase'),
+        (SOURCE_EXPENSE_CLAIM, 'Expense Claim'),
+        (SOURCE_MILEAGE, 'Mileage'),
+        (SOURCE_ACTIVITY, 'Activity'),
+    )
+
+    company = models.ForeignKey('Company', related_name='spend_rollups')
+    date = models.DateField()
+    source = models.CharField(max_length=20, choices=SOURCE_CHOICES)
+
+    user = models.ForeignKey('User', null=True, blank=True, related_name='+')
+    category = models.ForeignKey('Category', null=True, blank=True, related_name='+')
+    expense_field = models.ForeignKey('ExpenseClaimField', null=True, blank=True, related_name='+')
+    project = models.ForeignKey('ExpenseClaimProject', null=True, blank=True, related_name='+')
+    activity_type = models.CharField(max_length=100, default='', blank=True)
+    currency = models.ForeignKey('Currency', null=True, blank=True, related_name='+')
+
+    amount = models.FloatField(default=0)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        index_together = ('company', 'source', 'date')
+
+    def __unicode__(self):
+        return '%i. %s. %s. %s' % (self.id, self.company_id, self.date, self.source)
+
+
 # New Booking Section called "Activities"
 
-class Activity(HasCompany, Misc):
+class Activity(TrackedFieldsMixin, HasCompany, Misc):
 
     STATUS_NOT_SUBMITTED = 0
     STATUS_NEW = 1
@@ -2445,6 +3159,11 @@ class Activity(HasCompany, Misc):
     is_fixed = models.BooleanField(default=False)
     is_two_way = models.BooleanField(default=False)
 
+    tracked_fields = ('status', 'should_source')
+
+    class Meta:
+        index_together = ('company', 'date_created')
+
     def __unicode__(self):
         return '%i.' % (self.id, )
 
@@ -2551,8 +3270,7 @@ class ActivityQuote(models.Model):
 
     @property
     def total_value_gbp(self):
-        from vitesse_prod.apps.general_functions.functions import get_currency_rate
-        return self.value * get_currency_rate(self.activity.currency.name)
+        return convert_to_gbp(self.value, self.activity.currency_id)
 
     @property
     def total_value_gbp_int(self):
@@ -2598,6 +3316,105 @@ class PowerBICredentials(models.Model):
         return '%i. %s' % (self.id, self.data)
 
 
+NOTIFICATIONS_FEED_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+
+def encode_notifications_feed_cursor(notification):
+    # "<date_created in microseconds since epoch>_<id>"
+    delta = notification.date_created - NOTIFICATIONS_FEED_EPOCH
+    return '%i_%i' % ((delta.days * 86400 + delta.seconds) * 10 ** 6 + delta.microseconds, notification.id)
+
+
+def decode_notifications_feed_cursor(cursor):
+    try:
+        microseconds, notification_id = [int(part) for part in cursor.split('_')]
+    except (AttributeError, ValueError):
+        raise ValidationError('Invalid cursor', code='invalid')
+
+    return NOTIFICATIONS_FEED_EPOCH + datetime.timedelta(microseconds=microseconds), notification_id
+
+
+class ActivityNotificationQueryset(models.QuerySet):
+
+    def delete(self):
+        # post_delete fires per notification, update each user's counter once
+        with coalesce_unread_notifications_counts():
+            return super(ActivityNotificationQueryset, self).delete()
+
+    def feed(self, user, cursor=None, limit=50):
+        """
+        A page of user's notifications, newest first, rendered in 2 queries (notifications with
+        order/user_from/activity joined + one OrderReturnComment lookup for the returned orders).
+        Keyset pagination on (date_created, id): pass the returned next_cursor to get the next page.
+        """
+
+        queryset = self.filter(user_to=user).select_related('order', 'user_from', 'activity').order_by('-date_created', '-id')
+
+        if cursor:
+            date_created, notification_id = decode_notifications_feed_cursor(cursor)
+            queryset = queryset.filter(
+                Q(date_created__lt=date_created) | Q(date_created=date_created, id__lt=notification_id)
+            )
+
+        notifications = list(queryset[:limit + 1])
+        has_next = len(notifications) > limit
+        notifications = notifications[:limit]
+
+        returned_order_ids = [
+            n.order_id for n in notifications if n.type == ActivityNotification.TYPE_ORDER_BUYER_RETURNED and n.order_id
+        ]
+        if returned_order_ids:
+            comments = {}
+            # Buyer's comment wins when the end user replied as well
+            for order_id, comment in OrderReturnComment.objects.filter(order_id__in=returned_order_ids).order_by(
+                    '-direction').values_list('order_id', 'comment'):
+                comments[order_id] = comment
+
+            for notification in notifications:
+                if notification.order_id in comments:
+                    notification.__dict__['order_return_comment'] = comments[notification.order_id]
+
+        return {
+            'notifications': [{
+                'id': n.id,
+                'type': n.type,
+                'order_id': n.order_id,
+                'activity_id': n.activity_id,
+                'message': n.message,
+                'action_center_message': n.action_center_message,
+                'date_created': n.date_created,
+            } for n in notifications],
+            'next_cursor': encode_notifications_feed_cursor(notifications[-1]) if has_next else None
+        }
+
+    def bulk_notify(self, notifications, batch_size=None):
+        # bulk_create doesn't send post_save, counters are updated here with one UPDATE per distinct count
+
+        notifications = self.bulk_create(notifications, batch_size=batch_size)
+
+        deltas = {}
+        for notification in notifications:
+            deltas[notification.user_to_id] = deltas.get(notification.user_to_id, 0) + 1
+
+        with coalesce_unread_notifications_counts():
+            for user_id, delta in deltas.items():
+                add_unread_notifications_count(user_id, delta)
+
+        return notifications
+
+
+class ActivityNotificationManager(models.Manager):
+
+    def get_queryset(self):
+        return ActivityNotificationQueryset(self.model, using=self._db)
+
+    def feed(self, user, cursor=None, limit=50):
+        return self.get_queryset().feed(user, cursor=cursor, limit=limit)
+
+    def bulk_notify(self, notifications, batch_size=None):
+        return self.get_queryset().bulk_notify(notifications, batch_size=batch_size)
+
+
 class ActivityNotification(models.Model):
 
     TYPE_ORDER_DECLINED = 'order_declined'
@@ -2628,6 +3445,11 @@ class ActivityNotification(models.Model):
 
     date_created = models.DateTimeField(auto_now_add=True)
 
+    objects = ActivityNotificationManager()
+
+    class Meta:
+        index_together = ('user_to', 'date_created', 'id')
+
     def __unicode__(self):
         return '%i.' % (self.id,)
 
@@ -2649,27 +3471,13 @@ class ActivityNotification(models.Model):
             message_str = "Purchase #%s requires authorization" % self.order.tracking_number
 
         elif self.type == self.TYPE_ACTIVITY_RECEIVED_QUOTES:
-
-            activity_type_str = 'Travel Activity'
-            if self.activity.type == self.activity.TYPE_FLIGHT:
-                activity_type_str = 'flight'
-
-            elif self.activity.type == self.activity.TYPE_TRAIN:
-                activity_type_str = 'train ride'
-
-            elif self.activity.type == self.activity.TYPE_CAR_RENTAL:
-                activity_type_str = 'car rent'
-
-            elif self.activity.type == self.activity.TYPE_HOTEL:
-                activity_type_str = 'hotel booking'
-
-            message_str = "Your %s #%s has been quoted" % (activity_type_str, self.activity.tracking_number)
+            message_str = "Your %s #%s has been quoted" % (self.activity_type_str, self.activity.tracking_number)
 
         elif self.type == self.TYPE_SHARE_REPORT_WITH_YOU:
             message_str = "%s would like to see your reports" % self.user_from.get_full_name()
 
         elif self.type == self.TYPE_ORDER_BUYER_RETURNED:
-            message_str = 'Order has been returned by buyer. Tracking number: #%s.\nBuyer comment: %s' % (str(self.order.tracking_number), self.order.order_return_comment.get().comment)
+            message_str = 'Order has been returned by buyer. Tracking number: #%s.\nBuyer comment: %s' % (str(self.order.tracking_number), self.order_return_comment)
 
         return message_str
 
@@ -2691,21 +3499,7 @@ class ActivityNotification(models.Model):
             message_str = "Request #%s requires authorization" % self.order.tracking_number
 
         elif self.type == self.TYPE_ACTIVITY_RECEIVED_QUOTES:
-
-            activity_type_str = 'Travel Activity'
-            if self.activity.type == self.activity.TYPE_FLIGHT:
-                activity_type_str = 'flight'
-
-            elif self.activity.type == self.activity.TYPE_TRAIN:
-                activity_type_str = 'train ride'
-
-            elif self.activity.type == self.activity.TYPE_CAR_RENTAL:
-                activity_type_str = 'car rent'
-
-            elif self.activity.type == self.activity.TYPE_HOTEL:
-                activity_type_str = 'hotel booking'
-
-            message_str = "Your %s #%s has been quoted" % (activity_type_str, self.activity.tracking_number)
+            message_str = "Your %s #%s has been quoted" % (self.activity_type_str, self.activity.tracking_number)
 
         elif self.type == self.TYPE_SHARE_REPORT_WITH_YOU:
             message_str = "%s would like to see your reports" % self.user_from.get_full_name()
@@ -2715,6 +3509,29 @@ class ActivityNotification(models.Model):
 
         return message_str
 
+    @property
+    def activity_type_str(self):
+
+        activity_type_str = 'Travel Activity'
+        if self.activity.type == self.activity.TYPE_FLIGHT:
+            activity_type_str = 'flight'
+
+        elif self.activity.type == self.activity.TYPE_TRAIN:
+            activity_type_str = 'train ride'
+
+        elif self.activity.type == self.activity.TYPE_CAR_RENTAL:
+            activity_type_str = 'car rent'
+
+        elif self.activity.type == self.activity.TYPE_HOTEL:
+            activity_type_str = 'hotel booking'
+
+        return activity_type_str
+
+    @cached_property
+    def order_return_comment(self):
+        # Preset by ActivityNotificationQueryset.feed() for the whole page
+        return self.order.order_return_comment.get().comment
+
 
 class UserExpensesReminderLog(models.Model):
 
@@ -2780,6 +3597,12 @@ class BestDeal(models.Model):
         return self.short_description
 
 
+class CatalogQuerySet(models.QuerySet):
+
+    def visible_to(self, user):
+        return self.filter(id__in=user.get_visible_catalog_ids())
+
+
 class Catalog(models.Model):
 
     file_name = models.TextField()
@@ -2788,11 +3611,27 @@ class Catalog(models.Model):
     users = models.ManyToManyField('User', blank=True, related_name='user_catalogs')
     date_created = models.DateTimeField(auto_now_add=True)
 
+    objects = CatalogQuerySet.as_manager()
+
     def __unicode__(self):
         return "%s. %s." % (self.file_name, self.date_created)
 
 
-class CatalogItem(models.Model):
+class UserCatalogVisibility(models.Model):
+    # Catalogs visible to a user: shared with the user or with the user's company. Rebuilt per user
+    # by rebuild_catalog_visibility() on Catalog.users/companies and User.company changes
+
+    user = models.ForeignKey('User', related_name='catalog_visibilities')
+    catalog = models.ForeignKey('Catalog', related_name='user_visibilities')
+
+    class Meta:
+        unique_together = ('user', 'catalog')
+
+    def __unicode__(self):
+        return '%i. %s. %s' % (self.id, self.user_id, self.catalog_id)
+
+
+class CatalogItem(TrackedFieldsMixin, models.Model):
 
     supplier_name = models.TextField()
     title = models.TextField()
@@ -2821,29 +3660,144 @@ class CatalogItem(models.Model):
 
     is_active = models.BooleanField(default=True)
 
+    # Weighted tsvector of the text fields, kept by catalog_search.update_catalog_search_vectors
+    search_vector = SearchVectorField(null=True, blank=True)
+
+    tracked_fields = ('catalog_id', 'is_active')
+
     class Meta:
         verbose_name = _('catalog item')
         verbose_name_plural = _('catalog items')
+        indexes = [GinIndex(fields=['search_vector'])]
 
     def __unicode__(self):
         return self.title
 
+    def delete(self, *args, **kwargs):
+        # Not a receiver, so the queryset deletes (i.e. a catalog re-import) stay fast and invalidate once per catalog
+        result = super(CatalogItem, self).delete(*args, **kwargs)
+        invalidate_catalog_users_visibility([self.catalog_id])
+        return result
+
     @property
     def description(self):
         return '.'.join([self.short_description, self.long_description])
 
     def has_valid_image_url(self):
 
-        is_image = False
-        image_formats = ("image/png", "image/jpeg", "image/gif")
-        try:
-            site = requests.get(self.image_url)
-        except:
-            pass
-        else:
-            if site.headers['content-type'] in image_formats:  # check if the content-type is a image
-                is_image = True
-        return is_image
+        from vitesse_prod.apps.db.image_validation import validate_image_urls
+
+        return validate_image_urls([self.image_url]).get(self.image_url, False)
+
+    @classmethod
+    def bulk_has_valid_image_url(cls, catalog_items, **kwargs):
+        # {catalog_item_id: is valid}, the urls are checked concurrently and the results cached by ImageUrlCheck
+
+        from vitesse_prod.apps.db.image_validation import validate_image_urls
+
+        catalog_items = list(catalog_items)
+        results = validate_image_urls(set(item.image_url for item in catalog_items), **kwargs)
+
+        return dict((item.id, results.get(item.image_url, False)) for item in catalog_items)
+
+
+class ImageUrlCheck(models.Model):
+    # Cached result of image_validation.check_image_url per url, revalidated with the stored ETag.
+    # mirror is a local thumbnail of the image as of mirror_etag
+
+    from vitesse_prod.apps.general_functions.functions import set_file_name
+
+    url_hash = models.CharField(max_length=64, unique=True)
+    url = models.TextField()
+
+    is_valid = models.BooleanField(default=False)
+    status_code = models.IntegerField(null=True, blank=True)
+    content_type = models.CharField(max_length=255, default='', blank=True)
+    etag = models.CharField(max_length=255, default='', blank=True)
+    error = models.TextField(default='', blank=True)
+    date_checked = models.DateTimeField()
+
+    mirror = models.FileField(upload_to=set_file_name, max_length=255, blank=True, default='')
+    mirror_etag = models.CharField(max_length=255, default='', blank=True)
+
+    def __unicode__(self):
+        return '%i. %s. %s' % (self.id, self.url, self.is_valid)
+
+    @staticmethod
+    def hash_url(url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+
+# CATALOG VISIBILITY INDEX
+
+# Per user {'catalog_ids', 'has_items'} in the shared cache, read from UserCatalogVisibility.
+# Deleted whenever the user's index rows or the items of one of the user's catalogs change.
+CATALOG_VISIBILITY_CACHE_TTL = 60 * 60
+
+
+def get_catalog_visibility_cache_key(user_id):
+    return 'catalog_visibility:%s' % user_id
+
+
+def get_catalog_visibility(user_id):
+
+    key = get_catalog_visibility_cache_key(user_id)
+    visibility = cache.get(key)
+
+    if visibility is None:
+        catalog_ids = list(UserCatalogVisibility.objects.filter(user_id=user_id).values_list('catalog_id', flat=True))
+        visibility = {
+            'catalog_ids': catalog_ids,
+            'has_items': bool(catalog_ids) and CatalogItem.objects.filter(catalog_id__in=catalog_ids).exists(),
+        }
+        cache.set(key, visibility, CATALOG_VISIBILITY_CACHE_TTL)
+
+    return visibility
+
+
+def invalidate_catalog_visibility(user_ids):
+    cache.delete_many([get_catalog_visibility_cache_key(user_id) for user_id in set(user_ids)])
+
+
+def invalidate_catalog_users_visibility(catalog_ids):
+    invalidate_catalog_visibility(
+        UserCatalogVisibility.objects.filter(catalog_id__in=catalog_ids).values_list('user_id', flat=True)
+    )
+
+
+def rebuild_catalog_visibility(user_ids):
+
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+
+    company_ids = dict(User.objects.filter(id__in=user_ids).values_list('id', 'company_id'))
+
+    company_catalog_ids = {}
+    for company_id, catalog_id in Catalog.companies.through.objects.filter(
+            company_id__in=set(company_ids.values())).values_list('company_id', 'catalog_id'):
+        company_catalog_ids.setdefault(company_id, set()).add(catalog_id)
+
+    pairs = set(Catalog.users.through.objects.filter(user_id__in=user_ids).values_list('user_id', 'catalog_id'))
+    for user_id, company_id in company_ids.items():
+        pairs.update((user_id, catalog_id) for catalog_id in company_catalog_ids.get(company_id, ()))
+
+    with transaction.atomic():
+        UserCatalogVisibility.objects.filter(user_id__in=user_ids).delete()
+        UserCatalogVisibility.objects.bulk_create(
+            [UserCatalogVisibility(user_id=user_id, catalog_id=catalog_id) for user_id, catalog_id in pairs]
+        )
+
+    # Again after the commit, other processes may have cached the old rows meanwhile
+    invalidate_catalog_visibility(user_ids)
+    transaction.on_commit(lambda: invalidate_catalog_visibility(user_ids))
+
+
+def rebuild_all_catalog_visibility(chunk_size=1000):
+
+    user_ids = list(User.objects.order_by('id').values_list('id', flat=True))
+    for start in range(0, len(user_ids), chunk_size):
+        rebuild_catalog_visibility(user_ids[start:start + chunk_size])
 
 
 @python_2_unicode_compatible
@@ -2857,18 +3811,7 @@ class Product(models.Model):
 
     @property
     def values(self):
-        result = {}
-
-        for attribute in self.attributes.all():
-            result[attribute.title] = {
-                'id': attribute.id,
-                'slug': slugify(attribute.title).replace('-', '_').lower(),
-                'values': ProductAttributeValue.objects.filter(
-                    products__product=self, products__attribute=attribute).uniq_values(),
-                'measurements': attribute.measurements_list
-            }
-
-        return result
+        return get_products_values([self.id])[self.id]
 
 
 @python_2_unicode_compatible
@@ -2877,6 +3820,10 @@ class NLPProductAttribute(models.Model):
     attribute = models.ForeignKey('ProductAttribute')
 
     matchers = JSONField(null=True)
+    # Set by value/measurement changes, cleared once matchers are recompiled (see nlp.compile_stale_matchers)
+    matchers_stale = models.BooleanField(default=True, db_index=True)
+    # Bumped with every matchers_stale=True, a compilation only clears the flag of rows it read at the same version
+    matchers_version = models.IntegerField(default=0)
 
     def __str__(self):
         return "{}. {} - {}".format(self.id, self.product.title, self.attribute.title)
@@ -2888,28 +3835,16 @@ class NLPProductAttribute(models.Model):
 
     def nlp_rules(self):
 
-        values = []
-        if self.attribute.measurements.all().exists():
-            for measurement in self.attribute.measurements.all():
-                values.extend(list(measurement.items.all().values_list('title', flat=True)))
-        else:
-            values = list(self.values.values_list('value_lower', flat=True))
-
-        if self.attribute.nlp_pattern is None:
-
-            patterns = [[{'LOWER': t.lower()} for t in value.split()] for value in filter(None, values)]
+        from vitesse_prod.apps.db.nlp import build_matchers
 
+        if self.attribute.measurements.exists():
+            values = list(ProductMeasurement.objects.filter(group__productattribute=self.attribute).values_list('title', flat=True))
         else:
-            patterns = []
-
-            for pattern in self.attribute.nlp_pattern:
+            values = list(self.values.values_list('value_lower', flat=True))
 
-                for value in filter(None, values):
-                    attr_pattern = pattern[:]
-                    attr_pattern.append({"LOWER": t.lower() for t in value.split()})
-                    patterns.append(attr_pattern)
-        self.matchers = patterns
-        self.save()
+        self.matchers = build_matchers(values, self.attribute.nlp_pattern)
+        self.matchers_stale = False
+        self.save(update_fields=['matchers', 'matchers_stale'])
 
 
 class ProductAttributeValueQueryset(models.QuerySet):
@@ -2931,6 +3866,10 @@ class ProductAttribute(models.Model):
     is_custom = models.BooleanField(default=False)
     nlp_pattern = JSONField(null=True)
     matchers = JSONField(null=True)
+    # Set by value/measurement changes, cleared once matchers are recompiled (see nlp.compile_stale_matchers)
+    matchers_stale = models.BooleanField(default=True, db_index=True)
+    # Bumped with every matchers_stale=True, a compilation only clears the flag of rows it read at the same version
+    matchers_version = models.IntegerField(default=0)
 
     measurements = models.ManyToManyField('ProductMeasurementGroup')
     measurements_items = models.ManyToManyField('ProductMeasurement')
@@ -2950,32 +3889,24 @@ class ProductAttribute(models.Model):
 
     def nlp_rules(self):
 
-        values = []
-        if self.measurements.all().exists():
-            for measurement in self.measurements.all():
-                values.extend(list(measurement.items.all().values_list('title', flat=True)))
-        else:
-            values = list(self.values.all().distinct().values_list('value', flat=True))
-
-        if self.nlp_pattern is None:
-
-            patterns = [[{'LOWER': t.lower()} for t in value.split()] for value in filter(None, values)]
+        from vitesse_prod.apps.db.nlp import build_matchers
 
+        if self.measurements.exists():
+            values = list(ProductMeasurement.objects.filter(group__productattribute=self).values_list('title', flat=True))
         else:
-            patterns = []
-
-            for pattern in self.nlp_pattern:
+            values = list(self.values.all().distinct().values_list('value', flat=True))
 
-                for value in filter(None, values):
-                    attr_pattern = pattern[:]
-                    attr_pattern.append({"LOWER": t.lower() for t in value.split()})
-                    patterns.append(attr_pattern)
-        self.matchers = patterns
-        self.save()
+        self.matchers = build_matchers(values, self.nlp_pattern)
+        self.matchers_stale = False
+        self.save(update_fields=['matchers', 'matchers_stale'])
 
     @property
     def raw_values(self):
-        return json.dumps([v.value for v in self.values.all()])
+
+        from vitesse_prod.apps.db.attribute_vocabulary import TOP_VALUES_SIZE, autocomplete_attribute_values
+
+        # The most used values only, the rest of the vocabulary is reached with autocomplete_attribute_values
+        return json.dumps([item['value'] for item in autocomplete_attribute_values(self.id, '', TOP_VALUES_SIZE)])
 
     @property
     def raw_measurements(self):
@@ -2989,7 +3920,7 @@ class ProductAttribute(models.Model):
 
 
 @python_2_unicode_compatible
-class ProductAttributeValue(models.Model):
+class ProductAttributeValue(TrackedFieldsMixin, models.Model):
     value = models.TextField()
     is_manual = models.BooleanField(default=False)
     product_attribute = models.ForeignKey('ProductAttribute', related_name="values", related_query_name='values',
@@ -3002,6 +3933,8 @@ class ProductAttributeValue(models.Model):
 
     objects = ProductAttributeValueManager()
 
+    tracked_fields = ('order_id', 'order_line_id')
+
     def __str__(self):
         return "{}: {}".format(self.product_attribute, self.value)
 
@@ -3041,6 +3974,215 @@ class ProductAttributeValueThrough(models.Model):
         return "{} [{}] - {}".format(self.product.title, self.attribute.title, self.value.value)
 
 
+# PRODUCT VALUES CACHE
+
+# Per product {attribute title: {'id', 'slug', 'values', 'measurements'}} in the shared cache.
+# Deleted by the value, attribute and measurement changes of the product's attributes.
+PRODUCT_VALUES_CACHE_TTL = 24 * 60 * 60
+
+
+def get_product_values_cache_key(product_id):
+    return 'product_values:%s' % product_id
+
+
+def load_products_values(product_ids):
+    # Four queries whatever the number of products and attributes
+
+    result = dict((product_id, {}) for product_id in product_ids)
+
+    attributes = Product.attributes.through.objects.filter(product_id__in=product_ids).values_list(
+        'product_id', 'productattribute_id', 'productattribute__title'
+    )
+
+    attribute_ids = set()
+    for product_id, attribute_id, title in attributes:
+        attribute_ids.add(attribute_id)
+        result[product_id][title] = {
+            'id': attribute_id,
+            'slug': slugify(title).replace('-', '_').lower(),
+            'values': [],
+            'measurements': [],
+        }
+
+    # Distinct case-insensitive values per (product, attribute), as uniq_values()
+    product_values = ProductAttributeValueThrough.objects.filter(product_id__in=product_ids).annotate(
+        value_lower=Lower('value__value')
+    ).order_by('value_lower', 'value_id').values_list(
+        'product_id', 'attribute_id', 'value_id', 'value__value', 'value__is_manual', 'value_lower'
+    )
+
+    titles = dict(((product_id, attribute['id']), title)
+                  for product_id, product_attributes in result.items() for title, attribute in product_attributes.items())
+
+    seen = set()
+    for product_id, attribute_id, value_id, value, is_manual, value_lower in product_values:
+        title = titles.get((product_id, attribute_id))
+        if title is None or (product_id, attribute_id, value_lower) in seen:
+            continue
+
+        seen.add((product_id, attribute_id, value_lower))
+        result[product_id][title]['values'].append(
+            {'id': value_id, 'value': value, 'is_manual': is_manual, 'value_lower': value_lower}
+        )
+
+    # As ProductAttribute.measurements_list: the items of the groups and the single items
+    measurements = dict((attribute_id, set()) for attribute_id in attribute_ids)
+
+    for attribute_id, title in ProductMeasurement.objects.filter(
+            group__productattribute__in=attribute_ids).values_list('group__productattribute', 'title'):
+        measurements[attribute_id].add(title)
+
+    for attribute_id, title in ProductAttribute.measurements_items.through.objects.filter(
+            productattribute_id__in=attribute_ids).values_list('productattribute_id', 'productmeasurement__title'):
+        measurements[attribute_id].add(title)
+
+    for product_attributes in result.values():
+        for attribute in product_attributes.values():
+            attribute['measurements'] = sorted(measurements[attribute['id']])
+
+    return result
+
+
+def get_products_values(product_ids):
+    """
+    Returns {product_id: {attribute title: {'id', 'slug', 'values', 'measurements'}}}, values being
+    [{'id', 'value', 'is_manual', 'value_lower'}] distinct case-insensitively. Cached per product,
+    the missing ones are loaded together.
+    """
+
+    product_ids = set(product_ids)
+    keys = dict((get_product_values_cache_key(product_id), product_id) for product_id in product_ids)
+
+    result = dict((keys[key], values) for key, values in cache.get_many(list(keys)).items())
+
+    missing_ids = product_ids - set(result)
+    if missing_ids:
+        loaded = load_products_values(missing_ids)
+        cache.set_many(
+            dict((get_product_values_cache_key(product_id), values) for product_id, values in loaded.items()),
+            PRODUCT_VALUES_CACHE_TTL
+        )
+        result.update(loaded)
+
+    return result
+
+
+def invalidate_products_values(product_ids):
+
+    keys = [get_product_values_cache_key(product_id) for product_id in set(product_ids)]
+    if not keys:
+        return
+
+    # Again after the commit, other processes may have cached the old rows meanwhile
+    cache.delete_many(keys)
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def get_attributes_product_ids(attribute_ids):
+    return Product.attributes.through.objects.filter(productattribute_id__in=attribute_ids).values_list('product_id', flat=True)
+
+
+# ATTRIBUTE SCHEMA CACHE
+
+# Process-level compiled ProductAttribute schema. Dropped by the ProductAttribute
+# post_save/post_delete signals and lazily rebuilt with a single query. Other processes
+# rebuild it once it is ATTRIBUTE_SCHEMA_CACHE_TTL seconds old.
+ATTRIBUTE_SCHEMA_CACHE_TTL = 60
+
+_attribute_schema_cache = {'schema': None}
+
+
+def attribute_slug(title):
+    return slugify(title.lower()).replace('-', '_')
+
+
+def get_attribute_schema(refresh=False):
+    """
+    Returns {'by_id': {id: {'slug', 'title', 'is_custom'}}, 'by_slug': {slug: id}, 'loaded_at'}
+    """
+
+    schema = _attribute_schema_cache['schema']
+
+    if schema is None or refresh or time.time() - schema['loaded_at'] > ATTRIBUTE_SCHEMA_CACHE_TTL:
+        schema = {'by_id': {}, 'by_slug': {}, 'loaded_at': time.time()}
+
+        for attribute_id, title, is_custom in ProductAttribute.objects.values_list('id', 'title', 'is_custom'):
+            slug = attribute_slug(title)
+            schema['by_id'][attribute_id] = {'slug': slug, 'title': title, 'is_custom': is_custom}
+            schema['by_slug'][slug] = attribute_id
+
+        _attribute_schema_cache['schema'] = schema
+
+    return schema
+
+
+def invalidate_attribute_schema(sender=None, update_fields=None, **kwargs):
+
+    # nlp_rules() saves matchers only, the compiled schema stays valid
+    if update_fields and not set(update_fields) & {'title', 'is_custom'}:
+        return
+
+    _attribute_schema_cache['schema'] = None
+
+
+def normalize_attribute_value(value):
+    return (u'%s' % (value or '')).strip().lower()
+
+
+def build_attributes_dict(values, hide_item_name_id=False):
+    # values: iterable of (product_attribute_id, value, is_manual)
+
+    schema = get_attribute_schema()
+
+    # Attribute created by another process after the schema was compiled
+    if any(attribute_id not in schema['by_id'] for attribute_id, value, is_manual in values):
+        schema = get_attribute_schema(refresh=True)
+
+    result = {}
+    for attribute_id, attribute in schema['by_id'].items():
+        if not attribute['is_custom']:
+            result[attribute['slug']] = {
+                'is_custom': False,
+                'id': attribute_id,
+            }
+
+    for attribute_id, value, is_manual in values:
+        attribute = schema['by_id'][attribute_id]
+
+        if attribute['is_custom']:
+            result[attribute['slug']] = {
+                'value': value,
+                'is_manual': is_manual,
+                'is_custom': True,
+                'id': -1 if hide_item_name_id and attribute['title'] == 'Item name' else attribute_id,
+            }
+        else:
+            result[attribute['slug']].update({
+                'value': value,
+                'is_manual': is_manual,
+            })
+
+    return result
+
+
+def bulk_build_attributes_dicts(owner_field, owners, hide_item_name_id=False):
+    # owner_field: 'order_id' | 'order_line_id'
+
+    owner_ids = [owner.id for owner in owners]
+    owner_values = dict((owner_id, []) for owner_id in owner_ids)
+
+    values = ProductAttributeValue.objects.filter(**{owner_field + '__in': owner_ids}).order_by('id').values_list(
+        owner_field, 'product_attribute_id', 'value', 'is_manual'
+    )
+    for owner_id, attribute_id, value, is_manual in values:
+        owner_values[owner_id].append((attribute_id, value, is_manual))
+
+    return dict(
+        (owner_id, build_attributes_dict(owner_value_list, hide_item_name_id=hide_item_name_id))
+        for owner_id, owner_value_list in owner_values.items()
+    )
+
+
 # SIGNALS
 
 
@@ -3102,19 +4244,15 @@ def set_order_status_changed_date(sender, instance, **kwargs):
     if not instance.id:
         instance.date_status_changed = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
 
-    else:
-        old_order = Order.objects.get(id=instance.id)
-
-        if old_order.status != instance.status:
-            instance.date_status_changed = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+    elif instance.has_field_changed('status'):
+        instance.date_status_changed = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
 
 
 def inherit_region_currency(sender, instance, **kwargs):
 
     if instance.id:
 
-        old_region = User.objects.get(id=instance.id).default_region
-        if instance.default_region != old_region:
+        if instance.has_field_changed('default_region_id'):
             instance.default_currency = instance.default_region.default_currency
 
     else:
@@ -3123,35 +4261,24 @@ def inherit_region_currency(sender, instance, **kwargs):
             instance.default_currency = instance.default_region.default_currency
 
 
-def process_currency_change(sender, instance, **kwargs):
+def process_currency_change(sender, instance, created, **kwargs):
 
-    if instance.id and User.objects.get(id=instance.id).default_currency:
+    # post_save, before reset_tracked_fields: no job for a user save that failed
+    old_currency_id = instance.get_original_value('default_currency_id') if not created else None
 
-        old_currency = User.objects.get(id=instance.id).default_currency
-        new_currency = instance.default_currency
+    if old_currency_id and instance.default_currency_id and instance.has_field_changed('default_currency_id'):
 
-        if new_currency != old_currency and old_currency and new_currency:
-
-            from vitesse_prod.apps.general_functions.functions import convert_sum
-
-            # Recalc Claims and Mileages
-            ExpenseClaim.objects.filter(user=instance).update(
-                value=convert_sum(F('value'), old_currency.name, new_currency.name)
-            )
+        from vitesse_prod.apps.db.currency_conversion import schedule_currency_conversion
 
-            Mileage.objects.filter(user=instance).update(
-                cost_per_mile=convert_sum(F('cost_per_mile'), old_currency.name, new_currency.name)
-            )
+        # Recalc Claims and Mileages in background
+        schedule_currency_conversion(instance, old_currency_id, instance.default_currency_id)
 
 
 def remove_old_notifications(sender, instance, **kwargs):
 
     if instance.id:
 
-        old_user_role = User.objects.get(id=instance.id).role
-        new_user_role = instance.role
-
-        if old_user_role != new_user_role and new_user_role == User.SPONSOR:
+        if instance.has_field_changed('role') and instance.role == User.SPONSOR:
 
             ActivityNotification.objects.filter(
                 user_from=instance,
@@ -3181,8 +4308,7 @@ def set_activity_status(sender, instance, **kwargs):
         instance.status = Activity.STATUS_NOT_SUBMITTED
 
     if instance.id:
-        old_activity = Activity.objects.get(id=instance.id)
-        if instance.should_source and old_activity.should_source != instance.should_source and old_activity.status == Activity.STATUS_NOT_SUBMITTED:
+        if instance.should_source and instance.has_field_changed('should_source') and instance.get_original_value('status') == Activity.STATUS_NOT_SUBMITTED:
             instance.status = Activity.STATUS_NEW
 
 
@@ -3237,11 +4363,353 @@ def sponsor_report_sharing(sender, instance, created, **kwargs):
 def increase_user_unread_notifs_count(sender, instance, created, **kwargs):
 
     if created:
-        instance.user_to.set_unread_notifications_count('+1')
+        add_unread_notifications_count(instance.user_to_id, 1)
 
 
 def reduce_user_unread_notifs_count(sender, instance, **kwargs):
-    instance.user_to.set_unread_notifications_count('-1')
+    add_unread_notifications_count(instance.user_to_id, -1)
+
+
+def mark_nlp_matchers_stale(sender, instance, **kwargs):
+
+    attributes = ProductAttribute.objects.none()
+    nlp_attributes = NLPProductAttribute.objects.none()
+
+    if sender == ProductAttributeValue:
+        attributes = ProductAttribute.objects.filter(id=instance.product_attribute_id)
+        nlp_attributes = NLPProductAttribute.objects.filter(
+            attribute_id=instance.product_attribute_id, product__product_values__value_id=instance.id
+        )
+
+    elif sender == ProductAttributeValueThrough:
+        nlp_attributes = NLPProductAttribute.objects.filter(product_id=instance.product_id, attribute_id=instance.attribute_id)
+
+    elif sender == ProductMeasurement:
+        if not instance.group_id:
+            return
+        attributes = ProductAttribute.objects.filter(measurements=instance.group_id)
+        nlp_attributes = NLPProductAttribute.objects.filter(attribute__measurements=instance.group_id)
+
+    elif sender == ProductAttribute:
+        # Own matchers save (nlp_rules / bulk compile) doesn't change the sources
+        update_fields = kwargs.get('update_fields')
+        if kwargs.get('created') or (update_fields and 'nlp_pattern' not in update_fields):
+            return
+        attributes = ProductAttribute.objects.filter(id=instance.id)
+        nlp_attributes = NLPProductAttribute.objects.filter(attribute_id=instance.id)
+
+    attributes.update(matchers_stale=True, matchers_version=F('matchers_version') + 1)
+    nlp_attributes.update(matchers_stale=True, matchers_version=F('matchers_version') + 1)
+
+
+def mark_nlp_matchers_stale_on_measurements_change(sender, instance, action, reverse, pk_set, **kwargs):
+
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+
+    if reverse:
+        # instance is a ProductMeasurementGroup
+        attribute_ids = pk_set if pk_set is not None else ProductAttribute.objects.filter(
+            measurements=instance).values_list('id', flat=True)
+        attribute_ids = list(attribute_ids)
+    else:
+        attribute_ids = [instance.id]
+
+    ProductAttribute.objects.filter(id__in=attribute_ids).update(
+        matchers_stale=True, matchers_version=F('matchers_version') + 1
+    )
+    NLPProductAttribute.objects.filter(attribute_id__in=attribute_ids).update(
+        matchers_stale=True, matchers_version=F('matchers_version') + 1
+    )
+
+
+def invalidate_product_values(sender, instance, **kwargs):
+
+    if sender == ProductAttributeValueThrough:
+        product_ids = [instance.product_id]
+
+    elif sender == ProductAttributeValue:
+        product_ids = ProductAttributeValueThrough.objects.filter(value_id=instance.id).values_list('product_id', flat=True)
+
+    elif sender == ProductAttribute:
+        # Own matchers save (nlp_rules / bulk compile) doesn't change the title
+        update_fields = kwargs.get('update_fields')
+        if update_fields and 'title' not in update_fields:
+            return
+        product_ids = get_attributes_product_ids([instance.id])
+
+    else:
+        # ProductMeasurement, an item of the attributes groups or a single item
+        attributes = ProductAttribute.objects.filter(measurements_items=instance.id)
+        if instance.group_id:
+            attributes = attributes | ProductAttribute.objects.filter(measurements=instance.group_id)
+        product_ids = get_attributes_product_ids(attributes.values_list('id', flat=True))
+
+    invalidate_products_values(product_ids)
+
+
+def invalidate_attribute_vocabulary_on_value_change(sender, instance, **kwargs):
+
+    from vitesse_prod.apps.db.attribute_vocabulary import invalidate_attribute_vocabulary
+
+    invalidate_attribute_vocabulary(instance.product_attribute_id)
+
+
+def update_attribute_projections(sender, instance, **kwargs):
+    # Write-through of Order / OrderLine attribute_values, the previous owners too when a value moved
+
+    from vitesse_prod.apps.db.attribute_projection import refresh_attribute_projections
+
+    if sender == ProductAttribute:
+        # The slug follows the title, nlp_rules() saves matchers only
+        update_fields = kwargs.get('update_fields')
+        if kwargs.get('created') or (update_fields and 'title' not in update_fields):
+            return
+
+        get_attribute_schema(refresh=True)
+
+        values = ProductAttributeValue.objects.filter(product_attribute_id=instance.id)
+        order_ids = values.filter(order__isnull=False).values_list('order_id', flat=True).distinct()
+        order_line_ids = values.filter(order_line__isnull=False).values_list('order_line_id', flat=True).distinct()
+
+    else:
+        original_values = {} if kwargs.get('created') else instance.get_original_values()
+        order_ids = [instance.order_id, original_values.get('order_id')]
+        order_line_ids = [instance.order_line_id, original_values.get('order_line_id')]
+
+    refresh_attribute_projections(Order, order_ids)
+    refresh_attribute_projections(OrderLine, order_line_ids)
+
+
+def invalidate_product_values_on_attributes_change(sender, instance, action, reverse, pk_set, **kwargs):
+
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+
+    # Product.attributes: forward instance is a Product, reverse a ProductAttribute and pk_set product ids
+    if not reverse:
+        product_ids = [instance.id]
+    elif pk_set is not None:
+        product_ids = pk_set
+    else:
+        product_ids = get_attributes_product_ids([instance.id])
+
+    invalidate_products_values(product_ids)
+
+
+def invalidate_product_values_on_measurements_change(sender, instance, action, reverse, pk_set, **kwargs):
+
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+
+    # Reverse instance is a ProductMeasurementGroup / ProductMeasurement and pk_set attribute ids
+    if not reverse:
+        attribute_ids = [instance.id]
+    elif pk_set is not None:
+        attribute_ids = pk_set
+    else:
+        field = 'measurements' if sender == ProductAttribute.measurements.through else 'measurements_items'
+        attribute_ids = ProductAttribute.objects.filter(**{field: instance}).values_list('id', flat=True)
+
+    invalidate_products_values(get_attributes_product_ids(attribute_ids))
+
+
+def refresh_order_best_quote(sender, instance, **kwargs):
+
+    if getattr(settings, 'ORDER_BEST_QUOTE_TABLE', False):
+        refresh_order_best_quotes([instance.order_id])
+
+
+def read_spend_contributions(sender, instance, **kwargs):
+    # pre_save / pre_delete: what the row adds to the rollups before the change
+
+    from vitesse_prod.apps.db.analytics import get_spend_contributions
+
+    instance._spend_contributions = get_spend_contributions(instance, lock=True)
+
+
+def update_spend_rollups(sender, instance, **kwargs):
+    # post_save / post_delete: the rollups get the difference, in the transaction of the change
+
+    from vitesse_prod.apps.db.analytics import get_spend_contributions, apply_spend_rollup_deltas
+
+    contributions = {} if kwargs['signal'] == models.signals.post_delete else get_spend_contributions(instance)
+
+    apply_spend_rollup_deltas(getattr(instance, '_spend_contributions', {}), contributions)
+    instance._spend_contributions = contributions
+
+
+def queue_media_processing(sender, instance, **kwargs):
+
+    from vitesse_prod.apps.db.media_processing import schedule_media_job
+
+    schedule_media_job(instance)
+
+
+def update_catalog_item_search_vector(sender, instance, **kwargs):
+
+    from vitesse_prod.apps.db.catalog_search import update_catalog_search_vectors
+
+    update_catalog_search_vectors([instance.id])
+
+
+def update_catalog_users_visibility(sender, instance, action, reverse, pk_set, **kwargs):
+
+    # Catalog.users: forward instance is a Catalog and pk_set user ids, reverse a User and catalog ids
+    if action == 'pre_clear':
+        instance._catalog_visibility_pk_set = set(
+            getattr(instance, 'user_catalogs' if reverse else 'users').values_list('id', flat=True)
+        )
+        return
+
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if action == 'post_clear':
+        pk_set = instance._catalog_visibility_pk_set
+
+    rebuild_catalog_visibility([instance.id] if reverse else pk_set)
+
+
+def update_catalog_companies_visibility(sender, instance, action, reverse, pk_set, **kwargs):
+
+    # Catalog.companies: forward instance is a Catalog and pk_set company ids, reverse a Company and catalog ids
+    if action == 'pre_clear':
+        instance._catalog_visibility_pk_set = set(
+            getattr(instance, 'catalog_set' if reverse else 'companies').values_list('id', flat=True)
+        )
+        return
+
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if action == 'post_clear':
+        pk_set = instance._catalog_visibility_pk_set
+
+    company_ids = [instance.id] if reverse else pk_set
+    rebuild_catalog_visibility(User.objects.filter(company_id__in=company_ids).values_list('id', flat=True))
+
+
+def update_user_catalog_visibility(sender, instance, created, **kwargs):
+
+    if created or instance.has_field_changed('company_id'):
+        rebuild_catalog_visibility([instance.id])
+
+
+def invalidate_catalog_visibility_on_delete(sender, instance, **kwargs):
+    # Index rows go with the catalog (CASCADE), the users caches are dropped before
+
+    invalidate_catalog_users_visibility([instance.id])
+
+
+def invalidate_catalog_visibility_on_item_change(sender, instance, created, **kwargs):
+    # has_items only follows the catalog and the activity of the items, the bulk writes invalidate per catalog
+
+    if created or instance.has_field_changed('is_active') or instance.has_field_changed('catalog_id'):
+        invalidate_catalog_users_visibility(
+            [catalog_id for catalog_id in (instance.catalog_id, instance.get_original_value('catalog_id')) if catalog_id]
+        )
+
+
+def update_supplier_routes(sender, instance, **kwargs):
+
+    from vitesse_prod.apps.db.supplier_routing import schedule_supplier_routes_rebuild
+
+    if sender == CompanyCategorySupplier:
+        links = [(instance.company_id, instance.category_id, instance.subcategory_id)]
+
+        # A moved link leaves the routes of its previous company / category too
+        if not kwargs.get('created'):
+            original_values = instance.get_original_values()
+            links.append((original_values.get('company_id'), original_values.get('category_id'),
+                          original_values.get('subcategory_id')))
+
+        subcategory_categories = dict(Subcategory.objects.filter(
+            id__in=[subcategory_id for company_id, category_id, subcategory_id in links if subcategory_id]
+        ).values_list('id', 'category_id'))
+
+        keys = [(company_id, category_id or subcategory_categories.get(subcategory_id))
+                for company_id, category_id, subcategory_id in links if company_id]
+
+    else:
+        # OrderPreferredSupplier
+        keys = list(Order.objects.filter(id=instance.order_id).values_list('company_id', 'category_id'))
+
+    schedule_supplier_routes_rebuild(keys)
+
+
+def update_supplier_routes_on_order_change(sender, instance, created, **kwargs):
+    # The preferred suppliers of an order count in the history of its category / subcategory routes
+
+    from vitesse_prod.apps.db.supplier_routing import schedule_supplier_routes_rebuild
+
+    if created or not (instance.has_field_changed('category_id') or instance.has_field_changed('subcategory_id')):
+        return
+
+    if OrderPreferredSupplier.objects.filter(order_id=instance.id).exists():
+        schedule_supplier_routes_rebuild([
+            (instance.company_id, instance.get_original_value('category_id')),
+            (instance.company_id, instance.category_id),
+        ])
+
+
+def update_supplier_routes_on_categories_change(sender, instance, action, reverse, model, pk_set, **kwargs):
+
+    from vitesse_prod.apps.db.supplier_routing import schedule_supplier_routes_rebuild
+
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+
+    # The global routes of the categories change, and the company routes built on top of them
+    if reverse:
+        objects_ids = [instance.id]
+    elif action == 'pre_clear':
+        objects_ids = getattr(instance, 'category' if model == Category else 'subcategory').values_list('id', flat=True)
+    else:
+        objects_ids = pk_set
+
+    if model == Subcategory or (reverse and isinstance(instance, Subcategory)):
+        category_ids = Subcategory.objects.filter(id__in=objects_ids).values_list('category_id', flat=True)
+    else:
+        category_ids = objects_ids
+
+    schedule_supplier_routes_rebuild([(None, category_id) for category_id in set(category_ids)])
+
+
+def update_buyer_index(sender, instance, created, **kwargs):
+
+    from vitesse_prod.apps.db.buyer_assignment import schedule_buyers_reload
+
+    if (created and instance.role == User.BUYER) or instance.has_field_changed('role') or instance.has_field_changed('is_active'):
+        schedule_buyers_reload([instance.id])
+
+
+def update_buyer_index_on_memberships_change(sender, instance, action, reverse, pk_set, **kwargs):
+
+    from vitesse_prod.apps.db.buyer_assignment import schedule_buyers_reload, invalidate_buyer_index
+
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    # Forward instance is the buyer, reverse (i.e. region.region_users) pk_set holds the buyers
+    if not reverse:
+        schedule_buyers_reload([instance.id])
+    elif action == 'post_clear':
+        transaction.on_commit(invalidate_buyer_index)
+    else:
+        schedule_buyers_reload(pk_set)
+
+
+def update_buyer_order_load(sender, instance, created, **kwargs):
+
+    from vitesse_prod.apps.db.buyer_assignment import schedule_order_load_update
+
+    schedule_order_load_update(instance, created)
+
+
+def reset_tracked_fields(sender, instance, **kwargs):
+    # The saved values are the originals for the next save
+    instance.reset_original_values()
 
 
 def clear_text(sender, instance, **kwargs):
@@ -3279,7 +4747,6 @@ models.signals.post_save.connect(create_default_travel_class, sender=User)
 models.signals.post_save.connect(sponsor_report_sharing, sender=User)
 models.signals.pre_save.connect(remove_old_notifications, sender=User)
 models.signals.pre_save.connect(inherit_region_currency, sender=User)
-models.signals.pre_save.connect(process_currency_change, sender=User)
 models.signals.pre_save.connect(set_order_status_changed_date, sender=Order)
 models.signals.pre_save.connect(set_order_tracking_number, sender=Order)
 models.signals.pre_save.connect(set_activity_tracking_number, sender=Activity)
@@ -3287,6 +4754,91 @@ models.signals.pre_save.connect(set_activity_status, sender=Activity)
 models.signals.post_save.connect(company_initial_data_create, sender=Company)
 models.signals.post_save.connect(increase_user_unread_notifs_count, sender=ActivityNotification)
 models.signals.post_delete.connect(reduce_user_unread_notifs_count, sender=ActivityNotification)
+# The Activity rollups go with its quotes, deleting an activity deletes them
+models.signals.pre_save.connect(read_spend_contributions, sender=Order)
+models.signals.post_save.connect(update_spend_rollups, sender=Order)
+models.signals.pre_delete.connect(read_spend_contributions, sender=Order)
+models.signals.post_delete.connect(update_spend_rollups, sender=Order)
+models.signals.pre_save.connect(read_spend_contributions, sender=Purchase)
+models.signals.post_save.connect(update_spend_rollups, sender=Purchase)
+models.signals.pre_delete.connect(read_spend_contributions, sender=Purchase)
+models.signals.post_delete.connect(update_spend_rollups, sender=Purchase)
+models.signals.pre_save.connect(read_spend_contributions, sender=ExpenseClaim)
+models.signals.post_save.connect(update_spend_rollups, sender=ExpenseClaim)
+models.signals.pre_delete.connect(read_spend_contributions, sender=ExpenseClaim)
+models.signals.post_delete.connect(update_spend_rollups, sender=ExpenseClaim)
+models.signals.pre_save.connect(read_spend_contributions, sender=Mileage)
+models.signals.post_save.connect(update_spend_rollups, sender=Mileage)
+models.signals.pre_delete.connect(read_spend_contributions, sender=Mileage)
+models.signals.post_delete.connect(update_spend_rollups, sender=Mileage)
+models.signals.pre_save.connect(read_spend_contributions, sender=Activity)
+models.signals.post_save.connect(update_spend_rollups, sender=Activity)
+models.signals.pre_save.connect(read_spend_contributions, sender=ActivityQuote)
+models.signals.post_save.connect(update_spend_rollups, sender=ActivityQuote)
+models.signals.pre_delete.connect(read_spend_contributions, sender=ActivityQuote)
+models.signals.post_delete.connect(update_spend_rollups, sender=ActivityQuote)
+models.signals.post_save.connect(update_user_catalog_visibility, sender=User)
+models.signals.post_save.connect(update_buyer_index, sender=User)
+models.signals.post_save.connect(process_currency_change, sender=User)
+models.signals.post_save.connect(update_buyer_order_load, sender=Order)
+models.signals.post_save.connect(update_supplier_routes_on_order_change, sender=Order)
+models.signals.post_save.connect(update_supplier_routes, sender=CompanyCategorySupplier)
+models.signals.post_save.connect(invalidate_catalog_visibility_on_item_change, sender=CatalogItem)
+models.signals.post_save.connect(update_attribute_projections, sender=ProductAttributeValue)
+models.signals.post_delete.connect(update_attribute_projections, sender=ProductAttributeValue)
+models.signals.post_save.connect(update_attribute_projections, sender=ProductAttribute)
+models.signals.post_save.connect(reset_tracked_fields, sender=ProductAttributeValue)
+models.signals.post_save.connect(reset_tracked_fields, sender=User)
+models.signals.post_save.connect(reset_tracked_fields, sender=Order)
+models.signals.post_save.connect(reset_tracked_fields, sender=Activity)
+models.signals.post_save.connect(reset_tracked_fields, sender=CompanyCategorySupplier)
+models.signals.post_save.connect(reset_tracked_fields, sender=CatalogItem)
+models.signals.post_save.connect(refresh_order_best_quote, sender=Quote)
+models.signals.post_delete.connect(refresh_order_best_quote, sender=Quote)
+models.signals.post_save.connect(invalidate_attribute_schema, sender=ProductAttribute)
+models.signals.post_save.connect(update_catalog_item_search_vector, sender=CatalogItem)
+models.signals.pre_delete.connect(invalidate_catalog_visibility_on_delete, sender=Catalog)
+models.signals.m2m_changed.connect(update_catalog_users_visibility, sender=Catalog.users.through)
+models.signals.m2m_changed.connect(update_catalog_companies_visibility, sender=Catalog.companies.through)
+models.signals.post_delete.connect(update_supplier_routes, sender=CompanyCategorySupplier)
+models.signals.post_save.connect(update_supplier_routes, sender=OrderPreferredSupplier)
+models.signals.post_delete.connect(update_supplier_routes, sender=OrderPreferredSupplier)
+models.signals.m2m_changed.connect(update_supplier_routes_on_categories_change, sender=Supplier.category.through)
+models.signals.m2m_changed.connect(update_supplier_routes_on_categories_change, sender=Supplier.subcategory.through)
+models.signals.m2m_changed.connect(update_buyer_index_on_memberships_change, sender=User.buyer_regions.through)
+models.signals.m2m_changed.connect(update_buyer_index_on_memberships_change, sender=User.buyer_companies.through)
+models.signals.m2m_changed.connect(update_buyer_index_on_memberships_change, sender=User.buyer_categories.through)
+models.signals.m2m_changed.connect(update_buyer_index_on_memberships_change, sender=User.buyer_subcategories.through)
+models.signals.post_save.connect(queue_media_processing, sender=OrderImage)
+models.signals.post_save.connect(queue_media_processing, sender=OrderFile)
+models.signals.post_save.connect(queue_media_processing, sender=ExpenseClaim)
+models.signals.post_save.connect(invalidate_company_settings, sender=CompanyEmailSettings)
+models.signals.post_delete.connect(invalidate_company_settings, sender=CompanyEmailSettings)
+models.signals.post_save.connect(invalidate_company_settings, sender=CompanyMediaSettings)
+models.signals.post_delete.connect(invalidate_company_settings, sender=CompanyMediaSettings)
+models.signals.post_delete.connect(invalidate_company_settings, sender=Company)
+models.signals.post_save.connect(invalidate_currency_rate_table, sender=CurrencyRate)
+models.signals.post_save.connect(mark_nlp_matchers_stale, sender=ProductAttribute)
+models.signals.post_save.connect(mark_nlp_matchers_stale, sender=ProductAttributeValue)
+models.signals.post_delete.connect(mark_nlp_matchers_stale, sender=ProductAttributeValue)
+models.signals.post_save.connect(mark_nlp_matchers_stale, sender=ProductAttributeValueThrough)
+models.signals.post_delete.connect(mark_nlp_matchers_stale, sender=ProductAttributeValueThrough)
+models.signals.post_save.connect(mark_nlp_matchers_stale, sender=ProductMeasurement)
+models.signals.post_delete.connect(mark_nlp_matchers_stale, sender=ProductMeasurement)
+models.signals.m2m_changed.connect(mark_nlp_matchers_stale_on_measurements_change, sender=ProductAttribute.measurements.through)
+models.signals.post_delete.connect(invalidate_attribute_schema, sender=ProductAttribute)
+models.signals.post_save.connect(invalidate_product_values, sender=ProductAttributeValueThrough)
+models.signals.post_delete.connect(invalidate_product_values, sender=ProductAttributeValueThrough)
+models.signals.post_save.connect(invalidate_product_values, sender=ProductAttributeValue)
+models.signals.post_save.connect(invalidate_attribute_vocabulary_on_value_change, sender=ProductAttributeValue)
+models.signals.post_delete.connect(invalidate_attribute_vocabulary_on_value_change, sender=ProductAttributeValue)
+models.signals.post_save.connect(invalidate_product_values, sender=ProductAttribute)
+models.signals.pre_delete.connect(invalidate_product_values, sender=ProductAttribute)
+models.signals.post_save.connect(invalidate_product_values, sender=ProductMeasurement)
+models.signals.pre_delete.connect(invalidate_product_values, sender=ProductMeasurement)
+models.signals.m2m_changed.connect(invalidate_product_values_on_attributes_change, sender=Product.attributes.through)
+models.signals.m2m_changed.connect(invalidate_product_values_on_measurements_change, sender=ProductAttribute.measurements.through)
+models.signals.m2m_changed.connect(invalidate_product_values_on_measurements_change, sender=ProductAttribute.measurements_items.through)
 
 models.signals.pre_save.connect(clear_text, sender=ExpenseClaim)
 models.signals.pre_save.connect(clear_text, sender=ExpenseClaimProject)
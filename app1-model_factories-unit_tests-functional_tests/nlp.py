@@ -0,0 +1,392 @@
+import re
+import multiprocessing
+
+from django.contrib.postgres.fields import JSONField
+from django.db import connection, transaction
+from django.db.models import Case, When, Value, BooleanField
+
+from vitesse_prod.apps.db.attribute_projection import defer_attribute_projections, refresh_attribute_projections
+from vitesse_prod.apps.db.attribute_vocabulary import invalidate_attribute_vocabulary
+from vitesse_prod.apps.db.models import Product, ProductAttribute, NLPProductAttribute, ProductMeasurement, \
+    ProductAttributeValue, ProductAttributeValueThrough, Order, OrderLine
+
+
+COMPILE_CHUNK_SIZE = 500
+
+
+# MATCHERS COMPILATION
+
+def build_matchers(values, nlp_pattern=None):
+    # Token patterns for ProductAttribute.matchers / NLPProductAttribute.matchers
+
+    if nlp_pattern is None:
+        return [[{'LOWER': t.lower()} for t in value.split()] for value in filter(None, values)]
+
+    patterns = []
+    for pattern in nlp_pattern:
+
+        for value in filter(None, values):
+            attr_pattern = pattern[:]
+            attr_pattern.append({"LOWER": t.lower() for t in value.split()})
+            patterns.append(attr_pattern)
+
+    return patterns
+
+
+def _build_matchers_chunk(sources):
+    # Runs in the pool workers, must not touch the database
+    return [(obj_id, build_matchers(values, nlp_pattern)) for obj_id, values, nlp_pattern in sources]
+
+
+def _get_measurement_values(attribute_ids):
+    # {attribute_id: [measurement item titles]} for the attributes having measurement groups
+
+    measured_ids = set(ProductAttribute.measurements.through.objects.filter(
+        productattribute_id__in=attribute_ids
+    ).values_list('productattribute_id', flat=True))
+
+    values = dict((attribute_id, []) for attribute_id in measured_ids)
+    for attribute_id, title in ProductMeasurement.objects.filter(
+            group__productattribute__in=measured_ids).values_list('group__productattribute', 'title'):
+        values[attribute_id].append(title)
+
+    return values
+
+
+def get_attribute_sources(attribute_ids):
+    # [(attribute_id, values, nlp_pattern)], same values as ProductAttribute.nlp_rules() in 4 queries
+
+    values = _get_measurement_values(attribute_ids)
+    plain_ids = [attribute_id for attribute_id in attribute_ids if attribute_id not in values]
+
+    for attribute_id in plain_ids:
+        values[attribute_id] = []
+
+    for attribute_id, value in ProductAttributeValue.objects.filter(
+            product_attribute_id__in=plain_ids).values_list('product_attribute_id', 'value').distinct():
+        values[attribute_id].append(value)
+
+    return [
+        (attribute_id, values[attribute_id], nlp_pattern)
+        for attribute_id, nlp_pattern in ProductAttribute.objects.filter(id__in=attribute_ids).values_list('id', 'nlp_pattern')
+    ]
+
+
+def get_nlp_attribute_sources(nlp_attribute_ids):
+    # [(nlp_attribute_id, values, nlp_pattern)], same values as NLPProductAttribute.nlp_rules() in 5 queries
+
+    rows = list(NLPProductAttribute.objects.filter(id__in=nlp_attribute_ids).values_list(
+        'id', 'product_id', 'attribute_id', 'attribute__nlp_pattern'
+    ))
+    attribute_ids = set(row[2] for row in rows)
+    product_ids = set(row[1] for row in rows)
+
+    measurement_values = _get_measurement_values(attribute_ids)
+
+    # uniq_values(): distinct by lower(value), ordered by lower(value)
+    product_values = {}
+    for product_id, attribute_id, value in ProductAttributeValueThrough.objects.filter(
+            product_id__in=product_ids, attribute_id__in=attribute_ids).values_list('product_id', 'attribute_id', 'value__value'):
+        product_values.setdefault((product_id, attribute_id), set()).add(value.lower())
+
+    sources = []
+    for nlp_attribute_id, product_id, attribute_id, nlp_pattern in rows:
+
+        if attribute_id in measurement_values:
+            values = measurement_values[attribute_id]
+        else:
+            values = sorted(product_values.get((product_id, attribute_id), ()))
+
+        sources.append((nlp_attribute_id, values, nlp_pattern))
+
+    return sources
+
+
+def get_matchers_versions(model, ids):
+    # Read before the sources, a change landing after this read bumps the version
+    return dict(model.objects.filter(id__in=ids).values_list('id', 'matchers_version'))
+
+
+def bulk_update_matchers(model, results, versions):
+    # One UPDATE ... SET matchers = CASE id WHEN ... END for the whole chunk.
+    # Rows whose version moved since versions was read stay stale, their sources changed meanwhile
+
+    if not results:
+        return 0
+
+    return model.objects.filter(id__in=[obj_id for obj_id, matchers in results]).update(
+        matchers=Case(
+            *[When(id=obj_id, then=Value(matchers, output_field=JSONField())) for obj_id, matchers in results],
+            output_field=JSONField()
+        ),
+        matchers_stale=Case(
+            *[When(id=obj_id, matchers_version=versions.get(obj_id), then=Value(False)) for obj_id, matchers in results],
+            default=Value(True),
+            output_field=BooleanField()
+        )
+    )
+
+
+# STALENESS
+
+def ensure_nlp_product_attributes():
+    # Creates the missing NLPProductAttribute rows for every Product.attributes pair (created stale)
+
+    existing = set(NLPProductAttribute.objects.values_list('product_id', 'attribute_id'))
+    missing = [
+        NLPProductAttribute(product_id=product_id, attribute_id=attribute_id)
+        for product_id, attribute_id in Product.attributes.through.objects.values_list('product_id', 'productattribute_id')
+        if (product_id, attribute_id) not in existing
+    ]
+    NLPProductAttribute.objects.bulk_create(missing, batch_size=COMPILE_CHUNK_SIZE)
+
+    return len(missing)
+
+
+def get_stale_ids(model, force=False):
+
+    queryset = model.objects.all() if force else model.objects.filter(matchers_stale=True)
+    return list(queryset.order_by('id').values_list('id', flat=True))
+
+
+def compile_stale_matchers(processes=None, chunk_size=COMPILE_CHUNK_SIZE, force=False, seed=True, log=None):
+    """
+    Recompiles matchers of the stale ProductAttribute and NLPProductAttribute rows only (all of them if force).
+    Sources are loaded per chunk with a fixed number of queries, patterns are built in a process pool and
+    written back with a single UPDATE per chunk.
+    """
+
+    processes = processes or multiprocessing.cpu_count()
+
+    stats = {'seeded': 0, 'attributes': 0, 'nlp_attributes': 0}
+
+    if seed:
+        stats['seeded'] = ensure_nlp_product_attributes()
+
+    jobs = [
+        (ProductAttribute, get_attribute_sources, 'attributes'),
+        (NLPProductAttribute, get_nlp_attribute_sources, 'nlp_attributes'),
+    ]
+
+    pool = None
+    if processes > 1:
+        # Forked workers must not share the parent's database socket
+        connection.close()
+        pool = multiprocessing.Pool(processes)
+
+    try:
+        for model, get_sources, stat_key in jobs:
+
+            ids = get_stale_ids(model, force=force)
+
+            for start in range(0, len(ids), chunk_size):
+                versions = get_matchers_versions(model, ids[start:start + chunk_size])
+                sources = get_sources(ids[start:start + chunk_size])
+
+                if pool:
+                    step = max(1, len(sources) // processes)
+                    results = []
+                    for chunk_results in pool.map(_build_matchers_chunk, [
+                            sources[i:i + step] for i in range(0, len(sources), step)]):
+                        results.extend(chunk_results)
+                else:
+                    results = _build_matchers_chunk(sources)
+
+                with transaction.atomic():
+                    stats[stat_key] += bulk_update_matchers(model, results, versions)
+
+                if log:
+                    log('%s: %i/%i' % (model.__name__, min(start + chunk_size, len(ids)), len(ids)))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    return stats
+
+
+# ATTRIBUTE EXTRACTION
+
+TOKEN_RE = re.compile(r"\w+(?:[.,/-]\w+)*|[^\w\s]", re.UNICODE)
+
+# Token attributes supported besides LOWER / ORTH / TEXT
+TOKEN_PREDICATES = {
+    'IS_DIGIT': lambda t: t.isdigit(),
+    'IS_ALPHA': lambda t: t.isalpha(),
+    'IS_PUNCT': lambda t: not t.isalnum(),
+    'LIKE_NUM': lambda t: t.replace('.', '', 1).replace(',', '').isdigit(),
+}
+
+EXTRACT_CHUNK_SIZE = 2000
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text or '')
+
+
+class _TrieNode(object):
+    __slots__ = ('children', 'predicates', 'attribute_ids')
+
+    def __init__(self):
+        self.children = {}
+        self.predicates = []
+        self.attribute_ids = []
+
+
+class AttributeExtractor(object):
+    """
+    All attribute matchers compiled into one token trie. A description is scanned once, trying every
+    start position against the trie, so the cost doesn't grow with the number of attributes.
+    Longest match wins, only the first match of an attribute is kept.
+    """
+
+    def __init__(self, matchers_by_attribute):
+        self.root = _TrieNode()
+        self.patterns_count = 0
+        self.skipped_patterns_count = 0
+
+        for attribute_id, matchers in matchers_by_attribute.items():
+            for pattern in matchers or []:
+                if self._add(attribute_id, pattern):
+                    self.patterns_count += 1
+                else:
+                    self.skipped_patterns_count += 1
+
+    @classmethod
+    def from_db(cls, attribute_ids=None):
+
+        queryset = ProductAttribute.objects.filter(matchers__isnull=False)
+        if attribute_ids is not None:
+            queryset = queryset.filter(id__in=attribute_ids)
+
+        return cls(dict(queryset.values_list('id', 'matchers')))
+
+    def _add(self, attribute_id, pattern):
+
+        if not pattern:
+            return False
+
+        node = self.root
+        for spec in pattern:
+
+            # Only single-token specs without quantifiers fit into the trie
+            if not isinstance(spec, dict) or len(spec) != 1:
+                return False
+
+            key, value = list(spec.items())[0]
+
+            if key in ('LOWER', 'ORTH', 'TEXT'):
+                token = value.lower()
+                node = node.children.setdefault(token, _TrieNode())
+
+            elif key in TOKEN_PREDICATES and value is True:
+                for predicate_key, child in node.predicates:
+                    if predicate_key == key:
+                        node = child
+                        break
+                else:
+                    child = _TrieNode()
+                    node.predicates.append((key, child))
+                    node = child
+
+            else:
+                return False
+
+        if attribute_id not in node.attribute_ids:
+            node.attribute_ids.append(attribute_id)
+
+        return True
+
+    def _walk(self, tokens, lowered, start):
+        # Yields (end, attribute_ids) for every pattern matching tokens[start:end]
+
+        stack = [(self.root, start)]
+        while stack:
+            node, i = stack.pop()
+
+            if node.attribute_ids and i > start:
+                yield i, node.attribute_ids
+
+            if i == len(tokens):
+                continue
+
+            child = node.children.get(lowered[i])
+            if child is not None:
+                stack.append((child, i + 1))
+
+            for predicate_key, child in node.predicates:
+                if TOKEN_PREDICATES[predicate_key](tokens[i]):
+                    stack.append((child, i + 1))
+
+    def extract(self, text):
+        # {attribute_id: matched text}
+
+        tokens = tokenize(text)
+        lowered = [t.lower() for t in tokens]
+
+        found = {}
+        for start in range(len(tokens)):
+
+            best = {}
+            for end, attribute_ids in self._walk(tokens, lowered, start):
+                for attribute_id in attribute_ids:
+                    if attribute_id not in found and end > best.get(attribute_id, 0):
+                        best[attribute_id] = end
+
+            for attribute_id, end in best.items():
+                found[attribute_id] = ' '.join(tokens[start:end])
+
+        return found
+
+    def extract_many(self, texts):
+        return [self.extract(text) for text in texts]
+
+
+def extract_attribute_values(queryset, extractor=None, chunk_size=EXTRACT_CHUNK_SIZE, overwrite=False):
+    """
+    Scans raw_description of an Order or OrderLine queryset and bulk_creates the found ProductAttributeValue rows.
+    Attributes that already have a value for the order (line) are skipped unless overwrite is set,
+    then the existing non manual values of the scanned rows are replaced.
+    """
+
+    owner_field = {Order: 'order_id', OrderLine: 'order_line_id'}[queryset.model]
+    extractor = extractor or AttributeExtractor.from_db()
+
+    created_count = 0
+    rows = queryset.exclude(raw_description__isnull=True).exclude(raw_description='').order_by('id').values_list(
+        'id', 'raw_description'
+    )
+
+    ids = list(rows.values_list('id', flat=True))
+    for start in range(0, len(ids), chunk_size):
+        chunk = list(rows.filter(id__in=ids[start:start + chunk_size]))
+        chunk_ids = [row[0] for row in chunk]
+
+        extracted = [(owner_id, extractor.extract(description)) for owner_id, description in chunk]
+
+        # The replaced values are only gone once their replacements are stored. The projections of the chunk
+        # are refreshed once, not per deleted row, and bulk_create sends no post_save
+        with transaction.atomic(), defer_attribute_projections():
+            existing_values = ProductAttributeValue.objects.filter(**{owner_field + '__in': chunk_ids})
+            if overwrite:
+                existing_values.filter(is_manual=False).delete()
+            existing = set(existing_values.values_list(owner_field, 'product_attribute_id'))
+
+            new_values = []
+            for owner_id, found in extracted:
+                for attribute_id, value in found.items():
+                    if (owner_id, attribute_id) not in existing:
+                        new_values.append(ProductAttributeValue(
+                            **{owner_field: owner_id, 'product_attribute_id': attribute_id, 'value': value}
+                        ))
+
+            ProductAttributeValue.objects.bulk_create(new_values, batch_size=chunk_size)
+            refresh_attribute_projections(queryset.model, chunk_ids)
+
+        # bulk_create sends no post_save, the vocabularies are dropped as the signal handler does
+        for attribute_id in set(value.product_attribute_id for value in new_values):
+            invalidate_attribute_vocabulary(attribute_id)
+
+        created_count += len(new_values)
+
+    return created_count
@@ -0,0 +1,140 @@
+import datetime
+
+import pytz
+from django.db import transaction
+from django.db.models import Q, Avg, Min, Max, Count, Case, When, Value, FloatField, IntegerField
+
+from vitesse_prod.apps.db.models import Order, OrderSavings, OrderSavingsRun
+
+
+SAVINGS_CHUNK_SIZE = 1000
+
+CLOSED_STATUSES = [
+    Order.STATUS_CLOSED_ACCEPTED,
+    Order.STATUS_CLOSED_CANCELED,
+    Order.STATUS_CLOSED_AUTHORIZER_DECLINED,
+    Order.STATUS_CLOSED_QUOTES_DECLINED,
+]
+
+# Written by the engine, levels_applied and the TYPE_BENCHMARK rows stay hand maintained
+SAVINGS_FIELDS = (
+    ('type', IntegerField()),
+    ('baseline', FloatField()),
+    ('savings', FloatField()),
+    ('realization_type', IntegerField()),
+)
+
+
+def get_savings_rows(orders):
+    """
+    One grouped query over the orders and their quotes. Yields (order_id, type, baseline, savings, realization_type):
+    baseline is the request estimate (or the quotes average without an estimate), savings are realized against
+    the accepted quote, unrealized against the lowest one. Orders without quotes are skipped.
+    """
+
+    rows = orders.annotate(
+        quotes_count=Count('order_quotes'),
+        accepted_value=Max(Case(When(order_quotes__accepted=True, then='order_quotes__value'), output_field=FloatField())),
+        lowest_value=Min('order_quotes__value'),
+        average_value=Avg('order_quotes__value'),
+    ).filter(quotes_count__gt=0).order_by().values_list(
+        'id', 'estimated_value', 'quantity', 'accepted_value', 'lowest_value', 'average_value'
+    )
+
+    for order_id, estimated_value, quantity, accepted_value, lowest_value, average_value in rows:
+
+        if estimated_value:
+            savings_type = OrderSavings.TYPE_ESTIMATE
+            baseline = round(estimated_value * quantity, 2)
+        else:
+            savings_type = OrderSavings.TYPE_AVG_OF_QUOTES
+            baseline = round(average_value * quantity, 2)
+
+        if accepted_value is not None:
+            realization_type = OrderSavings.REALIZATION_TYPE_REALIZED
+            savings = round(baseline - accepted_value * quantity, 2)
+        else:
+            realization_type = OrderSavings.REALIZATION_TYPE_UNREALIZED
+            savings = round(baseline - lowest_value * quantity, 2)
+
+        yield order_id, savings_type, baseline, savings, realization_type
+
+
+def upsert_order_savings(rows):
+    # bulk_create for new orders, one CASE UPDATE per chunk for the existing OrderSavings
+
+    rows = list(rows)
+    existing = dict(OrderSavings.objects.filter(order_id__in=[row[0] for row in rows]).values_list('order_id', 'type'))
+
+    new_savings = []
+    updates = []
+    for order_id, savings_type, baseline, savings, realization_type in rows:
+
+        if order_id not in existing:
+            new_savings.append(OrderSavings(
+                order_id=order_id, type=savings_type, baseline=baseline, savings=savings, realization_type=realization_type
+            ))
+        elif existing[order_id] != OrderSavings.TYPE_BENCHMARK:
+            updates.append((order_id, savings_type, baseline, savings, realization_type))
+
+    with transaction.atomic():
+        OrderSavings.objects.bulk_create(new_savings, batch_size=SAVINGS_CHUNK_SIZE)
+
+        for start in range(0, len(updates), SAVINGS_CHUNK_SIZE):
+            chunk = updates[start:start + SAVINGS_CHUNK_SIZE]
+
+            values = {}
+            for position, (field, output_field) in enumerate(SAVINGS_FIELDS, 1):
+                values[field] = Case(
+                    *[When(order_id=row[0], then=Value(row[position])) for row in chunk], output_field=output_field
+                )
+
+            OrderSavings.objects.filter(order_id__in=[row[0] for row in chunk]).update(**values)
+
+    return len(new_savings), len(updates)
+
+
+def delete_ineligible_order_savings(company):
+    # Engine rows of orders no longer closed, deleted or left without quotes. One DELETE, run by every pass
+
+    eligible_ids = Order.objects.filter(
+        company=company, status__in=CLOSED_STATUSES, is_deleted=False, order_quotes__isnull=False
+    ).values('id')
+
+    return OrderSavings.objects.filter(order__company=company).exclude(type=OrderSavings.TYPE_BENCHMARK).exclude(
+        order_id__in=eligible_ids
+    ).delete()[0]
+
+
+def recompute_order_savings(company, incremental=False):
+    """
+    Recomputes OrderSavings of all closed orders of the company in one set-based pass.
+    incremental: only the orders edited, or whose quotes were edited, since the last finished run started.
+    It can't see changes that don't touch date_edited: deleted quotes of an order keeping other quotes
+    and status or value changes made with queryset.update() without date_edited. A full run fixes those.
+    Savings of orders that are no longer eligible are deleted in both modes.
+    """
+
+    run = OrderSavingsRun.objects.create(
+        company=company, is_incremental=incremental, date_started=datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+    )
+
+    orders = Order.objects.filter(company=company, status__in=CLOSED_STATUSES, is_deleted=False)
+
+    if incremental:
+        last_run = OrderSavingsRun.objects.filter(company=company, date_finished__isnull=False).exclude(id=run.id).first()
+
+        if last_run:
+            changed_ids = Order.objects.filter(company=company).filter(
+                Q(date_edited__gte=last_run.date_started) | Q(order_quotes__date_edited__gte=last_run.date_started)
+            ).values('id')
+            orders = orders.filter(id__in=changed_ids)
+
+    delete_ineligible_order_savings(company)
+    created_count, updated_count = upsert_order_savings(get_savings_rows(orders))
+
+    run.orders_processed = created_count + updated_count
+    run.date_finished = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+    run.save(update_fields=['orders_processed', 'date_finished'])
+
+    return run
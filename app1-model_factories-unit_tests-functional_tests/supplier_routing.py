@@ -0,0 +1,252 @@
+import threading
+from collections import defaultdict
+
+from django.db import connection, transaction
+from django.db.models import Q, Count
+
+from vitesse_prod.apps.db.models import (
+    Subcategory, Supplier, CompanyCategorySupplier, OrderPreferredSupplier, OrderSuggestedSupplier, SupplierRoute
+)
+
+
+ROUTE_MAX_SUPPLIERS = 50
+SUGGESTED_SUPPLIERS_LIMIT = 5
+ROUTING_CHUNK_SIZE = 1000
+
+# Scores: the company's own suppliers first, then its ordering history, then the global supplier categories
+SCORE_COMPANY_CATEGORY = 100
+SCORE_COMPANY_SUBCATEGORY = 100
+SCORE_CATEGORY_CARD = 10
+SCORE_HISTORY_MAX = 50
+SCORE_GLOBAL_CATEGORY = 10
+SCORE_GLOBAL_SUBCATEGORY = 20
+
+_pending_routes = threading.local()
+
+
+def get_ranked_ids(scores):
+    # Best score first, lowest id on ties so the order is stable between rebuilds
+    return [supplier_id for supplier_id, score in sorted(scores.items(), key=lambda item: (-item[1], item[0]))][
+        :ROUTE_MAX_SUPPLIERS]
+
+
+def add_scores(target, scores):
+
+    for supplier_id, score in scores.items():
+        target[supplier_id] = target.get(supplier_id, 0) + score
+
+
+def build_supplier_routes(company_ids=None, category_ids=None):
+    """
+    SupplierRoute objects of the scope: global routes (company None) when company_ids is None,
+    and the routes of the companies with suppliers or history in the categories.
+    A subcategory route also ranks the suppliers of its category. A company with a category route gets
+    a route for every subcategory with global suppliers, so its orders of the subcategory see them too.
+    """
+
+    def in_scope(queryset, category_lookup, company_lookup=None):
+        if category_ids is not None:
+            queryset = queryset.filter(**{'%s__in' % category_lookup: category_ids})
+        if company_lookup and company_ids is not None:
+            queryset = queryset.filter(**{'%s__in' % company_lookup: company_ids})
+        return queryset
+
+    subcategory_categories = dict(in_scope(Subcategory.objects.all(), 'category_id').values_list('id', 'category_id'))
+
+    # Global scores per (category, subcategory)
+    global_scores = defaultdict(dict)
+    for supplier_id, category_id in in_scope(
+            Supplier.category.through.objects.all(), 'category_id').values_list('supplier_id', 'category_id'):
+        global_scores[(category_id, None)][supplier_id] = SCORE_GLOBAL_CATEGORY
+
+    for supplier_id, subcategory_id in Supplier.subcategory.through.objects.filter(
+            subcategory_id__in=list(subcategory_categories)).values_list('supplier_id', 'subcategory_id'):
+        global_scores[(subcategory_categories[subcategory_id], subcategory_id)][supplier_id] = SCORE_GLOBAL_SUBCATEGORY
+
+    # Company scores per (company, category, subcategory)
+    company_scores = defaultdict(dict)
+
+    links = in_scope(CompanyCategorySupplier.objects.all(), 'category_id', 'company_id').filter(
+        category__isnull=False
+    ).values_list('company_id', 'category_id', 'supplier_id', 'is_in_category_card')
+    for company_id, category_id, supplier_id, is_in_category_card in links:
+        add_scores(company_scores[(company_id, category_id, None)], {
+            supplier_id: SCORE_COMPANY_CATEGORY + (SCORE_CATEGORY_CARD if is_in_category_card else 0)
+        })
+
+    links = in_scope(CompanyCategorySupplier.objects.all(), 'subcategory__category_id', 'company_id').filter(
+        subcategory__isnull=False
+    ).values_list('company_id', 'subcategory__category_id', 'subcategory_id', 'supplier_id', 'is_in_category_card')
+    for company_id, category_id, subcategory_id, supplier_id, is_in_category_card in links:
+        add_scores(company_scores[(company_id, category_id, subcategory_id)], {
+            supplier_id: SCORE_COMPANY_SUBCATEGORY + (SCORE_CATEGORY_CARD if is_in_category_card else 0)
+        })
+
+    history = in_scope(OrderPreferredSupplier.objects.all(), 'order__category_id', 'order__company_id').filter(
+        order__category__isnull=False
+    ).order_by().values_list('order__company_id', 'order__category_id', 'order__subcategory_id', 'supplier_id').annotate(
+        orders_count=Count('id')
+    )
+    for company_id, category_id, subcategory_id, supplier_id, orders_count in history:
+        score = {supplier_id: min(orders_count, SCORE_HISTORY_MAX)}
+
+        add_scores(company_scores[(company_id, category_id, None)], score)
+        if subcategory_id:
+            add_scores(company_scores[(company_id, category_id, subcategory_id)], score)
+
+    global_subcategory_ids = defaultdict(set)
+    for category_id, subcategory_id in global_scores:
+        if subcategory_id:
+            global_subcategory_ids[category_id].add(subcategory_id)
+
+    for company_id, category_id, subcategory_id in list(company_scores):
+        if subcategory_id is None:
+            for global_subcategory_id in global_subcategory_ids[category_id]:
+                company_scores.setdefault((company_id, category_id, global_subcategory_id), {})
+
+    routes = []
+
+    if company_ids is None:
+        for (category_id, subcategory_id), scores in global_scores.items():
+            if subcategory_id:
+                scores = dict(scores)
+                add_scores(scores, global_scores.get((category_id, None), {}))
+
+            routes.append(SupplierRoute(category_id=category_id, subcategory_id=subcategory_id,
+                                        supplier_ids=get_ranked_ids(scores)))
+
+    for (company_id, category_id, subcategory_id), own_scores in company_scores.items():
+        scores = {}
+        add_scores(scores, global_scores.get((category_id, None), {}))
+        add_scores(scores, company_scores.get((company_id, category_id, None), {}))
+
+        if subcategory_id:
+            add_scores(scores, global_scores.get((category_id, subcategory_id), {}))
+            add_scores(scores, own_scores)
+
+        routes.append(SupplierRoute(company_id=company_id, category_id=category_id, subcategory_id=subcategory_id,
+                                    supplier_ids=get_ranked_ids(scores)))
+
+    return routes
+
+
+def rebuild_supplier_routes(company_ids=None, category_ids=None):
+    # Replaces the routes of the scope, None: all companies (and the global routes) / all categories
+
+    routes = build_supplier_routes(company_ids=company_ids, category_ids=category_ids)
+
+    existing = SupplierRoute.objects.all()
+    if category_ids is not None:
+        existing = existing.filter(category_id__in=category_ids)
+    if company_ids is not None:
+        existing = existing.filter(company_id__in=company_ids)
+
+    with transaction.atomic():
+        existing.delete()
+        SupplierRoute.objects.bulk_create(routes, batch_size=ROUTING_CHUNK_SIZE)
+
+    return len(routes)
+
+
+def schedule_supplier_routes_rebuild(keys):
+    # keys: (company_id or None for every company, category_id). Collected per transaction, rebuilt once it commits
+
+    keys = set((company_id, category_id) for company_id, category_id in keys if category_id)
+    if not keys:
+        return
+
+    if not connection.in_atomic_block:
+        return rebuild_supplier_route_keys(keys)
+
+    # As the spend rollups: the first callback to run rebuilds all the pending keys, the others find nothing left
+    pending = getattr(_pending_routes, 'keys', None)
+    if pending is None:
+        pending = _pending_routes.keys = set()
+
+    pending.update(keys)
+    transaction.on_commit(flush_supplier_routes)
+
+
+def flush_supplier_routes():
+
+    pending = getattr(_pending_routes, 'keys', None)
+    _pending_routes.keys = None
+
+    if pending:
+        rebuild_supplier_route_keys(pending)
+
+
+def rebuild_supplier_route_keys(keys):
+
+    all_companies_category_ids = set(category_id for company_id, category_id in keys if company_id is None)
+    if all_companies_category_ids:
+        rebuild_supplier_routes(category_ids=list(all_companies_category_ids))
+
+    category_ids_by_company = defaultdict(set)
+    for company_id, category_id in keys:
+        if company_id is not None and category_id not in all_companies_category_ids:
+            category_ids_by_company[company_id].add(category_id)
+
+    for company_id, category_ids in category_ids_by_company.items():
+        rebuild_supplier_routes(company_ids=[company_id], category_ids=list(category_ids))
+
+
+def get_routes_for_orders(orders):
+    # {(company_id, category_id, subcategory_id): supplier ids} of the routes the orders may need, one query
+
+    company_ids = set(order[1] for order in orders)
+    category_ids = set(order[2] for order in orders if order[2])
+
+    routes = SupplierRoute.objects.filter(category_id__in=category_ids).filter(
+        Q(company_id__in=company_ids) | Q(company__isnull=True)
+    ).values_list('company_id', 'category_id', 'subcategory_id', 'supplier_ids')
+
+    return dict(((company_id, category_id, subcategory_id), supplier_ids)
+                for company_id, category_id, subcategory_id, supplier_ids in routes)
+
+
+def get_route_supplier_ids(routes, company_id, category_id, subcategory_id):
+    # Most specific route first: the company's subcategory, company's category, then the global ones.
+    # A company's category route is only used for subcategories without global suppliers, the others have their own
+
+    for key in ((company_id, category_id, subcategory_id), (company_id, category_id, None),
+                (None, category_id, subcategory_id), (None, category_id, None)):
+        if key in routes and (key[2] is None or subcategory_id):
+            return routes[key]
+
+    return []
+
+
+def get_suggested_supplier_ids(order, limit=SUGGESTED_SUPPLIERS_LIMIT):
+
+    key = (order.id, order.company_id, order.category_id, order.subcategory_id)
+    return get_route_supplier_ids(get_routes_for_orders([key]), *key[1:])[:limit]
+
+
+def fill_suggested_suppliers(orders, limit=SUGGESTED_SUPPLIERS_LIMIT):
+    """
+    Adds the top routed suppliers to OrderSuggestedSupplier for a whole queryset of orders:
+    one query for the orders, one for the routes, one for the existing suggestions per chunk and bulk inserts.
+    Returns the number of suggestions created.
+    """
+
+    orders = list(orders.order_by().values_list('id', 'company_id', 'category_id', 'subcategory_id'))
+    routes = get_routes_for_orders(orders)
+
+    created_count = 0
+    for start in range(0, len(orders), ROUTING_CHUNK_SIZE):
+        chunk = orders[start:start + ROUTING_CHUNK_SIZE]
+
+        existing = set(OrderSuggestedSupplier.objects.filter(
+            order_id__in=[order[0] for order in chunk]).values_list('order_id', 'supplier_id'))
+
+        suggestions = []
+        for order_id, company_id, category_id, subcategory_id in chunk:
+            for supplier_id in get_route_supplier_ids(routes, company_id, category_id, subcategory_id)[:limit]:
+                if (order_id, supplier_id) not in existing:
+                    suggestions.append(OrderSuggestedSupplier(order_id=order_id, supplier_id=supplier_id))
+
+        OrderSuggestedSupplier.objects.bulk_create(suggestions, batch_size=ROUTING_CHUNK_SIZE)
+        created_count += len(suggestions)
+
+    return created_count
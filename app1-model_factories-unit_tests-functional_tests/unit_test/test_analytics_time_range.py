@@ -0,0 +1,31 @@
+import datetime
+
+from django.test import SimpleTestCase
+from vitesse_prod.apps.db.analytics import get_analytics_time_range, get_bucket_start, get_next_bucket_start
+
+
+class TestAnalyticsTimeRange(SimpleTestCase):
+
+    def setUp(self):
+        self.today = datetime.date(2017, 2, 15)
+
+    def test_current_quarter(self):
+        self.assertEqual(
+            get_analytics_time_range('current_quarter', today=self.today),
+            (datetime.date(2017, 1, 1), datetime.date(2017, 2, 16))
+        )
+
+    def test_last_quarter_crosses_year(self):
+        self.assertEqual(
+            get_analytics_time_range('last_quarter', today=self.today),
+            (datetime.date(2016, 10, 1), datetime.date(2017, 1, 1))
+        )
+
+    def test_unknown_command(self):
+        self.assertEqual(get_analytics_time_range('next_decade', today=self.today), (None, None))
+
+    def test_bucket_boundaries(self):
+        self.assertEqual(get_bucket_start(self.today, 'week'), datetime.date(2017, 2, 13))
+        self.assertEqual(get_bucket_start(self.today, 'quarter'), datetime.date(2017, 1, 1))
+        self.assertEqual(get_next_bucket_start(datetime.date(2016, 11, 1), 'quarter'), datetime.date(2017, 2, 1))
+        self.assertEqual(get_next_bucket_start(datetime.date(2016, 12, 1), 'month'), datetime.date(2017, 1, 1))
@@ -0,0 +1,27 @@
+from django.test import SimpleTestCase
+from vitesse_prod.apps.db.nlp import AttributeExtractor, build_matchers
+
+
+class TestAttributeExtractor(SimpleTestCase):
+
+    def setUp(self):
+        self.extractor = AttributeExtractor({
+            1: build_matchers(['Red', 'Dark Blue']),
+            2: build_matchers(['10 mm', '10 mm x 5']),
+            3: [[{'IS_DIGIT': True}, {'LOWER': 'kg'}]],
+            4: [[{'LOWER': 'pack', 'OP': '?'}]],
+        })
+
+    def test_unsupported_patterns_skipped(self):
+        self.assertEqual(self.extractor.patterns_count, 5)
+        self.assertEqual(self.extractor.skipped_patterns_count, 1)
+
+    def test_longest_and_first_match(self):
+        self.assertEqual(
+            self.extractor.extract('Dark blue bolt 10 mm x 5 pack, 25 kg red'),
+            {1: 'Dark blue', 2: '10 mm x 5', 3: '25 kg'}
+        )
+
+    def test_no_match(self):
+        self.assertEqual(self.extractor.extract('green screw'), {})
+        self.assertEqual(self.extractor.extract(None), {})
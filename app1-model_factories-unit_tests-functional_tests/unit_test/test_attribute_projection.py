@@ -0,0 +1,44 @@
+import datetime
+from django.test import TestCase
+from vitesse_prod.apps.db.models import Measurement, OrderLine, ProductAttribute, ProductAttributeValue
+
+
+class TestAttributeProjection(TestCase):
+
+    def setUp(self):
+        measurement = Measurement.objects.create(name='pcs')
+        self.color = ProductAttribute.objects.create(title='Color')
+        self.size = ProductAttribute.objects.create(title='Pack Size')
+
+        self.order_lines = [
+            OrderLine.objects.create(description='Line %i' % i, date_required=datetime.datetime.utcnow(), measurement=measurement)
+            for i in range(3)
+        ]
+
+        for order_line, color, size in zip(self.order_lines, ('Red', 'red', 'Blue'), ('10', '20', '10')):
+            ProductAttributeValue.objects.create(product_attribute=self.color, value=color, order_line=order_line)
+            ProductAttributeValue.objects.create(product_attribute=self.size, value=size, order_line=order_line)
+
+    def test_projection_written_through(self):
+        order_line = OrderLine.objects.get(id=self.order_lines[0].id)
+        self.assertEqual(order_line.attribute_values, {'color': ['red'], 'pack_size': ['10']})
+
+        value = ProductAttributeValue.objects.get(order_line=order_line, product_attribute=self.color)
+        value.order_line = self.order_lines[2]
+        value.save()
+
+        self.assertEqual(OrderLine.objects.get(id=self.order_lines[0].id).attribute_values, {'pack_size': ['10']})
+        self.assertEqual(OrderLine.objects.get(id=self.order_lines[2].id).attribute_values,
+                         {'color': ['blue', 'red'], 'pack_size': ['10']})
+
+    def test_filter_attributes(self):
+        def filtered(filters):
+            return set(OrderLine.objects.filter_attributes(filters).values_list('id', flat=True))
+
+        ids = [order_line.id for order_line in self.order_lines]
+
+        self.assertEqual(filtered({'color': 'RED'}), {ids[0], ids[1]})
+        self.assertEqual(filtered({'color': 'red', 'pack_size': '10'}), {ids[0]})
+        self.assertEqual(filtered({'color': ['red', 'blue'], 'pack_size': '10'}), {ids[0], ids[2]})
+        self.assertEqual(filtered({'color': 'green'}), set())
+        self.assertEqual(filtered({'color': []}), set())
@@ -0,0 +1,48 @@
+import datetime
+from django.test import TestCase
+from vitesse_prod.apps.db.models import Measurement, OrderLine, ProductAttribute, ProductAttributeValue, \
+    get_attribute_schema
+
+
+class TestAttributeSchema(TestCase):
+
+    def setUp(self):
+        self.measurement = Measurement.objects.create(name='pcs')
+        self.color = ProductAttribute.objects.create(title='Color')
+        self.size = ProductAttribute.objects.create(title='Pack Size')
+        self.note = ProductAttribute.objects.create(title='Note', is_custom=True)
+
+        self.order_lines = []
+        for i in range(5):
+            order_line = OrderLine.objects.create(
+                description='Line %i' % i, date_required=datetime.datetime.utcnow(), measurement=self.measurement
+            )
+            ProductAttributeValue.objects.create(product_attribute=self.color, value='Red', order_line=order_line)
+            ProductAttributeValue.objects.create(product_attribute=self.note, value='Urgent', order_line=order_line,
+                                                 is_manual=True)
+            self.order_lines.append(order_line)
+
+    def test_raw_attributes(self):
+        attributes = self.order_lines[0].raw_attributes
+
+        self.assertEqual(attributes['color'], {'is_custom': False, 'id': self.color.id, 'value': 'Red', 'is_manual': False})
+        self.assertEqual(attributes['pack_size'], {'is_custom': False, 'id': self.size.id})
+        self.assertEqual(attributes['note'], {'is_custom': True, 'id': self.note.id, 'value': 'Urgent', 'is_manual': True})
+
+    def test_schema_invalidated_on_save(self):
+        get_attribute_schema()
+        self.size.title = 'Box Size'
+        self.size.save()
+
+        self.assertIn('box_size', get_attribute_schema()['by_slug'])
+        self.assertNotIn('pack_size', get_attribute_schema()['by_slug'])
+
+    def test_bulk_raw_attributes_query_count(self):
+        get_attribute_schema()
+
+        with self.assertNumQueries(1):
+            result = OrderLine.bulk_raw_attributes(self.order_lines)
+
+        self.assertEqual(len(result), 5)
+        for order_line in self.order_lines:
+            self.assertEqual(result[order_line.id], order_line.raw_attributes)
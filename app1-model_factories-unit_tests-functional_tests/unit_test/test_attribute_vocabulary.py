@@ -0,0 +1,25 @@
+from django.test import SimpleTestCase
+from vitesse_prod.apps.db.attribute_vocabulary import AttributeVocabulary, TOP_VALUES_SIZE
+
+
+class TestAttributeVocabulary(SimpleTestCase):
+
+    def setUp(self):
+        self.vocabulary = AttributeVocabulary([
+            (u'red', u'Red', 5), (u'redwood', u'Redwood', 1), (u'reef', u'Reef', 5), (u'blue', u'Blue', 9),
+            (u'rose', u'Rose', 2),
+        ])
+
+    def test_prefix(self):
+        self.assertEqual([item['value'] for item in self.vocabulary.complete(u'RE')], [u'Red', u'Reef', u'Redwood'])
+        self.assertEqual([item['value'] for item in self.vocabulary.complete(u'red')], [u'Red', u'Redwood'])
+        self.assertEqual(self.vocabulary.complete(u'x'), [])
+
+    def test_limit(self):
+        self.assertEqual([item['value'] for item in self.vocabulary.complete(u'', limit=2)], [u'Blue', u'Red'])
+        self.assertEqual(self.vocabulary.complete(u'r', limit=1), [{'value': u'Red', 'count': 5}])
+
+    def test_short_prefixes_match_the_scan(self):
+        # Precomputed rankings up to TOP_VALUES_SIZE, larger limits scan the range
+        for prefix in (u'', u'r', u're', u'b'):
+            self.assertEqual(self.vocabulary.complete(prefix), self.vocabulary.complete(prefix, limit=TOP_VALUES_SIZE + 1))
@@ -0,0 +1,39 @@
+from django.test import SimpleTestCase
+from vitesse_prod.apps.db.buyer_assignment import BuyerIndex
+
+
+def memberships(region=(), company=(), category=(), subcategory=()):
+    return {'region': set(region), 'company': set(company), 'category': set(category), 'subcategory': set(subcategory)}
+
+
+class TestBuyerIndex(SimpleTestCase):
+
+    def setUp(self):
+        self.index = BuyerIndex()
+        self.index.set_buyer(1, memberships(region=[10], category=[100]))
+        self.index.set_buyer(2, memberships(region=[10]))
+        self.index.set_buyer(3, memberships(region=[20], company=[5]))
+
+    def test_candidates(self):
+        self.assertEqual(sorted(self.index.get_candidates((10, 5, 100, None))), [1, 2])
+        self.assertEqual(sorted(self.index.get_candidates((10, 5, 200, None))), [2])
+        self.assertEqual(sorted(self.index.get_candidates((20, 5, 100, None))), [3])
+        self.assertEqual(self.index.get_candidates((20, 6, 100, None)), [])
+        self.assertEqual(sorted(self.index.get_candidates((None, None, None, None))), [1, 2, 3])
+
+    def test_pick_balances_load(self):
+        self.index.loads[1] = 3
+        self.assertEqual(self.index.pick_buyer((10, 5, 100, None)), 2)
+
+        self.index.loads[2] = 3
+        self.assertEqual(self.index.pick_buyer((10, 5, 100, None)), 1)
+
+    def test_membership_changes(self):
+        self.assertEqual(sorted(self.index.get_candidates((10, 5, 100, None))), [1, 2])
+
+        self.index.set_buyer(2, memberships(region=[10], category=[200]))
+        self.assertEqual(self.index.get_candidates((10, 5, 100, None)), [1])
+
+        self.index.set_buyer(1, None)
+        self.assertEqual(self.index.get_candidates((10, 5, 100, None)), [])
+        self.assertEqual(self.index.get_candidates((10, 5, 200, None)), [2])
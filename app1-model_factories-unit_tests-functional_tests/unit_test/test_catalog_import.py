@@ -0,0 +1,41 @@
+import io
+
+from django.test import TestCase
+from vitesse_prod.apps.db.catalog_import import import_catalog
+from vitesse_prod.apps.db.models import Catalog, CatalogItem, Currency
+
+HEADER = b'Supplier Name,Title,Short Description,Image URL,Price,Currency,Measurement,Category,Category Level 2\n'
+
+
+class TestCatalogImport(TestCase):
+
+    def setUp(self):
+        Currency.objects.create(name='GBP', sign='$')
+        self.catalog = Catalog.objects.create(file_name='catalog.csv')
+
+    def run_import(self, rows):
+        return import_catalog(self.catalog, io.BytesIO(HEADER + b''.join(rows)), 'catalog.csv')
+
+    def test_delta_import(self):
+        report = self.run_import([
+            b'Acme,Bolt,M6 bolt,,1.5,gbp,pcs,Hardware,Fasteners\n',
+            b'Acme,Nut,M6 nut,,0.5,GBP,pcs,Hardware,Fasteners\n',
+            b'Acme,Washer,,,abc,GBP,pcs,Hardware,\n',
+        ])
+        self.assertEqual((report['created'], report['errors_count']), (2, 1))
+
+        bolt = CatalogItem.objects.get(title='Bolt')
+        self.assertEqual(bolt.category.name, 'Hardware')
+        self.assertEqual(bolt.category_level_2.name, 'Fasteners')
+
+        report = self.run_import([
+            b'Acme,Bolt,M6 bolt,,1.75,GBP,pcs,Hardware,Fasteners\n',
+        ])
+        self.assertEqual((report['created'], report['updated'], report['deactivated']), (0, 1, 1))
+        self.assertEqual(CatalogItem.objects.get(title='Bolt').price, 1.75)
+        self.assertFalse(CatalogItem.objects.get(title='Nut').is_active)
+
+        report = self.run_import([
+            b'Acme,Bolt,M6 bolt,,1.75,GBP,pcs,Hardware,Fasteners\n',
+        ])
+        self.assertEqual((report['updated'], report['unchanged']), (0, 1))
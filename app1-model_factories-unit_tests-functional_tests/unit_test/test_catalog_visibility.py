@@ -0,0 +1,25 @@
+from django.test import TestCase
+from vitesse_prod.apps.db.models import Catalog, Company, User
+
+
+class TestCatalogVisibility(TestCase):
+
+    def setUp(self):
+        self.company = Company.objects.create(name='Company')
+        self.user = User.objects.create(email='user@example.com', name='User', company=self.company, role=User.MANAGER)
+        self.company_catalog = Catalog.objects.create(file_name='company.csv')
+        self.user_catalog = Catalog.objects.create(file_name='user.csv')
+
+    def test_index_follows_m2m_changes(self):
+        self.assertEqual(self.user.get_visible_catalog_ids(), [])
+
+        self.company_catalog.companies.add(self.company)
+        self.user.user_catalogs.add(self.user_catalog)
+        self.assertEqual(
+            set(self.user.get_visible_catalog_ids()), {self.company_catalog.id, self.user_catalog.id}
+        )
+        self.assertEqual(set(Catalog.objects.visible_to(self.user)), {self.company_catalog, self.user_catalog})
+
+        self.company_catalog.companies.clear()
+        self.assertEqual(self.user.get_visible_catalog_ids(), [self.user_catalog.id])
+        self.assertFalse(self.user.has_catalog_items())
@@ -0,0 +1,30 @@
+from django.test import TestCase
+from vitesse_prod.apps.db.models import Company, CompanyEmailSettings, get_company_settings
+
+
+class TestCompanySettings(TestCase):
+
+    def setUp(self):
+        self.company = Company.objects.create(name='Company')
+        self.email_settings = CompanyEmailSettings.objects.create(
+            company=self.company,
+            quote_acceptance_justification_emails='a@example.com; ;b@example.com',
+            quote_pending_recipients_emails='c@example.com'
+        )
+
+    def test_one_query_per_company(self):
+        get_company_settings(self.company.id, refresh=True)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.company.get_quote_acceptance_justification_emails(), ['a@example.com', 'b@example.com'])
+            self.assertEqual(self.company.get_quote_pending_recipients_emails(), ['c@example.com'])
+            self.assertIsNone(self.company.get_custom_email_host())
+            self.assertEqual(self.company.get_logo_file_name(), '')
+
+    def test_invalidated_on_save(self):
+        self.company.get_quote_pending_recipients_emails()
+
+        self.email_settings.quote_pending_recipients_emails = 'd@example.com;e@example.com'
+        self.email_settings.save()
+
+        self.assertEqual(self.company.get_quote_pending_recipients_emails(), ['d@example.com', 'e@example.com'])
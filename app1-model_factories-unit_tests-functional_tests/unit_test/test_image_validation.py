@@ -0,0 +1,88 @@
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from django.test import TestCase
+from vitesse_prod.apps.db.image_validation import validate_image_urls
+
+
+class StubImageHandler(BaseHTTPRequestHandler):
+
+    requests_count = 0
+
+    def respond(self, with_body):
+        StubImageHandler.requests_count += 1
+
+        if self.path == '/image.png':
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('ETag', '"v1"')
+
+        elif self.path == '/no-head.jpg':
+            if not with_body:
+                self.send_response(405)
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Type', 'image/jpeg')
+
+        elif self.path == '/page':
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+
+        else:
+            self.send_response(404)
+
+        self.send_header('Content-Length', '1' if with_body else '0')
+        self.end_headers()
+        if with_body:
+            self.wfile.write(b'x')
+
+    def do_HEAD(self):
+        self.respond(False)
+
+    def do_GET(self):
+        self.respond(True)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestImageValidation(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestImageValidation, cls).setUpClass()
+        cls.server = HTTPServer(('127.0.0.1', 0), StubImageHandler)
+        cls.server_thread = threading.Thread(target=cls.server.serve_forever)
+        cls.server_thread.daemon = True
+        cls.server_thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super(TestImageValidation, cls).tearDownClass()
+
+    def url(self, path):
+        return 'http://127.0.0.1:%i%s' % (self.server.server_port, path)
+
+    def test_validate_and_cache(self):
+        urls = [self.url(path) for path in ('/image.png', '/no-head.jpg', '/page', '/missing.gif')]
+
+        self.assertEqual(validate_image_urls(urls, workers=4), {
+            urls[0]: True, urls[1]: True, urls[2]: False, urls[3]: False
+        })
+
+        StubImageHandler.requests_count = 0
+        validate_image_urls(urls, workers=4)
+        self.assertEqual(StubImageHandler.requests_count, 0)
+
+    def test_revalidated_with_etag(self):
+        url = self.url('/image.png')
+        validate_image_urls([url])
+
+        self.assertEqual(validate_image_urls([url], refresh=True), {url: True})
@@ -0,0 +1,37 @@
+from django.test import TestCase
+from vitesse_prod.apps.db.models import Company, Currency, DeliveryLocation, Order, OrderFile, Quote, Supplier, \
+    SupplierQuote, User
+
+
+class TestOrderListing(TestCase):
+
+    def setUp(self):
+        company = Company.objects.create(name='Company')
+        user = User.objects.create(email='user@example.com', name='User', company=company, role=User.MANAGER)
+        currency = Currency.objects.create(name='GBP', sign='$')
+        location = DeliveryLocation.objects.create(creator=user, company=company, name='Office', address='Street')
+        suppliers = [Supplier.objects.create(email='supplier_%i@example.com' % i) for i in range(2)]
+
+        for i in range(20):
+            order = Order.objects.create(
+                company=company, app_user=user, currency=currency, delivery_location=location,
+                estimated_value=10, status=Order.STATUS_QUOTED
+            )
+            OrderFile.objects.create(order=order, file='orders/%i.png' % i)
+            Quote.objects.create(order=order, value=8, accepted=True)
+
+            SupplierQuote.objects.create(order=order, supplier=suppliers[0], is_submitted=True,
+                                         supplier_process_status=SupplierQuote.SUPPLIER_PROCESS_STATUS_QUOTED)
+            SupplierQuote.objects.create(order=order, supplier=suppliers[1], is_submitted=True,
+                                         supplier_process_status=SupplierQuote.SUPPLIER_PROCESS_STATUS_OPEN)
+
+    def test_query_budget(self):
+
+        with self.assertNumQueries(1):
+            for order in Order.objects.for_listing():
+                self.assertEqual(order.rfq_count_str, '1/2')
+                self.assertTrue(order.get_main_image().file_name.endswith('.png'))
+                self.assertEqual(order.get_estimated_value(), '$ 10.00')
+                self.assertEqual(order.ui_status, {'value': 'quoted', 'label': 'New'})
+                self.assertEqual(order.ui_status_value, 'quoted')
+                self.assertEqual(order.get_savings_amount(), 2)
@@ -0,0 +1,60 @@
+from django.core.cache import cache
+from django.test import TestCase
+from vitesse_prod.apps.db.models import Product, ProductAttribute, ProductAttributeValue, ProductAttributeValueThrough, \
+    ProductMeasurement, ProductMeasurementGroup, get_products_values
+
+
+class TestProductValues(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+        group = ProductMeasurementGroup.objects.create(title='Weight')
+        ProductMeasurement.objects.create(title='kg', group=group)
+        ProductMeasurement.objects.create(title='g', group=group)
+
+        self.products = []
+        for i in range(3):
+            product = Product.objects.create(title='Product %i' % i)
+
+            for j in range(10):
+                attribute = ProductAttribute.objects.create(title='Attribute %i %i' % (i, j))
+                attribute.measurements.add(group)
+                product.attributes.add(attribute)
+
+                for value in ('Red', 'red', 'Blue'):
+                    ProductAttributeValueThrough.objects.create(
+                        product=product, attribute=attribute,
+                        value=ProductAttributeValue.objects.create(product_attribute=attribute, value=value)
+                    )
+
+            self.products.append(product)
+
+    def test_matrix(self):
+        values = self.products[0].values['Attribute 0 1']
+
+        self.assertEqual(values['slug'], 'attribute_0_1')
+        self.assertEqual([value['value_lower'] for value in values['values']], ['blue', 'red'])
+        self.assertEqual(values['measurements'], ['g', 'kg'])
+
+    def test_query_budget(self):
+        cache.clear()
+
+        with self.assertNumQueries(4):
+            values = get_products_values([product.id for product in self.products])
+
+        self.assertEqual(sum(len(product_values) for product_values in values.values()), 30)
+
+        with self.assertNumQueries(0):
+            get_products_values([product.id for product in self.products])
+
+    def test_invalidated_on_value_change(self):
+        product = self.products[0]
+        attribute = product.attributes.get(title='Attribute 0 0')
+        self.assertEqual(len(product.values['Attribute 0 0']['values']), 2)
+
+        ProductAttributeValueThrough.objects.create(
+            product=product, attribute=attribute,
+            value=ProductAttributeValue.objects.create(product_attribute=attribute, value='Green')
+        )
+        self.assertEqual(len(product.values['Attribute 0 0']['values']), 3)
@@ -0,0 +1,61 @@
+from django.test import SimpleTestCase, TestCase
+from vitesse_prod.apps.db.models import Category, Company, CompanyCategorySupplier, Subcategory, Supplier
+from vitesse_prod.apps.db.supplier_routing import ROUTE_MAX_SUPPLIERS, build_supplier_routes, get_ranked_ids, \
+    get_route_supplier_ids
+
+
+class TestRouteLookup(SimpleTestCase):
+
+    def test_ranked_ids(self):
+        self.assertEqual(get_ranked_ids({3: 10, 1: 20, 2: 10}), [1, 2, 3])
+        self.assertEqual(len(get_ranked_ids(dict((i, i) for i in range(ROUTE_MAX_SUPPLIERS + 10)))), ROUTE_MAX_SUPPLIERS)
+
+    def test_most_specific_route(self):
+        routes = {
+            (1, 10, 100): [1],
+            (1, 10, None): [2],
+            (None, 10, 100): [3],
+            (None, 10, None): [4],
+        }
+
+        self.assertEqual(get_route_supplier_ids(routes, 1, 10, 100), [1])
+        self.assertEqual(get_route_supplier_ids(routes, 1, 10, 200), [2])
+        self.assertEqual(get_route_supplier_ids(routes, 1, 10, None), [2])
+        self.assertEqual(get_route_supplier_ids(routes, 2, 10, 100), [3])
+        self.assertEqual(get_route_supplier_ids(routes, 2, 10, None), [4])
+        self.assertEqual(get_route_supplier_ids(routes, 2, 20, None), [])
+
+
+class TestBuildSupplierRoutes(TestCase):
+
+    def setUp(self):
+        self.company = Company.objects.create(name='Company')
+        self.category = Category.objects.create(name='Category')
+        self.subcategory = Subcategory.objects.create(name='Subcategory', category=self.category)
+        self.suppliers = [Supplier.objects.create(email='supplier_%i@example.com' % i) for i in range(3)]
+
+        self.suppliers[0].category.add(self.category)
+        self.suppliers[1].subcategory.add(self.subcategory)
+        CompanyCategorySupplier.objects.create(company=self.company, category=self.category, supplier=self.suppliers[2])
+
+    def get_routes(self, **kwargs):
+        return dict(((route.company_id, route.category_id, route.subcategory_id), route.supplier_ids)
+                    for route in build_supplier_routes(**kwargs))
+
+    def test_scores(self):
+        routes = self.get_routes()
+        supplier_ids = [supplier.id for supplier in self.suppliers]
+
+        self.assertEqual(routes[(None, self.category.id, None)], [supplier_ids[0]])
+        self.assertEqual(routes[(None, self.category.id, self.subcategory.id)], [supplier_ids[1], supplier_ids[0]])
+        self.assertEqual(routes[(self.company.id, self.category.id, None)], [supplier_ids[2], supplier_ids[0]])
+
+    def test_company_route_keeps_global_subcategory_suppliers(self):
+        routes = self.get_routes(company_ids=[self.company.id])
+        supplier_ids = [supplier.id for supplier in self.suppliers]
+
+        self.assertNotIn((None, self.category.id, None), routes)
+        self.assertEqual(routes[(self.company.id, self.category.id, self.subcategory.id)],
+                         [supplier_ids[2], supplier_ids[1], supplier_ids[0]])
+        self.assertEqual(get_route_supplier_ids(routes, self.company.id, self.category.id, self.subcategory.id),
+                         [supplier_ids[2], supplier_ids[1], supplier_ids[0]])